@@ -1,7 +1,10 @@
+import functools
+
 from django.conf import settings
 from django.http import HttpResponse
 from tastypie import fields, http
 from tastypie.authentication import ApiKeyAuthentication, MultiAuthentication, SessionAuthentication
+from tastypie.exceptions import ImmediateHttpResponse
 from tastypie.resources import NamespacedModelResource as ModelResource
 
 from clist.api.authentication import OAuth2ScopedAuthentication
@@ -63,6 +66,25 @@ class BaseModelResource(ModelResource):
             ),
         )
 
+    def throttle_check(self, request):
+        identifier = self._meta.authentication.get_identifier(request)
+        state = self._meta.throttle.check(identifier)
+        request.throttle_state = state
+        if state.retry_after:
+            raise ImmediateHttpResponse(response=http.HttpTooManyRequests())
+
+    def wrap_view(self, view):
+        wrapper = super().wrap_view(view)
+
+        @functools.wraps(wrapper)
+        def wrapped(request, *args, **kwargs):
+            response = wrapper(request, *args, **kwargs)
+            state = getattr(request, 'throttle_state', None)
+            if state is not None:
+                self._meta.throttle.set_headers(response, state)
+            return response
+        return wrapped
+
     def _handle_500(self, request, exception):
         data = {'error_message': str(exception)}
         return self.error_response(request, data, response_class=http.HttpApplicationError)
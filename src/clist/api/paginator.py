@@ -1,13 +1,34 @@
+import base64
+import binascii
+import datetime
+import hashlib
 import json
+from urllib.parse import urlencode
 
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
+from tastypie.exceptions import BadRequest
 from tastypie.paginator import Paginator
 
 
+class CursorJSONEncoder(DjangoJSONEncoder):
+    """Keep microseconds of datetimes, DjangoJSONEncoder truncates them to milliseconds."""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
 class EstimatedCountPaginator(Paginator):
+    estimated_count_cache_timeout = 10 * 60
 
     def __init__(self, request_data, *args, **kwargs):
         self.return_total_count = request_data.get('total_count') in ['true', '1', 'yes']
+        self.cursor = request_data.get('cursor')
         super().__init__(request_data, *args, **kwargs)
 
     def get_next(self, limit, offset, count):
@@ -26,7 +47,13 @@ class EstimatedCountPaginator(Paginator):
         """Get the estimated count by using the database query planner."""
         # If you do not have PostgreSQL as your DB backend, alter this method
         # accordingly.
-        return self._get_postgres_estimated_count()
+        try:
+            query, params = self.objects.query.sql_with_params()
+        except AttributeError:
+            return self._get_postgres_estimated_count()
+        signature = hashlib.md5(f'{query} {params}'.encode()).hexdigest()
+        return cache.get_or_set(f'api_estimated_count_{signature}', self._get_postgres_estimated_count,
+                                timeout=self.estimated_count_cache_timeout)
 
     def _get_postgres_estimated_count(self):
 
@@ -64,8 +91,103 @@ class EstimatedCountPaginator(Paginator):
         rows = explain[0]['Plan']['Plan Rows']
         return rows
 
+    def get_ordering(self):
+        query = self.objects.query
+        ordering = query.order_by or (query.get_meta().ordering if query.default_ordering else [])
+        ret = []
+        for order in ordering:
+            if isinstance(order, str):
+                descending = order.startswith('-')
+                field = order.lstrip('-')
+                nulls_last = not descending
+            elif isinstance(order, OrderBy) and isinstance(order.expression, F):
+                descending = order.descending
+                field = order.expression.name
+                nulls_last = order.nulls_last or not descending and not order.nulls_first
+            else:
+                raise BadRequest('Cursor pagination is not supported for this ordering')
+            field = 'pk' if field in ('id', 'pk') else field
+            ret.append((field, descending, nulls_last))
+        if 'pk' not in [field for field, _, _ in ret]:
+            ret.append(('pk', False, True))
+        return ret
+
+    @staticmethod
+    def get_value(obj, field):
+        for attr in field.split('__'):
+            obj = getattr(obj, attr, None)
+        return getattr(obj, 'pk', obj)
+
+    @staticmethod
+    def encode_cursor(values):
+        data = json.dumps(values, cls=CursorJSONEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (binascii.Error, ValueError):
+            raise BadRequest(f"Invalid cursor '{cursor}' provided.")
+
+    @staticmethod
+    def get_seek_filter(ordering, values):
+        """Filter of rows following values in ordering, expanded (a, b) > (x, y) for mixed directions."""
+        ret = Q(pk__in=[])
+        equal = Q()
+        for (field, descending, nulls_last), value in zip(ordering, values):
+            if value is None:
+                if not nulls_last:
+                    ret |= equal & Q(**{f'{field}__isnull': False})
+                equal &= Q(**{f'{field}__isnull': True})
+            else:
+                after = Q(**{f'{field}__{"lt" if descending else "gt"}': value})
+                if nulls_last:
+                    after |= Q(**{f'{field}__isnull': True})
+                ret |= equal & after
+                equal &= Q(**{field: value})
+        return ret
+
+    def _generate_cursor_uri(self, limit, cursor):
+        if self.resource_uri is None:
+            return None
+        request_params = self.request_data.copy()
+        for param in ('limit', 'offset', 'cursor'):
+            request_params.pop(param, None)
+        request_params.update({'limit': str(limit), 'cursor': cursor})
+        if hasattr(request_params, 'urlencode'):
+            encoded_params = request_params.urlencode()
+        else:
+            encoded_params = urlencode(request_params)
+        return f'{self.resource_uri}?{encoded_params}'
+
+    def cursor_page(self):
+        try:
+            ordering = self.get_ordering()
+        except AttributeError:
+            raise BadRequest('Cursor pagination is not supported for this resource')
+        limit = self.get_limit() or self.max_limit
+        objects = self.objects
+        if self.cursor:
+            values = self.decode_cursor(self.cursor)
+            if not isinstance(values, list) or len(values) != len(ordering):
+                raise BadRequest(f"Invalid cursor '{self.cursor}' provided.")
+            objects = objects.filter(self.get_seek_filter(ordering, values))
+        objects = list(objects[:limit + 1])
+        has_next = len(objects) > limit
+        objects = objects[:limit]
+
+        meta = {'limit': limit, 'cursor': self.cursor or None, 'next': None, 'total_count': self.get_count()}
+        if has_next:
+            values = [self.get_value(objects[-1], field) for field, _, _ in ordering]
+            meta['next'] = self._generate_cursor_uri(limit, self.encode_cursor(values))
+        return {self.collection_name: objects, 'meta': meta}
+
     def page(self):
-        data = super().page()
+        if self.cursor is not None:
+            data = self.cursor_page()
+        else:
+            data = super().page()
         data['meta']['estimated_count'] = self.get_estimated_count()
         if not data[self.collection_name]:
             data['meta']['next'] = None
@@ -1,37 +1,107 @@
 #!/usr/bin/env python3
 
+import math
 import time
+from collections import namedtuple
+from logging import getLogger
 
 from django.core.cache import cache
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
 from tastypie.throttle import CacheThrottle
 
 from true_coders.models import Coder
 
+logger = getLogger('clist.api.throttle')
 
-class CustomCacheThrottle(CacheThrottle):
+ThrottleState = namedtuple('ThrottleState', ['limit', 'remaining', 'retry_after'])
 
-    def convert_identifier_to_key(self, identifier):
-        return str(identifier)
+# Sliding window counter: weighted previous window plus current window, two integer keys per identifier.
+# Check and increment are done in one script so concurrent workers can not overshoot the limit.
+SLIDING_WINDOW_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local timeframe = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+local window = math.floor(now / timeframe)
+local elapsed = now - window * timeframe
+local current_key = KEYS[1] .. ':' .. window
+local previous_key = KEYS[1] .. ':' .. (window - 1)
+local current = tonumber(redis.call('GET', current_key) or '0')
+local previous = tonumber(redis.call('GET', previous_key) or '0')
+local weight = 1 - elapsed / timeframe
+local used = previous * weight + current
+if used >= limit then
+    local retry_after
+    if current >= limit or previous == 0 then
+        retry_after = timeframe - elapsed
+    else
+        retry_after = timeframe * (1 - (limit - current) / previous) - elapsed
+    end
+    return {0, 0, tostring(retry_after)}
+end
+current = redis.call('INCR', current_key)
+if current == 1 then
+    redis.call('EXPIRE', current_key, timeframe * 2)
+end
+return {1, math.floor(limit - previous * weight - current), '0'}
+'''
 
-    def should_be_throttled(self, identifier, **kwargs):
-        key = self.convert_identifier_to_key(identifier)
-        limit_key = key + '[limit]'
 
-        now = int(time.time())
-        timeframe = int(self.timeframe)
-        throttle_at = int(cache.get(limit_key, self.throttle_at))
+class CustomCacheThrottle(CacheThrottle):
+    limit_timeout = 3600
 
-        minimum_time = now - timeframe
-        times_accessed = [access for access in cache.get(key, []) if access >= minimum_time]
-        cache.set(key, times_accessed, self.expiration)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._script = None
 
-        if len(times_accessed) >= throttle_at:
-            return timeframe - (now - times_accessed[-throttle_at])
+    @property
+    def script(self):
+        if self._script is None:
+            self._script = get_redis_connection('default').register_script(SLIDING_WINDOW_SCRIPT)
+        return self._script
 
-        if limit_key not in cache:
+    def convert_identifier_to_key(self, identifier):
+        return str(identifier)
+
+    def get_limit_key(self, identifier):
+        return self.convert_identifier_to_key(identifier) + '[limit]'
+
+    def get_throttle_at(self, identifier):
+        limit_key = self.get_limit_key(identifier)
+        throttle_at = cache.get(limit_key)
+        if throttle_at is None:
             settings = Coder.objects.filter(username=identifier).values_list('settings', flat=True)
             settings = settings[0] if settings else {}
             throttle_at = settings.get('api_throttle_at', self.throttle_at)
-            cache.set(limit_key, throttle_at, 3600)
+            cache.set(limit_key, throttle_at, self.limit_timeout)
+        return int(throttle_at)
+
+    def check(self, identifier):
+        throttle_at = self.get_throttle_at(identifier)
+        key = cache.make_key('throttle:' + self.convert_identifier_to_key(identifier))
+        try:
+            allowed, remaining, retry_after = self.script(
+                keys=[key],
+                args=[time.time(), int(self.timeframe), throttle_at],
+            )
+        except RedisError as e:
+            # fail open as cache does with IGNORE_EXCEPTIONS
+            logger.warning(f'Throttle check failed for {identifier}: {e}')
+            self._script = None
+            return ThrottleState(limit=throttle_at, remaining=throttle_at, retry_after=0)
+        retry_after = 0 if allowed else max(math.ceil(float(retry_after)), 1)
+        return ThrottleState(limit=throttle_at, remaining=max(int(remaining), 0), retry_after=retry_after)
+
+    def should_be_throttled(self, identifier, **kwargs):
+        state = self.check(identifier)
+        return state.retry_after or False
+
+    def accessed(self, identifier, **kwargs):
+        # access is counted atomically in check
+        pass
 
-        return False
+    def set_headers(self, response, state):
+        response['X-RateLimit-Limit'] = state.limit
+        response['X-RateLimit-Remaining'] = state.remaining
+        if state.retry_after:
+            response['Retry-After'] = state.retry_after
@@ -1,14 +1,18 @@
+import csv
+import io
 import json
 import re
 
 import arrow
 from django.conf import settings
 from django.core.exceptions import FieldDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models import CharField, IntegerField, JSONField, Value
 from django.db.models.constants import LOOKUP_SEP
 from django.db.models.expressions import F
 from django.db.models.fields.json import KeyTextTransform
 from django.db.models.functions import Cast
+from django.http import StreamingHttpResponse
 from django.urls import re_path, reverse
 from django.utils.timezone import now
 from tastypie import fields
@@ -29,9 +33,90 @@ from utils.timetools import parse_duration
 
 
 class BaseModelResource(CommmonBaseModuelResource):
+    export_chunk_size = 2000
 
     class Meta(CommmonBaseModuelResource.Meta):
         paginator_class = EstimatedCountPaginator
+        export_allowed = False
+
+    def prepend_urls(self):
+        if not self._meta.export_allowed:
+            return []
+        return [
+            re_path(
+                r'^(?P<resource_name>%s)/export%s$' % (self._meta.resource_name, trailing_slash),
+                self.wrap_view('export'),
+                name='api_dispatch_export'
+            )
+        ]
+
+    def clean_data(self, data):
+        return data
+
+    def get_export_fields(self, objects):
+        model_meta = self._meta.object_class._meta
+        ret = []
+        for name, field in self.fields.items():
+            if name in self._meta.excludes or not isinstance(field.attribute, str):
+                continue
+            attribute = field.attribute
+            if attribute not in objects.query.annotations:
+                try:
+                    model_meta.get_field(attribute.split(LOOKUP_SEP)[0])
+                except FieldDoesNotExist:
+                    attribute = None
+            ret.append((name, attribute))
+        return ret
+
+    def export(self, request, **kwargs):
+        """Stream all filtered objects as newline-delimited json (default) or csv without pagination."""
+        self.method_check(request, allowed=['get'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        export_format = request.GET.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise BadRequest(f"Invalid format '{export_format}' provided, use ndjson or csv.")
+
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.apply_sorting(objects, options=request.GET)
+        export_fields = self.get_export_fields(objects)
+        names = [name for name, _ in export_fields]
+        attributes = [attribute for _, attribute in export_fields if attribute]
+        rows = objects.values_list(*attributes).iterator(chunk_size=self.export_chunk_size)
+
+        def get_data(row):
+            values = iter(row)
+            data = {name: next(values) if attribute else None for name, attribute in export_fields}
+            return self.clean_data(data)
+
+        def stream_ndjson():
+            for row in rows:
+                yield json.dumps(get_data(row), cls=DjangoJSONEncoder) + '\n'
+
+        def stream_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(names)
+            for row in rows:
+                data = get_data(row)
+                values = [data[name] for name in names]
+                writer.writerow([
+                    json.dumps(value, cls=DjangoJSONEncoder) if isinstance(value, (dict, list)) else value
+                    for value in values
+                ])
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+
+        self.log_throttled_access(request)
+        if export_format == 'csv':
+            response = StreamingHttpResponse(stream_csv(), content_type='text/csv; charset=utf-8')
+            response['Content-Disposition'] = f'attachment; filename="{self._meta.resource_name}.csv"'
+        else:
+            response = StreamingHttpResponse(stream_ndjson(), content_type='application/x-ndjson; charset=utf-8')
+        return response
 
     def build_filters(self, filters=None, *args, **kwargs):
         filters = filters or {}
@@ -296,6 +381,7 @@ class StatisticsResource(BaseModelResource):
         }
         ordering = ['id', 'score', 'place', 'new_rating', 'rating_change', 'date']
         detail_allowed_methods = []
+        export_allowed = True
 
     def build_filters(self, filters=None, *args, **kwargs):
         filters = filters or {}
@@ -345,13 +431,12 @@ class StatisticsResource(BaseModelResource):
 
         return qs
 
-    def dehydrate(self, *args, **kwargs):
-        bundle = super().dehydrate(*args, **kwargs)
-        bundle.data.pop('coder_id', None)
-        bundle.data.pop('with_problems', None)
-        bundle.data.pop('with_more_fields', None)
+    def clean_data(self, data):
+        data.pop('coder_id', None)
+        data.pop('with_problems', None)
+        data.pop('with_more_fields', None)
 
-        problems = bundle.data['problems']
+        problems = data['problems']
         if problems:
             for problem in problems.values():
                 for k in list(problem.keys()):
@@ -360,13 +445,18 @@ class StatisticsResource(BaseModelResource):
                 for k in settings.PROBLEM_API_IGNORE_FIELDS:
                     problem.pop(k, None)
 
-        more_fields = bundle.data['more_fields']
+        more_fields = data['more_fields']
         if more_fields:
             for k in list(more_fields.keys()):
-                if k.startswith('_') or k in bundle.data:
+                if k.startswith('_') or k in data:
                     more_fields.pop(k, None)
             for k in 'problems', 'solved':
                 more_fields.pop(k, None)
+        return data
+
+    def dehydrate(self, *args, **kwargs):
+        bundle = super().dehydrate(*args, **kwargs)
+        self.clean_data(bundle.data)
         return bundle
 
 
@@ -395,6 +485,7 @@ class AccountResource(BaseModelResource):
             'overall_rank': ['exact', 'gt', 'lt', 'gte', 'lte', 'isnull'],
         }
         ordering = ['id', 'handle', 'rating', 'overall_rank', 'n_contests']
+        export_allowed = True
 
     def apply_filters(self, request, applicable_filters):
         qs = super().apply_filters(request, applicable_filters)
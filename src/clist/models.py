@@ -6,6 +6,7 @@ import logging
 import math
 import os
 import re
+import uuid
 from collections import defaultdict
 from collections.abc import Iterable
 from datetime import datetime, timedelta, timezone
@@ -20,11 +21,13 @@ from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
+from django.core.cache import cache
 from django.core.files.base import ContentFile
 from django.db import models, transaction
-from django.db.models import Case, F, Max, Q, When
+from django.db.models import Case, F, Max, Q, When, signals
 from django.db.models.expressions import Exists, OuterRef
 from django.db.models.functions import Cast, Ln
+from django.dispatch import receiver
 from django.http import Http404
 from django.urls import reverse
 from django.utils.timezone import now as timezone_now
@@ -566,6 +569,9 @@ class Contest(BaseModel):
         'scoring': 'SCORING',
         'cf': 'CF',
     }
+    EVENTS_CACHE_VERSION_KEY = 'contest_events_cache_version'
+    EVENTS_FIELDS = ('resource_id', 'title', 'host', 'start_time', 'end_time', 'duration_in_secs', 'url',
+                     'standings_url', 'registration_url', 'invisible')
 
     resource = models.ForeignKey(Resource, on_delete=models.CASCADE)
     kind = models.CharField(max_length=30, blank=True, null=True, db_index=True)
@@ -681,6 +687,8 @@ class Contest(BaseModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.prev_is_rated = self.is_rated
+        self.prev_events_signature = self.get_events_signature()
+        self.prev_end_time = self.__dict__.get('end_time')
 
     def save(self, *args, **kwargs):
         if self.duration_in_secs is None:
@@ -769,6 +777,26 @@ class Contest(BaseModel):
     def next_time_datetime(self):
         return self.end_time if self.is_running() else self.start_time
 
+    @classmethod
+    def get_events_cache_version(cls):
+        version = cache.get(cls.EVENTS_CACHE_VERSION_KEY)
+        if version is None:
+            version = cls.reset_events_cache_version()
+        return version
+
+    def get_events_signature(self):
+        values = self.__dict__
+        signature = [values.get(field) for field in self.EVENTS_FIELDS]
+        signature.append(bool(values.get('n_statistics')))
+        signature.append(bool(get_item(values.get('info'), 'problems')))
+        return signature
+
+    @classmethod
+    def reset_events_cache_version(cls):
+        version = uuid.uuid4().hex
+        cache.set(cls.EVENTS_CACHE_VERSION_KEY, version, timeout=None)
+        return version
+
     def __str__(self):
         return f'{self.title} Contest#{self.id}'
 
@@ -1148,6 +1176,16 @@ class Contest(BaseModel):
         return None
 
 
+@receiver([signals.post_save, signals.post_delete], sender=Contest)
+def reset_contest_events_cache(sender, instance, signal, **kwargs):
+    if signal is signals.post_save:
+        signature = instance.get_events_signature()
+        if not kwargs.get('created') and signature == instance.prev_events_signature:
+            return
+        instance.prev_events_signature = signature
+    Contest.reset_events_cache_version()
+
+
 class ContestSeries(BaseModel):
     name = models.TextField(unique=True, db_index=True, null=False)
     short = models.TextField(unique=True, db_index=True, null=False)
@@ -1285,7 +1323,7 @@ class Problem(BaseModel):
         )
 
     @staticmethod
-    @timed_cache('15m')
+    @timed_cache('15m', none_timeout=0)
     def cached_get(contest, short) -> Optional['Problem']:
         try:
             return Problem.objects.get(Q(short=short) & (Q(contest=contest) | Q(contests=contest)))
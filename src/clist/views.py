@@ -1,3 +1,4 @@
+import hashlib
 from collections import OrderedDict
 from datetime import timedelta
 from urllib.parse import parse_qs, urlparse
@@ -6,6 +7,7 @@ import arrow
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.management.commands import dumpdata
 from django.db.models import Avg, Count, F, FloatField, Max, Min, OuterRef, Prefetch, Q, Subquery
 from django.db.models.functions import Cast
@@ -135,7 +137,7 @@ def get_events(request):
 
     query = Q()
     if resources:
-        query = Q(resource__in=resources)
+        query = Q(resource__in=sorted(resource.pk for resource in resources))
     elif coder:
         query = coder.get_contest_filter(categories, ignore_filters)
     elif has_filter:
@@ -149,15 +151,28 @@ def get_events(request):
     if coder:
         past_action = coder.settings.get('past_action_in_calendar', past_action)
 
+    favorite_value = request.POST.get('favorite')
+    use_cache = favorite_value not in ('on', 'off')
+
+    # cached events are selected for the whole cache period and filtered by exact time for each request
+    if use_cache:
+        cache_timeout = settings.GET_EVENTS_CACHE_TIMEOUT_
+        time_from = now.replace(microsecond=0) - timedelta(seconds=int(now.timestamp()) % cache_timeout)
+        time_to = time_from + timedelta(seconds=cache_timeout)
+    else:
+        time_from = time_to = now
+
     start_time = arrow.get(request.POST.get('start', now)).datetime
     end_time = arrow.get(request.POST.get('end', now + timedelta(days=31))).datetime
-    query = query & Q(end_time__gte=start_time) & Q(start_time__lte=end_time)
+    query_start_time = arrow.get(request.POST['start']).datetime if 'start' in request.POST else time_from
+    query_end_time = (arrow.get(request.POST['end']).datetime if 'end' in request.POST
+                      else time_to + timedelta(days=31))
+    query = query & Q(end_time__gte=query_start_time) & Q(start_time__lte=query_end_time)
 
     search_query = request.POST.get('search_query')
     if search_query:
         query &= get_iregex_filter(search_query, 'host', 'title')
 
-    favorite_value = request.POST.get('favorite')
     if favorite_value == 'on':
         query &= Q(is_favorite=True)
     elif favorite_value == 'off':
@@ -169,12 +184,14 @@ def get_events(request):
         query = Q(ratings__party=party) & query
 
     contests = Contest.objects if party_slug else Contest.visible
-    contests = contests.annotate_favorite(coder)
+    if favorite_value in ('on', 'off'):
+        contests = contests.annotate_favorite(coder)
     contests = contests.select_related('resource')
     contests = contests.order_by('start_time', 'title')
 
+    start_day = None
     if past_action == 'hide':
-        contests = contests.filter(end_time__gte=now)
+        contests = contests.filter(end_time__gte=time_from)
     elif 'day' in past_action:
         threshold = now - timedelta(days=1) + timedelta(minutes=offset)
         start_day = threshold.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -182,33 +199,74 @@ def get_events(request):
         past_action = past_action.split('-')[0]
 
     if status == 'coming':
-        contests = contests.filter(start_time__gt=now)
+        contests = contests.filter(start_time__gt=time_from)
     elif status == 'running':
-        contests = contests.filter(start_time__lte=now, end_time__gte=now)
+        contests = contests.filter(start_time__lte=time_to, end_time__gte=time_from)
+
+    def get_contest_events():
+        events = []
+        for contest in contests.filter(query):
+            color = contest.resource.color
+            past_color = contest.resource.info.get('get_events', {}).get('colors', {}).get(past_action, color)
+            start_time = (contest.start_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S")
+            end_time = (contest.end_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S")
+            events.append({
+                'id': contest.pk,
+                'title': contest.title,
+                'host': contest.host,
+                'url': contest.actual_url,
+                'start': start_time,
+                'end': end_time,
+                'hr_duration': contest.hr_duration,
+                'color': color,
+                'icon': media_size(contest.resource.icon_file.name, 32),
+                'allDay': contest.full_duration >= timedelta(days=1),
+                '_start_time': contest.start_time,
+                '_end_time': contest.end_time,
+                '_past_color': past_color,
+            })
+        return events
+
+    if not use_cache:
+        events = get_contest_events()
+    else:
+        signature = [str(query), party_slug, past_action, start_day, status, offset, time_from]
+        signature = hashlib.md5(str(signature).encode('utf8')).hexdigest()
+        cache_key = f'get_events_{Contest.get_events_cache_version()}_{signature}'
+        events = cache.get_or_set(cache_key, get_contest_events, settings.GET_EVENTS_CACHE_TIMEOUT_)
+
+    favorite_contests = set()
+    if coder and events:
+        favorite_contests = set(Activity.objects.filter(
+            coder=coder,
+            activity_type=Activity.Type.FAVORITE,
+            content_type=ContentType.objects.get_for_model(Contest),
+            object_id__in=[event['id'] for event in events],
+        ).values_list('object_id', flat=True))
 
     result = []
-    for contest in contests.filter(query):
-        color = contest.resource.color
-        if past_action not in ['show', 'hide'] and contest.end_time < now:
-            color = contest.resource.info.get('get_events', {}).get('colors', {}).get(past_action, color)
-
-        start_time = (contest.start_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S")
-        end_time = (contest.end_time + timedelta(minutes=offset)).strftime("%Y-%m-%dT%H:%M:%S")
-        c = {
-            'id': contest.pk,
-            'title': contest.title,
-            'host': contest.host,
-            'url': contest.actual_url,
-            'start': start_time,
-            'end': end_time,
-            'countdown': contest.next_time_to(now),
-            'hr_duration': contest.hr_duration,
-            'color': color,
-            'icon': media_size(contest.resource.icon_file.name, 32),
-            'allDay': contest.full_duration >= timedelta(days=1),
-        }
+    for event in events:
+        contest_start_time = event['_start_time']
+        contest_end_time = event['_end_time']
+        if contest_end_time < start_time or contest_start_time > end_time:
+            continue
+        if past_action == 'hide' and contest_end_time < now:
+            continue
+        if status == 'coming' and contest_start_time <= now:
+            continue
+        if status == 'running' and not (contest_start_time <= now <= contest_end_time):
+            continue
+
+        c = {k: v for k, v in event.items() if not k.startswith('_')}
+        if past_action not in ['show', 'hide'] and contest_end_time < now:
+            c['color'] = event['_past_color']
+        if contest_end_time <= now:
+            c['countdown'] = 0
+        else:
+            next_time = contest_end_time if contest_start_time <= now else contest_start_time
+            c['countdown'] = int(round((next_time - now).total_seconds()))
         if coder:
-            c['favorite'] = contest.is_favorite
+            c['favorite'] = event['id'] in favorite_contests
         result.append(c)
     return JsonResponse(result, safe=False)
 
@@ -2,19 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from bisect import bisect_left
+from collections import defaultdict
 from datetime import timedelta
 
 from django.core.management.base import BaseCommand
 from django.db import transaction
-from django.db.models import Case, DateTimeField, F, Q, When
-from django.db.models.functions import Cast
+from django.db.models import F, Q
 from django.utils import timezone
 from django_print_sql import print_sql_decorator
 from tqdm import tqdm
 
 from clist.models import Contest
 from notification.models import Notification, Task
-from utils.timetools import Epoch
+from ranking.models import Rating
+from true_coders.models import Filter
 from utils.traceback_with_vars import colored_format_exc
 
 logger = logging.getLogger(__name__)
@@ -24,32 +26,129 @@ class Command(BaseCommand):
     help = 'Add notice tasks'
 
     def process(self, notify, contests, prefix=''):
-        if contests.exists():
+        if contests:
             addition = {}
             addition['context'] = {'prefix': prefix}
             addition['contests'] = [contest.pk for contest in contests]
-
-            Task.objects.create(
-                notification=notify,
-                addition=addition,
-            )
+            self.tasks.append(Task(notification=notify, addition=addition))
 
     def add_arguments(self, parser):
         parser.add_argument('--coders', nargs='+')
         parser.add_argument('--dryrun', action='store_true', default=False)
         parser.add_argument('--methods', nargs='+')
         parser.add_argument('--reset', action='store_true', default=False)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def load_contests(self, now):
+        contests = Contest.visible.filter(end_time__gte=now).order_by('start_time', 'pk')
+        contests = list(contests.only('pk', 'resource_id', 'title', 'url', 'host', 'start_time', 'end_time',
+                                      'duration_in_secs', 'modified', 'notification_timing'))
+        party_ids = defaultdict(set)
+        for contest_id, party_id in Rating.objects.filter(contest__in=[c.pk for c in contests]).values_list(
+            'contest_id', 'party_id',
+        ):
+            party_ids[contest_id].add(party_id)
+        for contest in contests:
+            contest.party_ids = party_ids[contest.pk]
+            contest.duration_time = round((contest.end_time - contest.start_time).total_seconds())
+        return contests
+
+    def get_filter_contest_ids(self, filter_):
+        if filter_.pk not in self.filter_contest_ids:
+            if filter_.contest_id:
+                contest = self.contests_by_id.get(filter_.contest_id)
+                contests = [contest] if contest else []
+            elif filter_.resources:
+                contests = [c for r in set(filter_.resources) for c in self.contests_by_resource.get(r, [])]
+            else:
+                contests = self.contests
+            if filter_.regex:
+                # postgres regex syntax differs from python one, so it is matched by database as in web filters
+                query = filter_.get_contest_query()
+                contest_ids = set(Contest.objects.filter(query, pk__in=[c.pk for c in contests])
+                                  .values_list('pk', flat=True))
+            else:
+                predicate = filter_.get_contest_predicate()
+                contest_ids = None if predicate is None else {c.pk for c in contests if predicate(c)}
+            self.filter_contest_ids[filter_.pk] = contest_ids
+        return self.filter_contest_ids[filter_.pk]
+
+    def get_filters(self, coder_id, category):
+        if '@' in category:
+            category, username = category.split('@', 1)
+            return Filter.objects.filter(coder__username=username, categories__contains=[category], enabled=True)
+        return [f for f in self.coder_filters[coder_id] if category in f.categories]
+
+    def get_matched_contests(self, coder_id, category):
+        key = (coder_id, category)
+        if key not in self.matched_contests:
+            show = set()
+            hide = set()
+            has_show = False
+            for filter_ in self.get_filters(coder_id, category):
+                contest_ids = self.get_filter_contest_ids(filter_)
+                if contest_ids is None:
+                    continue
+                if filter_.to_show:
+                    has_show = True
+                    show |= contest_ids
+                else:
+                    hide |= contest_ids
+            matched = (show if has_show else set(self.contests_by_id)) - hide
+
+            one_day = timedelta(days=1)
+            coming = []
+            virtual = []
+            updates = []
+            for contest in self.contests:
+                if contest.pk not in matched:
+                    continue
+                if contest.start_time >= self.now:
+                    coming.append(contest)
+                    if contest.pk in self.updates_ids:
+                        updates.append(contest)
+                elif (
+                    contest.duration_in_secs is not None
+                    and contest.duration_time != contest.duration_in_secs
+                    and contest.duration_time > one_day.total_seconds()
+                ):
+                    virtual.append(contest)
+            virtual.sort(key=lambda c: (c.end_time, c.pk))
+            self.matched_contests[key] = {
+                'coming': coming,
+                'coming_times': [c.start_time for c in coming],
+                'virtual': virtual,
+                'virtual_times': [c.end_time for c in virtual],
+                'updates': updates,
+            }
+        return self.matched_contests[key]
+
+    def get_candidates(self, matched, before, min_time, with_virtual, exclude):
+        one_day = timedelta(days=1)
+        candidates = []
+        coming = matched['coming']
+        for contest in coming[bisect_left(matched['coming_times'], min_time):]:
+            if contest.pk not in exclude:
+                candidates.append((contest.start_time, contest))
+        if with_virtual:
+            virtual = matched['virtual']
+            for contest in virtual[bisect_left(matched['virtual_times'], min_time - before + one_day):]:
+                candidates.append((contest.end_time - one_day + before, contest))
+            candidates.sort(key=lambda t: t[0])
+        return candidates
 
     @print_sql_decorator()
     def handle(self, *args, **options):
         coders = options.get('coders')
         dryrun = options.get('dryrun')
         methods = options.get('methods')
+        batch_size = options.get('batch_size')
 
         updates = Contest.visible\
             .filter(start_time__gte=timezone.now()) \
             .filter(Q(notification_timing=None) | Q(modified__gt=F('notification_timing'))) \
             .order_by('start_time')
+        updates_ids = set(updates.values_list('pk', flat=True))
 
         now = timezone.now()
         if dryrun:
@@ -62,88 +161,82 @@ class Command(BaseCommand):
             notifies = notifies.filter(method__in=methods)
         if dryrun and options.get('reset'):
             notifies.update(last_time=now)
-        if not updates:
+        if not updates_ids:
             notifies = notifies.filter(last_time__isnull=False, last_time__lte=now)
         elif dryrun:
-            logger.info(f'updates = {updates}')
-
-        notifies = notifies.select_related('coder')
-
-        contests = Contest.visible.annotate(duration_time=Epoch(F('end_time') - F('start_time')))
-
-        for notify in tqdm(notifies.iterator()):
+            logger.info(f'updates = {updates_ids}')
+
+        self.now = now
+        self.updates_ids = updates_ids
+        self.contests = self.load_contests(now)
+        self.contests_by_id = {c.pk: c for c in self.contests}
+        self.contests_by_resource = defaultdict(list)
+        for contest in self.contests:
+            self.contests_by_resource[contest.resource_id].append(contest)
+        self.coder_filters = defaultdict(list)
+        for filter_ in Filter.objects.filter(enabled=True, coder__in=notifies.values('coder')):
+            self.coder_filters[filter_.coder_id].append(filter_)
+        self.filter_contest_ids = {}
+        self.matched_contests = {}
+        self.tasks = []
+        updated_notifies = []
+
+        for notify in tqdm(notifies.iterator(), desc='notifications'):
             try:
                 if ':' in notify.method:
                     category = notify.method.split(':', 1)[-1]
                 else:
                     category = notify.method
-                filt = notify.coder.get_contest_filter(category)
+                matched = self.get_matched_contests(notify.coder_id, category)
 
                 before = timedelta(minutes=notify.before)
 
-                qs = contests.filter(end_time__gte=now)
-
-                if updates and notify.last_time and notify.with_updates:
-                    qs_updates = updates.filter(filt, start_time__lt=min(now, notify.last_time) + before)
-                    self.process(notify, qs_updates, 'UPD')
-                    qs = qs.filter(~Q(pk__in=[c.pk for c in qs_updates]))
-
-                qs = qs.filter(filt)
-
-                if notify.with_virtual:
-                    one_day = timedelta(days=1)
-                    if_virtual = (~Q(duration_time=F('duration_in_secs'))
-                                  & Q(duration_time__gt=one_day.total_seconds(), start_time__lt=now))
-                    qs = qs.annotate(
-                        time=Case(
-                            When(start_time__gte=now, then=F('start_time')),
-                            When(if_virtual, then=Cast(F('end_time') - one_day + before, output_field=DateTimeField())),
-                            default=None,
-                        )
-                    )
-                else:
-                    qs = qs.filter(start_time__gte=now).annotate(time=F('start_time'))
-
-                qs = qs.filter(time__isnull=False).order_by('time')
+                exclude = set()
+                if updates_ids and notify.last_time and notify.with_updates:
+                    threshold = min(now, notify.last_time) + before
+                    contests_updates = [c for c in matched['updates'] if c.start_time < threshold]
+                    self.process(notify, contests_updates, 'UPD')
+                    exclude = {c.pk for c in contests_updates}
 
                 if notify.last_time:
-                    qs = qs.filter(time__gte=notify.last_time + before)
+                    min_time = notify.last_time + before
                 else:
-                    qs = qs.filter(time__gte=now + before)
+                    min_time = now + before
+                candidates = self.get_candidates(matched, before, min_time, notify.with_virtual, exclude)
 
-                first = qs.first()
-                if not first:
+                if not candidates:
                     if dryrun:
                         logger.info(f'last_time = {notify.last_time} to none')
                     else:
                         notify.last_time = now + timedelta(hours=1)
-                        notify.save()
+                        updated_notifies.append(notify)
                     continue
 
-                delta = first.time - (now + before)
+                first_time, _ = candidates[0]
+                delta = first_time - (now + before)
                 if delta > timedelta(minutes=3):
-                    new_time = first.time - before - timedelta(minutes=1)
+                    new_time = first_time - before - timedelta(minutes=1)
                     if dryrun:
                         logger.info(f'last_time = {notify.last_time} to {new_time}')
                     else:
                         notify.last_time = new_time
-                        notify.save()
+                        updated_notifies.append(notify)
                     continue
 
                 if notify.period == Notification.EVENT:
-                    last = first.time - now + timedelta(seconds=1)
+                    last = first_time - now + timedelta(seconds=1)
                 else:
                     last = before + notify.get_delta()
-                qs = qs.filter(time__lt=now + last)
+                contests = [contest for time, contest in candidates if time < now + last]
 
                 new_time = now + last - before
                 if dryrun:
-                    logger.info(f'qs = {qs}')
+                    logger.info(f'contests = {contests}')
                     logger.info(f'last_time = {notify.last_time} to {new_time}')
                 else:
-                    self.process(notify, qs)
+                    self.process(notify, contests)
                     notify.last_time = new_time
-                    notify.save()
+                    updated_notifies.append(notify)
             except Exception as e:
                 logger.debug(colored_format_exc())
                 logger.warning(f'notification = {notify}')
@@ -151,5 +244,8 @@ class Command(BaseCommand):
 
         if not dryrun:
             with transaction.atomic():
+                Task.objects.bulk_create(self.tasks, batch_size=batch_size)
+                Notification.objects.bulk_update(updated_notifies, ['last_time'], batch_size=batch_size)
                 now = timezone.now()
-                updates.update(notification_timing=now)
+                Contest.objects.filter(pk__in=updates_ids).update(notification_timing=now)
+            logger.info(f'Created {len(self.tasks)} tasks, updated {len(updated_notifies)} notifications')
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
 import os
 import re
+import threading
 from copy import deepcopy
 from datetime import timedelta
 from logging import getLogger
-from smtplib import SMTPDataError, SMTPResponseException
-from time import sleep
+from queue import Queue
+from smtplib import SMTPDataError, SMTPResponseException, SMTPServerDisconnected
+from time import monotonic, sleep
+from types import SimpleNamespace
 
 import tqdm
 import yaml
@@ -15,6 +19,7 @@ from django.conf import settings
 from django.core.mail.backends.smtp import EmailBackend
 from django.core.mail.message import EmailMultiAlternatives
 from django.core.management.base import BaseCommand
+from django.db import connection
 from django.db.models import Prefetch, Q
 from django.template.loader import render_to_string
 from django.utils.timezone import now
@@ -22,6 +27,7 @@ from django_print_sql import print_sql_decorator
 from filelock import FileLock
 from requests.exceptions import ConnectionError
 from telegram.error import BadRequest, ChatMigrated, Unauthorized
+from telegram.utils.request import Request
 from webpush import send_user_notification
 from webpush.utils import WebPushException
 
@@ -36,37 +42,164 @@ logger = getLogger('notification.sendout.tasks')
 lock = FileLock('sharedfiles/lock/sendout_tasks.lock')
 
 
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                current = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (current - self.updated) * self.rate)
+                self.updated = current
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class ChannelPool:
+
+    def __init__(self, name, handler, n_workers=1, rate=None, burst=None):
+        self.name = name
+        self.handler = handler
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.queue = Queue()
+        self.workers = [
+            threading.Thread(target=self.work, name=f'sendout-{name}-{index}', daemon=True)
+            for index in range(n_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def work(self):
+        try:
+            while True:
+                task = self.queue.get()
+                if task is None:
+                    break
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                self.handler(task)
+        finally:
+            connection.close()
+
+    def submit(self, task):
+        self.queue.put(task)
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+
+    def is_alive(self):
+        return any(worker.is_alive() for worker in self.workers)
+
+
 class Command(BaseCommand):
     help = 'Send out all unsent tasks'
     TELEGRAM_BOT = Bot()
     CONFIG_FILE = __file__ + '.yaml'
     N_STOP_EMAIL_FAILED_LIMIT = 5
+    STATUS_BATCH_SIZE = 100
+    CHANNELS = {
+        settings.NOTIFICATION_CONF.TELEGRAM: {'n_workers': 8, 'rate': 25},
+        settings.NOTIFICATION_CONF.EMAIL: {'n_workers': 1, 'rate': 0.4, 'burst': 1},
+        settings.NOTIFICATION_CONF.WEBBROWSER: {'n_workers': 8, 'rate': 50},
+    }
+    DEFAULT_CHANNEL = {'n_workers': 2}
+    RENDER_PLACEHOLDER = '\x00%s\x00'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.email_connection = None
         self.n_messages_sent = 0
         self.config = None
+        self.contests_cache = {}
+        self.rendered_messages = {}
+        self.rendered_messages_time_bucket = None
+        # contests and rendered messages are shared by workers of all channels
+        self.cache_lock = threading.Lock()
 
     def add_arguments(self, parser):
         parser.add_argument('--dryrun', action='store_true', default=False)
         parser.add_argument('--force', action='store_true', default=False)
         parser.add_argument('--coders', nargs='+')
 
+    def prefetch_contests(self, tasks):
+        contests_ids = set()
+        for task in tasks:
+            contests_ids.update(task.addition.get('contests', []))
+        contests_ids -= set(self.contests_cache)
+        if contests_ids:
+            contests = Contest.objects.filter(pk__in=contests_ids).select_related('resource')
+            self.contests_cache.update({contest.pk: contest for contest in contests})
+
+    def get_contests(self, contests_ids):
+        with self.cache_lock:
+            missing_ids = [pk for pk in contests_ids if pk not in self.contests_cache]
+            if missing_ids:
+                contests = Contest.objects.filter(pk__in=missing_ids).select_related('resource')
+                self.contests_cache.update({contest.pk: contest for contest in contests})
+            return [self.contests_cache[pk] for pk in contests_ids if pk in self.contests_cache]
+
+    def render_message(self, template_name, context, shared_key):
+        """Render template once for shared context, coder and notification fields are spliced in afterwards.
+
+        Templates show relative times of contests, so rendered messages are reused only within the current minute.
+        """
+        coder = context.get('coder')
+        notification = context.get('notification')
+        time_bucket = now().replace(second=0, microsecond=0)
+        key = (template_name, shared_key, getattr(coder, 'timezone', None), notification is not None)
+        with self.cache_lock:
+            if self.rendered_messages_time_bucket != time_bucket:
+                self.rendered_messages_time_bucket = time_bucket
+                self.rendered_messages = {}
+            rendered_messages = self.rendered_messages
+            rendered = rendered_messages.get(key)
+        if rendered is None:
+            render_context = dict(context)
+            if coder is not None:
+                render_context['coder'] = SimpleNamespace(
+                    username=self.RENDER_PLACEHOLDER % 'coder.username',
+                    timezone=coder.timezone,
+                )
+            if notification is not None:
+                render_context['notification'] = SimpleNamespace(
+                    pk=self.RENDER_PLACEHOLDER % 'notification.pk',
+                    secret=self.RENDER_PLACEHOLDER % 'notification.secret',
+                )
+            rendered = render_to_string(template_name, render_context).strip()
+            with self.cache_lock:
+                rendered_messages[key] = rendered
+        if coder is not None:
+            rendered = rendered.replace(self.RENDER_PLACEHOLDER % 'coder.username', coder.username)
+        if notification is not None:
+            rendered = rendered.replace(self.RENDER_PLACEHOLDER % 'notification.pk', str(notification.pk))
+            rendered = rendered.replace(self.RENDER_PLACEHOLDER % 'notification.secret', str(notification.secret))
+        return rendered
+
     def get_message(self, method, data, **kwargs):
         subject_ = kwargs.pop('subject', None)
         message_ = kwargs.pop('message', None)
 
         if 'contests' in data:
-            contests = Contest.objects.filter(pk__in=data['contests'])
+            contests = self.get_contests(data['contests'])
             context = deepcopy(data.get('context', {}))
             context.update({'contests': contests, 'domain': settings.MAIN_HOST_URL_})
             context.update(kwargs)
-            subject = render_to_string('subject', context).strip()
+            shared_key = (tuple(data['contests']), json.dumps(data.get('context', {}), sort_keys=True))
+            subject = self.render_message('subject', context, shared_key)
             subject = re.sub(r'\s+', ' ', subject)
             context['subject'] = subject
             method = method.split(':', 1)[0]
-            message = render_to_string('message/%s' % method, context).strip()
+            message = self.render_message('message/%s' % method, context, shared_key)
         else:
             subject = ''
             message = ''
@@ -126,9 +259,7 @@ class Command(BaseCommand):
             elif delete_notification('Strange notification'):
                 return 'removed'
         elif method == settings.NOTIFICATION_CONF.EMAIL:
-            if self.n_messages_sent % 20 == 0:
-                if self.n_messages_sent:
-                    sleep(10)
+            if self.email_connection is None:
                 self.email_connection = EmailBackend()
             mail = EmailMultiAlternatives(
                 subject=subject,
@@ -139,9 +270,14 @@ class Command(BaseCommand):
                 connection=self.email_connection,
                 alternatives=[(message, 'text/html')],
             )
-            mail.send()
+            try:
+                self.email_connection.open()
+                mail.send()
+            except SMTPServerDisconnected:
+                self.email_connection.close()
+                self.email_connection.open()
+                mail.send()
             self.n_messages_sent += 1
-            sleep(2)
         elif method == settings.NOTIFICATION_CONF.WEBBROWSER:
             payload = {
                 'head': subject,
@@ -169,7 +305,8 @@ class Command(BaseCommand):
         task = kwargs.get('task')
         if task is not None and response:
             task.response = response
-            task.save()
+            if not kwargs.get('batch_status'):
+                task.save()
 
     def load_config(self):
         if os.path.exists(self.CONFIG_FILE):
@@ -186,6 +323,79 @@ class Command(BaseCommand):
             with open(self.CONFIG_FILE, 'w') as fo:
                 yaml.dump(self.config, fo, indent=2)
 
+    def get_channel_pool(self, method):
+        channel = method.split(':', 1)[0]
+        if channel not in self.channel_pools:
+            channel_config = dict(self.CHANNELS.get(channel, self.DEFAULT_CHANNEL))
+            channel_config.update(self.config.get('channels', {}).get(channel, {}))
+            if channel == settings.NOTIFICATION_CONF.EMAIL:
+                # workers share one smtp connection
+                channel_config['n_workers'] = 1
+            if channel == settings.NOTIFICATION_CONF.TELEGRAM and channel_config['n_workers'] > 1:
+                request = Request(con_pool_size=channel_config['n_workers'])
+                self.TELEGRAM_BOT = Bot(request=request)
+            self.channel_pools[channel] = ChannelPool(channel, self.send_task, **channel_config)
+        return self.channel_pools[channel]
+
+    def send_task(self, task):
+        notification = task.notification
+        is_email = notification.method == settings.NOTIFICATION_CONF.EMAIL
+        if self.stop_email and is_email:
+            if self.clear_email_task:
+                contests = task.addition.get('contests', [])
+                if contests and not Contest.objects.filter(pk__in=contests, start_time__gt=now()).exists():
+                    task.delete()
+                    with self.results_lock:
+                        self.n_deleted += 1
+            return
+
+        try:
+            status = self.send_message(
+                notification.coder,
+                notification.method,
+                task.addition,
+                subject=task.subject,
+                message=task.message,
+                task=task,
+                notification=notification,
+                batch_status=True,
+            )
+            if status == 'removed':
+                return
+            task.is_sent = True
+        except Exception as e:
+            logger.debug(colored_format_exc())
+            logger.warning(f'task = {task}')
+            logger.error(f'Exception sendout task: {e}')
+            task.is_sent = False
+            if isinstance(e, (SMTPResponseException, SMTPDataError)):
+                self.stop_email = True
+
+                if self.n_messages_sent:
+                    self.config['stop_email']['n_failed'] = 1
+                else:
+                    self.config['stop_email']['n_failed'] += 1
+                if self.config['stop_email']['n_failed'] >= self.N_STOP_EMAIL_FAILED_LIMIT:
+                    self.clear_email_task = True
+
+                self.config['stop_email']['failed_time'] = now()
+
+        with self.results_lock:
+            self.processed_tasks.append(task)
+
+    def flush_task_statuses(self):
+        with self.results_lock:
+            tasks, self.processed_tasks = self.processed_tasks, []
+        if not tasks:
+            return
+        modified = now()
+        for task in tasks:
+            task.modified = modified
+        Task.objects.bulk_update(tasks, ['is_sent', 'response', 'modified'], batch_size=self.STATUS_BATCH_SIZE)
+        n_done = sum(task.is_sent for task in tasks)
+        self.n_done += n_done
+        self.n_failed += len(tasks) - n_done
+
     @print_sql_decorator()
     @lock
     def handle(self, *args, **options):
@@ -193,13 +403,13 @@ class Command(BaseCommand):
         dryrun = options.get('dryrun')
         coders = options.get('coders')
 
-        stop_email = settings.STOP_EMAIL_ and not dryrun
+        self.stop_email = settings.STOP_EMAIL_ and not dryrun
         if (
             self.config['stop_email']['n_failed'] >= self.N_STOP_EMAIL_FAILED_LIMIT
             and now() - self.config['stop_email']['failed_time'] < timedelta(hours=2)
         ):
-            stop_email = True
-        clear_email_task = False
+            self.stop_email = True
+        self.clear_email_task = False
 
         delete_info = Task.objects.filter(
             Q(is_sent=True, modified__lte=now() - timedelta(days=1)) |
@@ -223,67 +433,33 @@ class Command(BaseCommand):
         )
         qs = qs.order_by('modified')
 
-        done = 0
-        failed = 0
-        deleted = 0
-        for is_email_iteration in range(2):
-            for task in tqdm.tqdm(qs, 'sending'):
-                if task.notification is None:
-                    if task.id:
-                        task.delete()
-                    continue
-                is_email = task.notification.method == settings.NOTIFICATION_CONF.EMAIL
-                if is_email_iteration != is_email:
-                    continue
-
-                if stop_email and is_email:
-                    if clear_email_task:
-                        contests = task.addition.get('contests', [])
-                        if contests and not Contest.objects.filter(pk__in=contests, start_time__gt=now()).exists():
-                            task.delete()
-                            deleted += 1
-                    continue
-
-                try:
-                    notification = task.notification
-                    coder = notification.coder
-                    method = notification.method
-
-                    status = self.send_message(
-                        coder,
-                        method,
-                        task.addition,
-                        subject=task.subject,
-                        message=task.message,
-                        task=task,
-                        notification=notification,
-                    )
-                    if status == 'removed':
-                        continue
-
-                    task.is_sent = True
-                    task.save()
-                except Exception as e:
-                    logger.debug(colored_format_exc())
-                    logger.warning(f'task = {task}')
-                    logger.error(f'Exception sendout task: {e}')
-                    task.is_sent = False
-                    task.save()
-                    if isinstance(e, (SMTPResponseException, SMTPDataError)):
-                        stop_email = True
-
-                        if self.n_messages_sent:
-                            self.config['stop_email']['n_failed'] = 1
-                        else:
-                            self.config['stop_email']['n_failed'] += 1
-                        if self.config['stop_email']['n_failed'] >= self.N_STOP_EMAIL_FAILED_LIMIT:
-                            clear_email_task = True
-
-                        self.config['stop_email']['failed_time'] = now()
-
-                if task.is_sent:
-                    done += 1
-                else:
-                    failed += 1
-        logger.info(f'Done: {done}, failed: {failed}, deleted: {deleted}')
+        self.channel_pools = {}
+        self.results_lock = threading.Lock()
+        self.processed_tasks = []
+        self.n_done = 0
+        self.n_failed = 0
+        self.n_deleted = 0
+
+        tasks = list(qs)
+        self.prefetch_contests(tasks)
+        for task in tqdm.tqdm(tasks, 'queueing'):
+            if task.notification is None:
+                if task.id:
+                    task.delete()
+                continue
+            self.get_channel_pool(task.notification.method).submit(task)
+
+        for pool in self.channel_pools.values():
+            pool.close()
+        with tqdm.tqdm(desc='sending') as pbar:
+            while any(pool.is_alive() for pool in self.channel_pools.values()):
+                sleep(1)
+                n_processed = self.n_done + self.n_failed
+                self.flush_task_statuses()
+                pbar.update(self.n_done + self.n_failed - n_processed)
+        self.flush_task_statuses()
+        if self.email_connection is not None:
+            self.email_connection.close()
+
+        logger.info(f'Done: {self.n_done}, failed: {self.n_failed}, deleted: {self.n_deleted}')
         self.save_config()
@@ -1,17 +1,25 @@
+import gzip
 import json
+import re
+import threading
 import zlib
 from functools import partial
+from time import monotonic
 
+import brotli
 import zstandard as zstd
 from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
 from django.db.models import Q
 from django.http import HttpResponse, HttpResponseForbidden
 from django.middleware import csrf
 from django.shortcuts import redirect
-from django.utils import timezone
+from django.utils.cache import patch_vary_headers, set_response_etag
+from django.utils.text import compress_sequence, compress_string
 
 from clist.templatetags.extras import redirect_login
+from true_coders.activity import record_coder_activity
 from true_coders.models import Coder
 from utils.custom_request import CustomRequest
 
@@ -114,11 +122,8 @@ def UpdateCoderLastActivity(get_response):
 
     def middleware(request):
         response = get_response(request)
-        if request.user.is_authenticated:
-            coder = Coder.objects.filter(pk=request.user.coder.pk).first()
-            if coder:
-                coder.last_activity = timezone.now()
-                coder.save(update_fields=['last_activity'])
+        if request.user.is_authenticated and hasattr(request.user, 'coder'):
+            record_coder_activity(request.user.coder.pk)
         return response
 
     return middleware
@@ -169,22 +174,160 @@ def NonHtmlDebugToolbarMiddleware(get_response):
 
 
 class CompressionMiddleware:
+    min_size = 512
+    encodings = ('zstd', 'br', 'gzip', 'deflate')
+    compressible_types = (
+        'text/',
+        'application/json',
+        'application/javascript',
+        'application/xml',
+        'application/atom+xml',
+        'application/rss+xml',
+        'application/x-ndjson',
+        'image/svg+xml',
+    )
+    cached_paths_regex = re.compile(r'^/(get/events/|api/v[0-9]+/(json/)?contest/)')
+    cache_timeout = 600
+    cache_max_size = 4 * 2 ** 20
+    # BREACH mitigation of GZipMiddleware, only gzip can carry random bytes in its header
+    randomized_types = ('text/html',)
+    randomized_encodings = ('gzip',)
+    max_random_bytes = 100
+    stream_flush_size = 32 * 2 ** 10
+    stream_flush_interval = 1
 
     def __init__(self, get_response):
         self.get_response = get_response
+        self.local = threading.local()
+
+    def get_encoding(self, request, encodings):
+        accepted = {}
+        for value in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            encoding, *params = [v.strip() for v in value.split(';')]
+            quality = 1.0
+            for param in params:
+                if param.startswith('q='):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        quality = 0
+            accepted[encoding.lower()] = quality
+        for encoding in encodings:
+            if accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding
+
+    def is_compressible(self, response):
+        if 'Content-Encoding' in response or response.status_code == 206:
+            return False
+        if 'no-transform' in response.get('Cache-Control', ''):
+            return False
+        content_type = response.get('Content-Type', '').lower()
+        return content_type.startswith(self.compressible_types)
+
+    def is_randomized(self, response):
+        return response.get('Content-Type', '').lower().startswith(self.randomized_types)
+
+    def get_zstd_compressor(self):
+        compressor = getattr(self.local, 'zstd_compressor', None)
+        if compressor is None:
+            compressor = self.local.zstd_compressor = zstd.ZstdCompressor()
+        return compressor
+
+    def compress(self, encoding, content, randomized=False):
+        if randomized:
+            return compress_string(content, max_random_bytes=self.max_random_bytes)
+        if encoding == 'zstd':
+            return self.get_zstd_compressor().compress(content)
+        if encoding == 'br':
+            return brotli.compress(content, quality=5)
+        if encoding == 'gzip':
+            return gzip.compress(content, compresslevel=6, mtime=0)
+        return zlib.compress(content)
+
+    def compress_stream(self, encoding, iterator, randomized=False):
+        if randomized:
+            yield from compress_sequence(
+                (chunk.encode() if isinstance(chunk, str) else chunk for chunk in iterator),
+                max_random_bytes=self.max_random_bytes,
+            )
+            return
+
+        if encoding == 'zstd':
+            compressor = zstd.ZstdCompressor().compressobj()
+            compress = compressor.compress
+            flush = partial(compressor.flush, zstd.COMPRESSOBJ_FLUSH_BLOCK)
+            finish = compressor.flush
+        elif encoding == 'br':
+            compressor = brotli.Compressor(quality=5)
+            compress = compressor.process
+            flush = compressor.flush
+            finish = compressor.finish
+        else:
+            wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+            compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+            compress = compressor.compress
+            flush = partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+            finish = compressor.flush
+
+        # flushing ends a compression block, so it is done only after enough data or time
+        n_pending = 0
+        flushed_time = monotonic()
+        for chunk in iterator:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compress(chunk)
+            n_pending += len(chunk)
+            if n_pending >= self.stream_flush_size or monotonic() - flushed_time >= self.stream_flush_interval:
+                data += flush()
+                n_pending = 0
+                flushed_time = monotonic()
+            if data:
+                yield data
+        yield finish()
+
+    def get_cache_key(self, request, response, encoding):
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return
+        if not response.has_header('ETag'):
+            if not self.cached_paths_regex.match(request.path):
+                return
+            set_response_etag(response)
+        etag = response.get('ETag')
+        if etag:
+            return f'compressed_{encoding}_{etag}'
 
     def __call__(self, request):
         response = self.get_response(request)
 
-        if not response.streaming and 'Content-Encoding' not in response:
-            encodings = request.META.get('HTTP_ACCEPT_ENCODING', '')
-            if 'zstd' in encodings:
-                zstd_compressor = zstd.ZstdCompressor()
-                response.content = zstd_compressor.compress(response.content)
-                response['Content-Encoding'] = 'zstd'
-            elif 'deflate' in encodings:
-                response.content = zlib.compress(response.content)
-                response['Content-Encoding'] = 'deflate'
-            response['Content-Length'] = str(len(response.content))
-
+        if not self.is_compressible(response):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        randomized = self.is_randomized(response)
+        encoding = self.get_encoding(request, self.randomized_encodings if randomized else self.encodings)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                return response
+            response.streaming_content = self.compress_stream(encoding, response.streaming_content, randomized)
+            del response['Content-Length']
+        else:
+            if len(response.content) < self.min_size:
+                return response
+            cache_key = self.get_cache_key(request, response, encoding)
+            content = cache.get(cache_key) if cache_key else None
+            if content is None:
+                content = self.compress(encoding, response.content, randomized)
+                if cache_key and len(content) <= self.cache_max_size:
+                    cache.set(cache_key, content, self.cache_timeout)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
         return response
@@ -123,8 +123,6 @@ INSTALLED_APPS = (
 
 MIDDLEWARE = (
     'pyclist.middleware.CompressionMiddleware',
-    'django.middleware.gzip.GZipMiddleware',
-    'django_brotli.middleware.BrotliMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -692,6 +690,7 @@ ACE_CALENDARS_ = {
 }
 PAST_CALENDAR_ACTIONS_ = ['show', 'lighten', 'darken', 'lighten-day', 'darken-day', 'hide']
 PAST_CALENDAR_DEFAULT_ACTION_ = 'lighten'
+GET_EVENTS_CACHE_TIMEOUT_ = 60
 ORDERED_MEDALS_ = ['gold', 'silver', 'bronze']
 THEMES_ = ['default', 'cerulean', 'cosmo', 'cyborg', 'darkly', 'flatly', 'journal', 'lumen', 'paper', 'readable',
            'sandstone', 'simplex', 'slate', 'spacelab', 'superhero', 'united', 'yeti']
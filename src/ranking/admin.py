@@ -7,8 +7,8 @@ from clist.models import Contest
 from pyclist.admin import BaseModelAdmin, admin_register
 from ranking.management.commands.parse_statistic import Command as parse_stat
 from ranking.models import (Account, AccountMatching, AccountRenaming, AccountVerification, AutoRating, CountryAccount,
-                            Finalist, FinalistResourceInfo, Module, ParseStatistics, Rating, Stage, StageContest,
-                            Statistics, VerifiedAccount, VirtualStart)
+                            Finalist, FinalistResourceInfo, Module, ParseStatistics, Rating, RatingHistory, Stage,
+                            StageContest, Statistics, VerifiedAccount, VirtualStart)
 
 
 class HasCoders(admin.SimpleListFilter):
@@ -141,6 +141,14 @@ class StatisticsAdmin(BaseModelAdmin):
     _adv.short_description = 'Adv'
 
 
+@admin_register(RatingHistory)
+class RatingHistoryAdmin(BaseModelAdmin):
+    list_display = ['account', 'contest', 'date', 'new_rating', 'rating_change', 'place']
+    search_fields = ['=account__key']
+    list_filter = ['resource__host']
+    raw_id_fields = ['statistic', 'account', 'contest']
+
+
 @admin_register(Stage)
 class StageAdmin(BaseModelAdmin):
     list_display = ['contest', 'filter_params']
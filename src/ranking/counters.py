@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import connection
+
+ACCOUNT_COUNTERS_BATCH_SIZE = 1000
+
+_local = threading.local()
+
+
+class AccountCountersAccumulator:
+    """Collects account counters diffs and last activity times to apply them with one grouped UPDATE."""
+
+    def __init__(self):
+        self.deltas = defaultdict(lambda: defaultdict(int))
+        self.maximums = defaultdict(dict)
+
+    def __bool__(self):
+        return bool(self.deltas or self.maximums)
+
+    def add(self, account_id, field, value):
+        if value:
+            self.deltas[account_id][field] += value
+
+    def set_max(self, account_id, field, value):
+        if value is None:
+            return
+        current = self.maximums[account_id].get(field)
+        if current is None or current < value:
+            self.maximums[account_id][field] = value
+
+    def flush(self, batch_size=ACCOUNT_COUNTERS_BATCH_SIZE):
+        from ranking.models import Account
+
+        if not self:
+            return 0
+
+        delta_fields = sorted({field for deltas in self.deltas.values() for field in deltas})
+        max_fields = sorted({field for maximums in self.maximums.values() for field in maximums})
+        fields = delta_fields + max_fields
+        account_ids = sorted(set(self.deltas) | set(self.maximums))
+
+        set_values = []
+        for field in delta_fields:
+            column = Account._meta.get_field(field).column
+            set_values.append(f'{column} = CASE WHEN v.{column} IS NULL THEN a.{column} '
+                              f'ELSE COALESCE(a.{column}, 0) + v.{column} END')
+        for field in max_fields:
+            column = Account._meta.get_field(field).column
+            set_values.append(f'{column} = GREATEST(a.{column}, v.{column})')
+        columns = ['id'] + [Account._meta.get_field(field).column for field in fields]
+        placeholder = ', '.join(
+            f'%s::{Account._meta.get_field(field).db_type(connection)}' for field in ['id'] + fields
+        )
+
+        n_updated = 0
+        with connection.cursor() as cursor:
+            for offset in range(0, len(account_ids), batch_size):
+                batch = account_ids[offset:offset + batch_size]
+                params = []
+                for account_id in batch:
+                    deltas = self.deltas.get(account_id, {})
+                    maximums = self.maximums.get(account_id, {})
+                    params.append(account_id)
+                    params.extend(deltas.get(field) or None for field in delta_fields)
+                    params.extend(maximums.get(field) for field in max_fields)
+                values = ', '.join([f'({placeholder})'] * len(batch))
+                cursor.execute(f'''
+                    UPDATE {Account._meta.db_table} AS a SET {", ".join(set_values)}
+                    FROM (VALUES {values}) AS v ({", ".join(columns)})
+                    WHERE a.id = v.id
+                ''', params)
+                n_updated += cursor.rowcount
+        self.deltas.clear()
+        self.maximums.clear()
+        return n_updated
+
+
+def get_account_counters_accumulator():
+    return getattr(_local, 'accumulator', None)
+
+
+@contextmanager
+def deferred_account_counters():
+    """Defer account counters updates from statistics signals and apply them grouped on exit.
+
+    Nested usage shares the outer accumulator. Counters of accounts in memory are not changed,
+    so accounts should not be saved entirely inside the block.
+    """
+    accumulator = get_account_counters_accumulator()
+    if accumulator is not None:
+        yield accumulator
+        return
+
+    accumulator = AccountCountersAccumulator()
+    _local.accumulator = accumulator
+    try:
+        yield accumulator
+    except Exception:
+        # inside transaction saved statistics are rolled back together with counters
+        if not connection.in_atomic_block:
+            accumulator.flush()
+        raise
+    else:
+        accumulator.flush()
+    finally:
+        _local.accumulator = None
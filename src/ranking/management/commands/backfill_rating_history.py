@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django_print_sql import print_sql_decorator
+from tqdm import tqdm
+
+from clist.models import Resource
+from ranking.models import RatingHistory, Statistics
+from utils.attrdict import AttrDict
+from utils.logger import suppress_db_logging_context
+
+
+class Command(BaseCommand):
+    help = 'Backfill rating history from statistics'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = getLogger('ranking.backfill_rating_history')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-r', '--resources', metavar='HOST', nargs='*', help='resources hosts')
+        parser.add_argument('-c', '--contest-id', type=int, help='contest id')
+        parser.add_argument('--account-id', type=int, help='account id')
+        parser.add_argument('-bs', '--batch-size', type=int, help='batch size', default=1000)
+        parser.add_argument('--reset', action='store_true', help='remove rating history before backfill')
+
+    @print_sql_decorator(count_only=True)
+    def handle(self, *args, **options):
+        self.stdout.write(str(options))
+        args = AttrDict(options)
+
+        resources = Resource.objects.filter(has_rating_history=True)
+        if args.resources:
+            resource_filter = Q()
+            for r in args.resources:
+                resource_filter |= Q(host=r) | Q(short_host=r)
+            resources = resources.filter(resource_filter)
+
+        for resource in tqdm(resources, total=resources.count(), desc='resources'):
+            statistics = Statistics.objects.filter(resource=resource)
+            histories = RatingHistory.objects.filter(resource=resource)
+            if args.contest_id:
+                statistics = statistics.filter(contest_id=args.contest_id)
+                histories = histories.filter(contest_id=args.contest_id)
+            if args.account_id:
+                statistics = statistics.filter(account_id=args.account_id)
+                histories = histories.filter(account_id=args.account_id)
+
+            rating_filter = (
+                Q(addition__new_rating__isnull=False) |
+                Q(addition___rating_data__isnull=False)
+            )
+            statistics = statistics.filter(rating_filter)
+
+            with suppress_db_logging_context():
+                if args.reset:
+                    n_deleted, _ = histories.delete()
+                else:
+                    n_deleted, _ = histories.exclude(statistic__in=statistics).delete()
+
+                n_upserted = 0
+                batch = []
+                statistics = statistics.select_related('contest').only(
+                    'pk', 'account_id', 'contest_id', 'resource_id', 'place', 'solving', 'addition',
+                    'contest__end_time',
+                )
+                total = statistics.count()
+                for statistic in tqdm(statistics.iterator(chunk_size=args.batch_size), total=total,
+                                      desc=f'{resource.host} statistics'):
+                    if not RatingHistory.has_rating(statistic.addition):
+                        continue
+                    batch.append(statistic)
+                    if len(batch) >= args.batch_size:
+                        n_upserted += len(RatingHistory.upsert(batch))
+                        batch = []
+                if batch:
+                    n_upserted += len(RatingHistory.upsert(batch))
+
+            self.logger.info(f'{resource.host}: n_upserted = {n_upserted}, n_deleted = {n_deleted}')
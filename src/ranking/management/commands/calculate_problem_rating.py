@@ -9,17 +9,17 @@ from pprint import pprint  # noqa
 
 import tqdm
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.utils.timezone import now
-from sql_util.utils import SubqueryCount
 
 from clist.models import Contest, Resource
 from clist.templatetags.extras import as_number, get_item, get_problem_key, get_problem_short, is_solved
 from clist.utils import update_problems
 from logify.models import EventLog, EventStatus
+from ranking.models import Statistics
 from utils.attrdict import AttrDict
 from utils.json_field import JSONF
-from utils.rating import get_weighted_rating
+from utils.rating import WeightedRatingGrid, get_weighted_rating
 
 
 def get_statistics(contest):
@@ -86,42 +86,54 @@ def get_solved(result, problem, not_full_multiplier=1e-3):
     return ret
 
 
-def account_get_old_rating(account, before):
-    ret = (
-        account.statistics_set
-        .filter(contest__end_time__lt=before.end_time)
-        .filter(Q(addition__new_rating__isnull=False) | Q(addition__old_rating__isnull=False))
-        .filter(contest__stage__isnull=True)
-        .filter(contest__kind=before.kind)
-        .order_by('-contest__end_time')
-        .annotate(rating=JSONF('addition__new_rating'))
-        .values_list('rating', flat=True)
-        .first()
+def get_statistics_rows(contest):
+    rows = []
+    for stat in get_statistics(contest).iterator():
+        if is_skip(contest, stat):
+            continue
+        team_id, handles = get_team(stat)
+        rows.append(AttrDict(stat=stat, team_id=team_id, handles=handles))
+    return rows
+
+
+def previous_statistics_filter(before):
+    return Q(
+        contest__end_time__lt=before.end_time,
+        contest__stage__isnull=True,
+        contest__kind=before.kind,
     )
-    if ret is None:
-        ret = before.resource.avg_rating
-    return ret
 
 
-def account_get_n_contests(account, before):
-    ret = (
-        account.statistics_set
-        .filter(contest__end_time__lt=before.end_time)
-        .filter(contest__stage__isnull=True)
-        .filter(contest__kind=before.kind)
-        .count()
+def accounts_get_old_ratings(account_ids, before):
+    qs = (
+        Statistics.objects
+        .filter(account_id__in=account_ids)
+        .filter(previous_statistics_filter(before))
+        .filter(Q(addition__new_rating__isnull=False) | Q(addition__old_rating__isnull=False))
+        .order_by('account_id', '-contest__end_time')
+        .distinct('account_id')
+        .annotate(rating=JSONF('addition__new_rating'))
+        .values_list('account_id', 'rating')
     )
+    ratings = dict(qs)
+    ret = {}
+    for account_id in account_ids:
+        rating = ratings.get(account_id)
+        ret[account_id] = before.resource.avg_rating if rating is None else rating
     return ret
 
 
-def statistics_get_n_contests(statistics, before):
-    contest_filter = Q(
-        contest__end_time__lt=before.end_time,
-        contest__stage__isnull=True,
-        contest__kind=before.kind,
+def accounts_get_n_contests(account_ids, before):
+    qs = (
+        Statistics.objects
+        .filter(account_id__in=account_ids)
+        .filter(previous_statistics_filter(before))
+        .values('account_id')
+        .annotate(n_contests=Count('id'))
+        .values_list('account_id', 'n_contests')
     )
-    qs = statistics.annotate(n_contests=SubqueryCount('account__statistics', filter=contest_filter))
-    return {s['pk']: s['n_contests'] for s in qs.values('pk', 'n_contests')}
+    n_contests = dict(qs)
+    return {account_id: n_contests.get(account_id, 0) for account_id in account_ids}
 
 
 def adjust_rating(adjustment, account, rating, n_contests):
@@ -244,16 +256,14 @@ class Command(BaseCommand):
                     if problem_contest.info.get('skip_problem_rating'):
                         continue
                     if problem_contest not in problems_contests:
-                        statistics = get_statistics(problem_contest)
-                        problems_contests[problem_contest] = statistics
-                        self.logger.info(f'number of statistics = {statistics.count()}, contest = {problem_contest}')
+                        statistics_rows = get_statistics_rows(problem_contest)
+                        problems_contests[problem_contest] = statistics_rows
+                        self.logger.info(f'number of statistics = {len(statistics_rows)}, contest = {problem_contest}')
 
             rows_values = []
-            for current_contest, current_statistics in problems_contests.items():
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='rows_values'):
-                    if is_skip(current_contest, stat):
-                        continue
-
+            for current_contest, statistics_rows in problems_contests.items():
+                for statistics_row in tqdm.tqdm(statistics_rows, desc='rows_values'):
+                    stat = statistics_row.stat
                     problems = current_contest.info['problems']
                     if 'division' in problems:
                         problems = problems['division'][stat.addition.get('division')]
@@ -297,24 +307,29 @@ class Command(BaseCommand):
             stats = dict()
             team_ids = set()
             missing_account = False
-            for current_contest, current_statistics in problems_contests.items():
-
-                accounts_to_get_n_contests = set()
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(),
-                                      desc='accounts_to_get_n_contests'):
-                    if is_skip(current_contest, stat):
-                        continue
-                    team_id, _ = get_team(stat)
-                    if team_id is None:
+            for current_contest, statistics_rows in problems_contests.items():
+
+                members_handles = set()
+                for statistics_row in statistics_rows:
+                    if statistics_row.team_id is not None:
+                        members_handles.update(statistics_row.handles)
+                members_accounts = resource.account_set.filter(key__in=members_handles)
+                members_accounts = {account.key: account for account in members_accounts}
+
+                accounts_to_get_old_rating = {account.pk for account in members_accounts.values()}
+                accounts_to_get_n_contests = set(accounts_to_get_old_rating)
+                for statistics_row in statistics_rows:
+                    stat = statistics_row.stat
+                    if statistics_row.team_id is None:
                         accounts_to_get_n_contests.add(stat.account_id)
-                filtered_statistics = current_statistics.filter(account_id__in=accounts_to_get_n_contests)
-                n_contests_for_accounts = statistics_get_n_contests(filtered_statistics, current_contest)
-
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='old_ratings'):
-                    if is_skip(current_contest, stat):
-                        continue
-
-                    team_id, handles = get_team(stat)
+                        if stat.get_old_rating() is None:
+                            accounts_to_get_old_rating.add(stat.account_id)
+                old_ratings = accounts_get_old_ratings(accounts_to_get_old_rating, current_contest)
+                n_contests_for_accounts = accounts_get_n_contests(accounts_to_get_n_contests, current_contest)
+
+                for statistics_row in tqdm.tqdm(statistics_rows, desc='old_ratings'):
+                    stat = statistics_row.stat
+                    team_id, handles = statistics_row.team_id, statistics_row.handles
                     if team_id is not None:
                         if team_id in team_ids:
                             continue
@@ -322,7 +337,7 @@ class Command(BaseCommand):
                         ratings = []
                         n_contests_values = []
                         for handle in handles:
-                            account = resource.account_set.filter(key=handle).first()
+                            account = members_accounts.get(handle)
                             if account is None:
                                 self.logger.info(f'missing account = {handle}')
                                 if not missing_account and args.update_contest_on_missing_account:
@@ -335,8 +350,8 @@ class Command(BaseCommand):
                                 old_rating = resource.avg_rating
                                 n_contests = 0
                             else:
-                                old_rating = account_get_old_rating(account, current_contest)
-                                n_contests = account_get_n_contests(account, current_contest)
+                                old_rating = old_ratings[account.pk]
+                                n_contests = n_contests_for_accounts[account.pk]
                                 old_rating = adjust_rating(rating_adjustment, account, old_rating, n_contests)
                             ratings.append((1, old_rating))
                             n_contests_values.append(n_contests)
@@ -349,11 +364,8 @@ class Command(BaseCommand):
                     else:
                         old_rating = stat.get_old_rating()
                         if old_rating is None:
-                            old_rating = account_get_old_rating(stat.account, current_contest)
-                        if stat.pk in n_contests_for_accounts:
-                            n_contests = n_contests_for_accounts[stat.pk]
-                        else:
-                            n_contests = account_get_n_contests(stat.account, current_contest)
+                            old_rating = old_ratings[stat.account_id]
+                        n_contests = n_contests_for_accounts[stat.account_id]
                         old_rating = adjust_rating(rating_adjustment, stat.account, old_rating, n_contests)
 
                     weight = 1 - 0.9 ** (n_contests + 1)
@@ -382,22 +394,22 @@ class Command(BaseCommand):
                     rank += size
 
             problems_infos = dict()
-            caches = dict()
+            rating_grids = dict()
             skip_problems = set()
-            for current_contest, current_statistics in problems_contests.items():
-                for stat in tqdm.tqdm(current_statistics, total=current_statistics.count(), desc='performances'):
-                    if is_skip(current_contest, stat):
-                        continue
-
-                    team_id, _ = get_team(stat)
+            for current_contest, statistics_rows in problems_contests.items():
+                for statistics_row in tqdm.tqdm(statistics_rows, desc='performances'):
+                    stat = statistics_row.stat
+                    team_id = statistics_row.team_id
                     if team_id is not None:
                         if team_id not in team_ids:
                             continue
                         team_ids.remove(team_id)
 
-                    info = contests_divisions_data[get_info_key(stat)]
-                    cache = caches.setdefault(get_info_key(stat), {})
-                    performance = get_weighted_rating(info['wratings'], info['orders'][stat.place_as_int], cache=cache)
+                    info_key = get_info_key(stat)
+                    info = contests_divisions_data[info_key]
+                    if info_key not in rating_grids:
+                        rating_grids[info_key] = WeightedRatingGrid(info['wratings'])
+                    performance = rating_grids[info_key].get(info['orders'][stat.place_as_int])
                     rating = (performance + stats[stat.pk]['old_rating']) / 2
 
                     problems = current_contest.info['problems']
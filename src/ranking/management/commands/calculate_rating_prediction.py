@@ -12,6 +12,7 @@ from django.db.models import Case, F, FloatField, Q, When
 from django.utils import timezone
 from numba import njit
 from prettytable import PrettyTable
+from scipy.signal import fftconvolve
 from sql_util.utils import SubqueryCount
 
 from clist.models import Contest, Resource
@@ -94,13 +95,60 @@ def calculate_expected_ratings(ranks, ratings, rating_limit=10000):
     return expected_ratings
 
 
-def calculate_rating_prediction(rankings):
+HISTOGRAM_SOLVER_MIN_SIZE = 5000
+DEFAULT_MAX_ERROR = 1.0
+
+
+def calculate_expected_ratings_histogram(ranks, ratings, max_error=DEFAULT_MAX_ERROR, rating_limit=10000):
+    """Approximate calculate_expected_ratings in O(n + m log m) with m grid points.
+
+    Ratings are binned into a histogram on a grid with step max_error / 2, the sum of E(r - x)
+    over all participants is evaluated for every grid point by one FFT convolution, and the
+    expected ratings are found by binary search with linear interpolation over that grid.
+    """
+    ratings = np.asarray(ratings, dtype=np.float64)
+    ranks = np.asarray(ranks, dtype=np.float64)
+    step = max_error / 2
+
+    low = min(0.0, np.floor(ratings.min()))
+    high = max(float(rating_limit), np.ceil(ratings.max()))
+    n_grid = int(np.ceil((high - low) / step)) + 1
+    grid = low + np.arange(n_grid) * step
+
+    counts = np.bincount(np.rint((ratings - low) / step).astype(np.int64), minlength=n_grid).astype(np.float64)
+    deltas = np.arange(n_grid - 1, -n_grid, -1) * step
+    kernel = 1 / (1 + 10 ** (-deltas / 400))
+    expected_sum = fftconvolve(counts, kernel)[n_grid - 1:2 * n_grid - 1]
+    expected_sum = np.minimum.accumulate(expected_sum)
+
+    e_ranks = np.interp(ratings, grid, expected_sum) + 0.5
+    rank_means = np.sqrt(ranks * e_ranks)
+    targets = np.stack([rank_means, ranks + 0.5], axis=1) - 1
+
+    indices = np.searchsorted(-expected_sum, -targets, side='right')
+    indices = np.clip(indices, 1, n_grid - 1)
+    left_values = expected_sum[indices - 1]
+    right_values = expected_sum[indices]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(left_values > right_values, (left_values - targets) / (left_values - right_values), 0)
+    expected_ratings = grid[indices - 1] + np.clip(ratio, 0, 1) * step
+    return np.clip(expected_ratings, 0, rating_limit)
+
+
+def calculate_rating_prediction(rankings, solver=None, max_error=None):
     assert len(rankings) > 1
 
     rankings.sort(key=lambda r: r['old_rating'])
     ranks = np.array([r['rank'] for r in rankings])
     ratings = np.array([r['old_rating'] for r in rankings])
-    expected_ratings = calculate_expected_ratings(ranks, ratings)
+    if solver is None:
+        solver = 'histogram' if len(rankings) >= HISTOGRAM_SOLVER_MIN_SIZE else 'exact'
+    if solver == 'histogram':
+        expected_ratings = calculate_expected_ratings_histogram(ranks, ratings, max_error or DEFAULT_MAX_ERROR)
+    elif solver == 'exact':
+        expected_ratings = calculate_expected_ratings(ranks, ratings)
+    else:
+        raise ValueError(f'Unknown rating prediction solver = {solver}')
     for ranking, expected_rating in zip(rankings, expected_ratings):
         expected_rating = dict(zip(['rating', 'perf'], expected_rating))
         rating_change = f(ranking['n_contests']) * (expected_rating['rating'] - ranking['old_rating'])
@@ -185,6 +233,8 @@ class Command(BaseCommand):
         parser.add_argument('-s', '--search', metavar='TITLE', help='contest title regex')
         parser.add_argument('-l', '--limit', metavar='LIMIT', type=int, help='limit contests')
         parser.add_argument('-f', '--force', action='store_true', help='force update')
+        parser.add_argument('--solver', choices=['exact', 'histogram'], help='expected ratings solver')
+        parser.add_argument('--max-error', type=float, help='max rating error for histogram solver')
 
     def handle(self, *_, **options):
         global args
@@ -253,8 +303,10 @@ class Command(BaseCommand):
                     event_log.update_status(EventStatus.SKIPPED, message='unchanged rating prediction hash')
                     continue
 
+            solver = args.solver or resource.rating_prediction.get('solver')
+            max_error = args.max_error or resource.rating_prediction.get('max_error')
             with measure_time('calculate_rating_prediction', logger=self.logger):
-                calculate_rating_prediction(rankings)
+                calculate_rating_prediction(rankings, solver=solver, max_error=max_error)
 
             for ranking in rankings:
                 if 'rating_field' in resource.rating_prediction:
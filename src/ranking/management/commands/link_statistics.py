@@ -10,6 +10,7 @@ from django.db.models import Q
 from django.utils import timezone
 
 from clist.models import Contest, Resource
+from ranking.counters import deferred_account_counters
 from ranking.models import Account, Statistics
 from utils.attrdict import AttrDict
 from utils.strings import slug_string_iou, slugify, string_iou
@@ -59,6 +60,7 @@ class Command(BaseCommand):
             return name
 
         @transaction.atomic
+        @deferred_account_counters()
         def link_contest(contest):
             counters = defaultdict(int)
             resource = contest.resource
@@ -15,6 +15,7 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--dryrun', action='store_true', default=False)
+        parser.add_argument('--incremental', action='store_true', default=False, help='Write only changed rows')
         self.logger = logging.getLogger('ranking.parse.live_statistics')
 
     def handle(self, *args, **options):
@@ -46,6 +47,7 @@ class Command(BaseCommand):
                     without_set_coder_problems=parse_stat.without_set_coder_problems,
                     without_stage=parse_stat.without_stage,
                     without_subscriptions=parse_stat.without_subscriptions,
+                    incremental=args.incremental,
                 )
 
             parse_times = [p.parse_time for p in parse_statistics]
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import hashlib
+import json
 import logging
 import operator
 import os
@@ -26,6 +28,7 @@ from django.db import transaction
 from django.db.models import Exists, F, Max, OuterRef, Prefetch, Q
 from django.utils.timezone import now as timezone_now
 from django_print_sql import print_sql_decorator
+from rq.job import Dependency
 
 from clist.models import Contest, Problem, Resource
 from clist.templatetags.extras import (as_number, canonize, get_item, get_number_from_str, get_problem_key,
@@ -37,14 +40,17 @@ from logify.models import EventLog, EventStatus
 from notification.models import NotificationMessage, Subscription
 from notification.utils import compose_message_by_problems, compose_message_by_submissions, send_messages
 from pyclist.decorators import analyze_db_queries
+from ranking.counters import deferred_account_counters
 from ranking.management.commands.parse_accounts_infos import rename_account
 from ranking.management.modules.common import REQ, UNCHANGED
 from ranking.management.modules.excepts import (ExceptionParseStandings, FailOnGetResponse, InitModuleException,
                                                 ProxyLimitReached)
-from ranking.models import Account, AccountRenaming, Module, Stage, Statistics
-from ranking.utils import account_update_contest_additions, update_stage
+from ranking.models import Account, AccountRenaming, Module, RatingHistory, Stage, Statistics
+from ranking.rating_history import deferred_rating_history
+from ranking.utils import account_update_contest_additions, bulk_update_or_create_statistics, update_stage
 from ranking.views import update_standings_socket
-from submissions.models import Language, Submission, Testing, Verdict
+from submissions.models import Language, Submission, Verdict
+from submissions.utils import ingest_submissions, ingest_testings
 from true_coders.models import Coder
 from utils.attrdict import AttrDict
 from utils.countrier import Countrier
@@ -170,6 +176,17 @@ def canonize_name(name):
     return name
 
 
+def get_statistic_hash(defaults, addition, submissions, upsolving_submissions):
+    data = {
+        'defaults': {k: v for k, v in defaults.items() if k not in ('resource', 'addition')},
+        'addition': addition,
+        'submissions': submissions,
+        'upsolving_submissions': upsolving_submissions,
+    }
+    data = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.md5(data.encode()).hexdigest()
+
+
 class Command(BaseCommand):
     help = 'Parsing statistics'
 
@@ -220,6 +237,60 @@ class Command(BaseCommand):
         parser.add_argument('--allow-delete-statistics', action='store_true')
         parser.add_argument('--clear-submissions-info', action='store_true')
         parser.add_argument('--split-by-resource', action='store_true', help='Separately for each resource')
+        parser.add_argument('--split-by-contest', action='store_true', help='Separately for each contest')
+        parser.add_argument('--n-jobs-per-resource', type=int, default=2,
+                            help='Max parallel contest jobs per resource with --split-by-contest')
+        parser.add_argument('--batch-size', type=int, default=None, help='Batch size for bulk statistics writes')
+        parser.add_argument('--incremental', action='store_true', default=False, help='Write only changed rows')
+
+    def enqueue_contests_jobs(self, contests, n_jobs_per_resource):
+        """Enqueue job per contest, contests of the same resource are chained into at most n_jobs_per_resource
+        sequences (overridden by resource.info.statistics.n_jobs), so resources are parsed in parallel
+        without exceeding their api limits."""
+        queue = django_rq.get_queue('parse_statistics')
+        connection = django_rq.get_connection('parse_statistics')
+
+        resources_contests = defaultdict(list)
+        resources_groups = defaultdict(set)
+        for contest in contests:
+            # contests of one group are parsed together, so only the first one of the group is enqueued
+            group = contest.info.get('__parse_statistics_group')
+            if group and group in resources_groups[contest.resource]:
+                self.logger.info(f'Skip contest = {contest} because already enqueued group = {group}')
+                continue
+            resources_groups[contest.resource].add(group)
+            resources_contests[contest.resource].append(contest)
+
+        for resource, resource_contests in resources_contests.items():
+            resource_host = resource.host.split('/')[0]
+            n_jobs = get_item(resource, 'info.statistics.n_jobs') or n_jobs_per_resource or 1
+            slots_keys = [f'parse_statistics:{resource_host}:slot:{slot}' for slot in range(n_jobs)]
+            slots_jobs = []
+            for slot_key in slots_keys:
+                job_id = connection.get(slot_key)
+                job = queue.fetch_job(job_id.decode()) if job_id else None
+                if job and (job.is_finished or job.is_failed):
+                    job = None
+                slots_jobs.append(job)
+
+            n_added = 0
+            for contest in resource_contests:
+                job_id = f'parse_statistics_contest_{contest.pk}'
+                job = queue.fetch_job(job_id)
+                if job and not job.is_finished and not job.is_failed:
+                    self.logger.info(f'{contest} parse_statistics job already in queue: job = {job}')
+                    continue
+
+                free_slots = [slot for slot, slot_job in enumerate(slots_jobs) if slot_job is None]
+                slot = free_slots[0] if free_slots else n_added % n_jobs
+                previous_job = slots_jobs[slot]
+                depends_on = Dependency(jobs=[previous_job], allow_failure=True) if previous_job else None
+                job = queue.enqueue(call_command, 'parse_statistic', contest_id=contest.pk, job_id=job_id,
+                                    depends_on=depends_on)
+                slots_jobs[slot] = job
+                connection.set(slots_keys[slot], job.id, ex=timedelta(days=1))
+                n_added += 1
+                self.logger.info(f'Added {contest} parse_statistics job to queue: job = {job}, slot = {slot}')
 
     def parse_statistic(
         self,
@@ -257,6 +328,10 @@ class Command(BaseCommand):
         allow_delete_statistics=None,
         clear_submissions_info=None,
         split_by_resource=None,
+        split_by_contest=None,
+        n_jobs_per_resource=None,
+        batch_size=None,
+        incremental=None,
     ):
         channel_layer_handler = ChannelLayerHandler()
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%b-%d %H:%M:%S')
@@ -385,6 +460,10 @@ class Command(BaseCommand):
                     self.logger.info(f'{resource} parse_statistics job already in queue: job = {job}')
             return
 
+        if split_by_contest:
+            self.enqueue_contests_jobs(contests, n_jobs_per_resource)
+            return
+
         if len(resources) == 1 and len(contests) > 3:
             resource_event_log = EventLog.objects.create(name='parse_statistic',
                                                          related=contests[0].resource,
@@ -474,7 +553,7 @@ class Command(BaseCommand):
 
                 plugin = resource.plugin.Statistic(contest=contest)
 
-                with transaction.atomic():
+                with transaction.atomic(), deferred_account_counters(), deferred_rating_history():
                     _ = Contest.objects.select_for_update().get(pk=contest.pk)
 
                     statistics_users = copy.deepcopy(specific_users)
@@ -487,6 +566,7 @@ class Command(BaseCommand):
                         statistics_by_key = {}
                         more_statistics_by_key = {}
                         statistics_to_delete = set()
+                        statistics_hashes = {}
                         has_statistics = False
                         n_skip_on_update = 0
                         if not no_update_results:
@@ -495,6 +575,9 @@ class Command(BaseCommand):
                                 statistics = statistics.filter(account__key__in=statistics_users)
                             for s in statistics.iterator():
                                 addition = s.addition or {}
+                                row_hash = addition.pop('_row_hash', None)
+                                if incremental and row_hash:
+                                    statistics_hashes[s.account.key] = (s.pk, row_hash)
                                 if addition.get('_skip_on_update'):
                                     n_skip_on_update += 1
                                     contest_log_counter['skip_on_update'] += 1
@@ -608,6 +691,7 @@ class Command(BaseCommand):
                                         reset_place_ids.add(pk)
                             if reset_place_ids:
                                 Statistics.objects.filter(pk__in=reset_place_ids).update(place=None, place_as_int=None)
+                                RatingHistory.reset_place(reset_place_ids)
 
                         if get_item(resource, 'info.standings.keep_rating_fields'):
                             result = standings.setdefault('result', {})
@@ -991,13 +1075,16 @@ class Command(BaseCommand):
                             contest.has_hidden_results = has_hidden
                             contest.save(update_fields=['has_hidden_results'])
 
-                        if not lazy_fetch_accounts:
-                            members = [r['member'] for r in results]
+                        def fetch_accounts(members):
                             accounts = resource.account_set
                             if with_subscription:
                                 accounts = accounts.prefetch_related(prefetch_subscribed_coders)
                             accounts = accounts.filter(key__in=members)
-                            accounts = {a.key: a for a in accounts}
+                            return {a.key: a for a in accounts}
+
+                        accounts = {}
+                        if not lazy_fetch_accounts:
+                            accounts = fetch_accounts([r['member'] for r in results])
 
                         if contest.set_matched_coders_to_members:
                             matched_coders = contest.account_matchings
@@ -1009,14 +1096,393 @@ class Command(BaseCommand):
                                 for m in matched_coders
                             }
 
-                        for r in tqdm(results, desc='update results'):
+                        def update_after_update_or_create(pending, statistic, created):
+                            updates = {}
+                            updates['has_first_ac'] = False
+                            updated_problems = updates.setdefault('problems', [])
+                            problems = pending.r.get('problems', {})
+
+                            if not created:
+                                nonlocal calculate_time
+                                statistics_to_delete.discard(statistic.pk)
+
+                                if contest_timeline and pending.try_calculate_time:
+                                    p_problems = statistic.addition.get('problems', {})
+
+                                    ts = int((now - contest.start_time).total_seconds())
+                                    ts = min(ts, contest.duration_in_secs)
+                                    time = time_in_seconds_format(contest_timeline, ts, num=2)
+
+                                    for k, v in problems.items():
+                                        v_result = v.get('result', '')
+                                        if isinstance(v_result, str) and '?' in v_result:
+                                            calculate_time = True
+                                        if 'time' in v or 'result' not in v:
+                                            continue
+                                        p = p_problems.get(k, {})
+                                        has_change = v.get('result') != p.get('result')
+                                        if (not has_change or contest.end_time < now) and 'time' in p:
+                                            v['time'] = p['time']
+                                        else:
+                                            v['time'] = time
+
+                            if force_socket:
+                                updated_statistics_ids.append(statistic.pk)
+
+                            previous_problems = pending.stat.get('problems', {})
+                            for k, problem in problems.items():
+                                verdict = problem.get('verdict')
+                                previous_problem = previous_problems.get(k, {})
+                                previous_verdict = previous_problem.get('verdict')
+                                same_result = problem.get('result') == previous_problem.get('result')
+                                same_verdict = not verdict or not previous_verdict or verdict == previous_verdict
+                                same_verdict |= is_solved(problem)
+                                if same_result and same_verdict:
+                                    continue
+                                if not same_result and problem.get('first_ac'):
+                                    updates['has_first_ac'] = True
+                                updated_problems.append(k)
+                                if statistic.pk in updated_statistics_ids:
+                                    continue
+                                contest_log_counter['updated_statistics_problem'] += 1
+                                updated_statistics_ids.append(statistic.pk)
+
+                            for field, lhs, rhs in (
+                                ('place', str(statistic.place), str(pending.stat.get('place'))),
+                                ('score', statistic.solving, pending.stat.get('score')),
+                            ):
+                                if lhs != rhs and statistic.pk not in updated_statistics_ids:
+                                    contest_log_counter[f'updated_statistics_{field}'] += 1
+                                    updated_statistics_ids.append(statistic.pk)
+
+                            if pending.try_calculate_time:
+                                statistic.addition = pending.addition
+                                statistic.save()
+                            return updates
+
+                        @suppress_db_logging_context()
+                        def update_submissions(pending, statistic):
+                            result_submissions = pending.result_submissions
+                            if not result_submissions:
+                                return
+
+                            if not contest.has_submissions:
+                                contest.has_submissions = True
+                                contest.save(update_fields=['has_submissions'])
+
+                            statistic_problems = statistic.addition.get('problems', {})
+                            updated_submission_problems = False
+
+                            submission_rows = {}
+                            for result_submission in result_submissions:
+                                language = Language.cached_get(result_submission['language'])
+                                verdict = Verdict.cached_get(result_submission['verdict'])
+                                problem = Problem.cached_get(contest=contest,
+                                                             short=result_submission['problem_short'])
+                                problem_short = result_submission['problem_short']
+
+                                row = {
+                                    'account': pending.account.pk,
+                                    'contest': contest.pk,
+                                    'statistic': statistic.pk,
+                                    'secondary_key': str(result_submission['id']),
+                                    'problem_short': problem_short,
+                                    'problem': problem.pk if problem is not None else None,
+                                    'contest_time': result_submission['contest_time'],
+                                    'language': language.pk,
+                                    'verdict': verdict.pk,
+                                    'time': result_submission.get('time'),
+                                    'current_result': result_submission.get('current_result'),
+                                    'current_attempt': result_submission.get('current_attempt'),
+                                    'problem_key': problem.key if problem is not None else None,
+                                }
+
+                                for field in ('run_time', 'failed_test'):
+                                    if field in result_submission:
+                                        row[field] = result_submission[field]
+
+                                testings = {}
+                                for testing in result_submission.get('testing') or []:
+                                    verdict = Verdict.cached_get(testing['verdict'])
+                                    test_number = testing.get('test_number')
+                                    run_time = testing.get('run_time')
+
+                                    if (
+                                        not verdict.solved and
+                                        test_number is not None and
+                                        'failed_test' not in row and
+                                        (row.get('created_failed_test') is None
+                                         or test_number < row['created_failed_test'])
+                                    ):
+                                        row['created_failed_test'] = test_number
+
+                                    if (
+                                        verdict.solved and
+                                        run_time is not None and
+                                        'run_time' not in row and
+                                        (row.get('created_run_time') is None
+                                         or run_time > row['created_run_time'])
+                                    ):
+                                        row['created_run_time'] = run_time
+
+                                    testings[str(testing['id'])] = {
+                                        'secondary_key': str(testing['id']),
+                                        'verdict': verdict.pk,
+                                        'test_number': test_number,
+                                        'run_time': run_time,
+                                        'contest_time': testing.get('contest_time'),
+                                        'time': testing.get('time'),
+                                    }
+                                row['testings'] = list(testings.values())
+                                row['n_testings'] = len(result_submission.get('testing') or [])
+
+                                if result_submission.get('testing') and not contest.has_submissions_tests:
+                                    contest.has_submissions_tests = True
+                                    contest.save(update_fields=['has_submissions_tests'])
+
+                                submission_rows[(row['secondary_key'], problem_short)] = row
+                                contest_log_counter['submissions_total'] += 1
+
+                            submissions = ingest_submissions(list(submission_rows.values()))
+                            submission_ids = {submission['id'] for submission in submissions.values()}
+
+                            testing_rows = []
+                            for key, row in submission_rows.items():
+                                submission = submissions[key]
+                                if not submission['created']:
+                                    continue
+                                contest_log_counter['submissions_created'] += 1
+                                contest_log_counter['testing_total'] += row['n_testings']
+                                for testing in row['testings']:
+                                    testing_rows.append({'submission': submission['id'], **testing})
+                            contest_log_counter['testing_created'] += ingest_testings(testing_rows)
+
+                            for key, row in submission_rows.items():
+                                submission = submissions[key]
+                                problem_short = row['problem_short']
+                                statistic_problem = statistic_problems.get(problem_short, {})
+                                if (
+                                    statistic_problem and
+                                    row['current_result'] == statistic_problem.get('result')
+                                ):
+                                    fields_values = (
+                                        ('language', row['language']),
+                                        ('verdict', row['verdict']),
+                                        ('run_time', submission['run_time']),
+                                        ('failed_test', submission['failed_test']),
+                                    )
+                                    if contest.calculate_time and not is_solved(row['current_result']):
+                                        time = time_in_seconds_format(contest_timeline,
+                                                                      int(row['contest_time'].total_seconds()),
+                                                                      num=2)
+                                        fields_values += (('time', time),)
+
+                                    for field, value in fields_values:
+                                        if value is not None and statistic_problem.get(field) != value:
+                                            statistic_problem[field] = value
+                                            updated_submission_problems = True
+                            if update_problems_values(statistic.addition):
+                                updated_submission_problems = True
+                            if updated_submission_problems:
+                                statistic.save(update_fields=['addition'])
+                            if os.environ.get('DELETE_SUBMISSIONS'):
+                                extra = Submission.objects.filter(statistic=statistic)
+                                extra = extra.exclude(pk__in=submission_ids)
+                                delete_info = extra.delete()
+                                n_deleted, delete_info = delete_info
+                                if n_deleted:
+                                    self.logger.warning(f'Delete extra submissions: {delete_info}')
+                                    contest_log_counter['submissions_deleted'] += n_deleted
+
+                        def update_problems_values(addition):
+                            problems = addition.get('problems', {})
+                            updated_addition = False
+                            for problem_field, field, contest_field in settings.PROBLEM_STATISTIC_FIELDS:
+                                values = set()
+                                for problem in problems.values():
+                                    value = problem.get(problem_field)
+                                    if value:
+                                        problems_values[contest_field].add(value)
+                                        values.add(value)
+                                if field not in addition and values:
+                                    addition[field] = list(values)
+                                    updated_addition = True
+                            return updated_addition
+
+                        def link_account(statistic):
+                            account_keys = set()
+                            for member in statistic.addition.get('_members', []):
+                                if not member:
+                                    continue
+                                account_key = member.get('account')
+                                if not account_key:
+                                    continue
+                                account_keys.add(account_key)
+                            link_accounts = resource.account_set.filter(key__in=account_keys)
+                            link_accounts = link_accounts.prefetch_related('coders')
+                            for link_account in link_accounts:
+                                coders = link_account.coders.all()
+                                if len(coders) != 1:
+                                    continue
+                                coder = coders[0]
+                                if coder.account_set.filter(pk=statistic.account.pk).exists():
+                                    continue
+                                statistic.account.coders.add(coder)
+                                NotificationMessage.link_accounts(to=coder, accounts=[statistic.account])
+
+                        def set_matched_coders_to_members(statistic):
+                            with_countries = not statistic.addition.get('_countries')
+                            to_update = False
+                            for member in statistic.addition.get('_members', []):
+                                if 'name' not in member or len(member) > 1:
+                                    continue
+                                matched_coder_key = (member['name'], statistic.pk)
+                                if matched_coder_key in matched_coders:
+                                    member['coder'], country = matched_coders[matched_coder_key]
+                                    if country and with_countries:
+                                        statistic.addition.setdefault('_countries', []).append(country)
+                                    to_update = True
+                            if to_update:
+                                statistic.save(update_fields=['addition'])
+
+                        def process_subscriptions(pending, statistic, updates):
+                            if pending.skip_result or not with_subscription:
+                                return
+                            if pending.addition.get('_skip_subscription') or not updates['problems']:
+                                return
+                            account = pending.account
+
+                            with_top_n = (subscription_top_n and statistic.place_as_int and
+                                          statistic.place_as_int <= subscription_top_n)
+                            with_first_ac = updates['has_first_ac'] and subscription_first_ac
+                            subscribed_coders = getattr(account, 'subscribed_coders', None)
+                            if (
+                                not account.n_subscribers and
+                                not subscribed_coders and
+                                not with_top_n and
+                                not with_first_ac
+                            ):
+                                return
+
+                            kwargs = {
+                                'problem_shorts': updates['problems'],
+                                'statistic': statistic,
+                                'previous_addition': pending.stat,
+                                'contest_or_problems': standings_problems,
+                            }
+                            subscription_message = compose_message_by_problems(**kwargs)
+
+                            subscriptions_filter = Q()
+                            if account.n_subscribers:
+                                subscriptions_filter |= Q(accounts=account)
+                            if subscribed_coders:
+                                subscriptions_filter |= Q(coders__in=subscribed_coders)
+                            if with_top_n:
+                                subscriptions_filter |= Q(top_n__gte=statistic.place_as_int)
+                            if with_first_ac:
+                                subscriptions_filter |= Q(with_first_accepted=True)
+                            subscriptions_filter = (
+                                subscriptions_filter
+                                & (Q(resource__isnull=True) | Q(resource=resource))
+                                & (Q(contest__isnull=True) | Q(contest=contest))
+                            )
+                            subscriptions = Subscription.for_statistics.filter(subscriptions_filter)
+                            already_sent = set()
+                            for subscription in subscriptions:
+                                if subscription.notification_key in already_sent:
+                                    continue
+                                already_sent.add(subscription.notification_key)
+
+                                message = compose_message_by_problems(
+                                    subscription=subscription,
+                                    general_message=subscription_message,
+                                    **kwargs,
+                                )
+                                subscription.send(message=message, contest=contest)
+                                contest_log_counter['statistics_subscription'] += 1
+
+                        def process_upsolving_subscriptions(pending):
+                            account, submissions = pending.account, pending.result_upsolving_submissions
+                            if not submissions or not with_upsolving_subscription:
+                                return
+                            subscribed_coders = getattr(account, 'subscribed_coders', None)
+                            if not account.n_subscribers and not subscribed_coders:
+                                return
+
+                            subscriptions_filter = Q()
+                            if account.n_subscribers:
+                                subscriptions_filter |= Q(accounts=account)
+                            if subscribed_coders:
+                                subscriptions_filter |= Q(coders__in=subscribed_coders)
+                            subscriptions_filter = (
+                                subscriptions_filter
+                                & (Q(resource__isnull=True) | Q(resource=resource))
+                                & (Q(contest__isnull=True) | Q(contest=contest))
+                            )
+                            upsolving_subscriptions = Subscription.for_upsolving.filter(subscriptions_filter)
+
+                            processed = set()
+                            for subscription in upsolving_subscriptions:
+                                message = compose_message_by_submissions(
+                                    resource, account, submissions,
+                                    cache=processed,
+                                    subscription=subscription,
+                                )
+                                if not message:
+                                    continue
+                                subscription.send(message=message)
+                                contest_log_counter['statistics_subscription'] += 1
+
+                        def save_statistics(rows):
+                            if batch_size:
+                                return bulk_update_or_create_statistics(contest, rows)
+                            statistics_objects = Statistics.saved_objects
+                            statistics_objects = statistics_objects.select_related('account', 'contest', 'resource')
+                            return [
+                                statistics_objects.update_or_create(account=account, contest=contest,
+                                                                    defaults=defaults)
+                                for account, defaults in rows
+                            ]
+
+                        def flush_pending_statistics():
+                            nonlocal n_statistics_total, n_statistics_created
+
+                            rows = list(pending_statistics)
+                            pending_statistics.clear()
+                            saved = save_statistics([(pending.account, pending.defaults) for pending in rows])
+
+                            for pending, (statistic, statistic_created) in zip(rows, saved):
+                                n_statistics_total += 1
+                                n_statistics_created += statistic_created
+                                contest_log_counter['statistics_total'] += 1
+                                if statistic_created:
+                                    contest_log_counter['statistics_created'] += 1
+
+                                updates = update_after_update_or_create(pending, statistic, statistic_created)
+
+                                update_submissions(pending, statistic)
+
+                                if with_link_accounts:
+                                    link_account(statistic)
+
+                                if contest.set_matched_coders_to_members:
+                                    set_matched_coders_to_members(statistic)
+
+                                process_subscriptions(pending, statistic, updates)
+                                process_upsolving_subscriptions(pending)
+
+                        pending_statistics = []
+                        for index, r in enumerate(tqdm(results, desc='update results')):
+                            if lazy_fetch_accounts and batch_size and index % batch_size == 0:
+                                accounts = fetch_accounts([row['member'] for row in results[index:index + batch_size]])
+
                             skip_update = bool(r.get('_skip_update'))
                             if skip_update:
                                 continue
                             member = r.pop('member')
                             skip_result = bool(r.get('_no_update_n_contests'))
 
-                            if lazy_fetch_accounts:
+                            if lazy_fetch_accounts and member not in accounts:
                                 account = Account.objects
                                 if with_subscription:
                                     account = account.prefetch_related(prefetch_subscribed_coders)
@@ -1386,342 +1852,6 @@ class Command(BaseCommand):
 
                                 return defaults, addition, try_calculate_time
 
-                            def update_after_update_or_create(statistic, created, addition, try_calculate_time):
-                                updates = {}
-                                updates['has_first_ac'] = False
-                                updated_problems = updates.setdefault('problems', [])
-                                problems = r.get('problems', {})
-
-                                if not created:
-                                    nonlocal calculate_time
-                                    statistics_to_delete.discard(statistic.pk)
-
-                                    if contest_timeline and try_calculate_time:
-                                        p_problems = statistic.addition.get('problems', {})
-
-                                        ts = int((now - contest.start_time).total_seconds())
-                                        ts = min(ts, contest.duration_in_secs)
-                                        time = time_in_seconds_format(contest_timeline, ts, num=2)
-
-                                        for k, v in problems.items():
-                                            v_result = v.get('result', '')
-                                            if isinstance(v_result, str) and '?' in v_result:
-                                                calculate_time = True
-                                            if 'time' in v or 'result' not in v:
-                                                continue
-                                            p = p_problems.get(k, {})
-                                            has_change = v.get('result') != p.get('result')
-                                            if (not has_change or contest.end_time < now) and 'time' in p:
-                                                v['time'] = p['time']
-                                            else:
-                                                v['time'] = time
-
-                                if force_socket:
-                                    updated_statistics_ids.append(statistic.pk)
-
-                                previous_problems = stat.get('problems', {})
-                                for k, problem in problems.items():
-                                    verdict = problem.get('verdict')
-                                    previous_problem = previous_problems.get(k, {})
-                                    previous_verdict = previous_problem.get('verdict')
-                                    same_result = problem.get('result') == previous_problem.get('result')
-                                    same_verdict = not verdict or not previous_verdict or verdict == previous_verdict
-                                    same_verdict |= is_solved(problem)
-                                    if same_result and same_verdict:
-                                        continue
-                                    if not same_result and problem.get('first_ac'):
-                                        updates['has_first_ac'] = True
-                                    updated_problems.append(k)
-                                    if statistic.pk in updated_statistics_ids:
-                                        continue
-                                    contest_log_counter['updated_statistics_problem'] += 1
-                                    updated_statistics_ids.append(statistic.pk)
-
-                                for field, lhs, rhs in (
-                                    ('place', str(statistic.place), str(stat.get('place'))),
-                                    ('score', statistic.solving, stat.get('score')),
-                                ):
-                                    if lhs != rhs and statistic.pk not in updated_statistics_ids:
-                                        contest_log_counter[f'updated_statistics_{field}'] += 1
-                                        updated_statistics_ids.append(statistic.pk)
-
-                                if try_calculate_time:
-                                    statistic.addition = addition
-                                    statistic.save()
-                                return updates
-
-                            @suppress_db_logging_context()
-                            def update_submissions(statistic, result_submissions):
-                                if not result_submissions:
-                                    return
-
-                                if not contest.has_submissions:
-                                    contest.has_submissions = True
-                                    contest.save(update_fields=['has_submissions'])
-
-                                statistic_problems = statistic.addition.get('problems', {})
-                                updated_submission_problems = False
-                                submission_ids = set()
-                                for result_submission in result_submissions:
-                                    language = Language.cached_get(result_submission['language'])
-                                    verdict = Verdict.cached_get(result_submission['verdict'])
-                                    problem = Problem.cached_get(contest=contest,
-                                                                 short=result_submission['problem_short'])
-                                    problem_short = result_submission['problem_short']
-
-                                    defaults = {
-                                        'problem': problem,
-                                        'contest_time': result_submission['contest_time'],
-                                        'language': language,
-                                        'verdict': verdict,
-                                        'time': result_submission.get('time'),
-                                        'current_result': result_submission.get('current_result'),
-                                        'current_attempt': result_submission.get('current_attempt'),
-                                        'problem_key': problem.key if problem is not None else None,
-                                    }
-
-                                    for field in ('run_time', 'failed_test'):
-                                        if field in result_submission:
-                                            defaults[field] = result_submission[field]
-
-                                    run_time = result_submission.get('run_time')
-                                    if run_time is not None:
-                                        defaults['run_time'] = run_time
-
-                                    submission, submission_created = Submission.objects.update_or_create(
-                                        account=account,
-                                        contest=contest,
-                                        statistic=statistic,
-                                        secondary_key=result_submission['id'],
-                                        problem_short=problem_short,
-                                        defaults=defaults,
-                                    )
-                                    submission_ids.add(submission.pk)
-
-                                    contest_log_counter['submissions_total'] += 1
-                                    if submission_created:
-                                        contest_log_counter['submissions_created'] += 1
-
-                                    if result_submission.get('testing') and not contest.has_submissions_tests:
-                                        contest.has_submissions_tests = True
-                                        contest.save(update_fields=['has_submissions_tests'])
-
-                                    if 'testing' in result_submission and submission_created:
-                                        update_fields = {}
-                                        for testing in result_submission['testing']:
-                                            verdict = Verdict.cached_get(testing['verdict'])
-                                            test_number = testing.get('test_number')
-                                            run_time = testing.get('run_time')
-
-                                            if (
-                                                not verdict.solved and
-                                                test_number is not None and
-                                                'failed_test' not in defaults and
-                                                ('failed_test' not in update_fields
-                                                 or test_number < update_fields['failed_test'])
-                                            ):
-                                                update_fields['failed_test'] = test_number
-
-                                            if (
-                                                verdict.solved and
-                                                run_time is not None and
-                                                'run_time' not in defaults and
-                                                ('run_time' not in update_fields
-                                                 or run_time > update_fields['run_time'])
-                                            ):
-                                                update_fields['run_time'] = run_time
-
-                                            _, testing_created = Testing.objects.update_or_create(
-                                                submission=submission,
-                                                secondary_key=testing['id'],
-                                                defaults={
-                                                    'verdict': verdict,
-                                                    'test_number': test_number,
-                                                    'run_time': run_time,
-                                                    'contest_time': testing.get('contest_time'),
-                                                    'time': testing.get('time'),
-                                                }
-                                            )
-                                            contest_log_counter['testing_total'] += 1
-                                            if testing_created:
-                                                contest_log_counter['testing_created'] += 1
-
-                                        if update_fields:
-                                            for field, value in update_fields.items():
-                                                setattr(submission, field, value)
-                                            submission.save(update_fields=list(update_fields))
-
-                                    statistic_problem = statistic_problems.get(problem_short, {})
-                                    if (
-                                        statistic_problem and
-                                        submission.current_result == statistic_problem.get('result')
-                                    ):
-                                        fields_values = (
-                                            ('language', submission.language_id),
-                                            ('verdict', submission.verdict_id),
-                                            ('run_time', submission.run_time),
-                                            ('failed_test', submission.failed_test),
-                                        )
-                                        if contest.calculate_time and not is_solved(submission.current_result):
-                                            time = time_in_seconds_format(contest_timeline,
-                                                                          int(submission.contest_time.total_seconds()),
-                                                                          num=2)
-                                            fields_values += (('time', time),)
-
-                                        for field, value in fields_values:
-                                            if value is not None and statistic_problem.get(field) != value:
-                                                statistic_problem[field] = value
-                                                updated_submission_problems = True
-                                if update_problems_values(statistic.addition):
-                                    updated_submission_problems = True
-                                if updated_submission_problems:
-                                    statistic.save(update_fields=['addition'])
-                                if os.environ.get('DELETE_SUBMISSIONS'):
-                                    extra = Submission.objects.filter(statistic=statistic)
-                                    extra = extra.exclude(pk__in=submission_ids)
-                                    delete_info = extra.delete()
-                                    n_deleted, delete_info = delete_info
-                                    if n_deleted:
-                                        self.logger.warning(f'Delete extra submissions: {delete_info}')
-                                        contest_log_counter['submissions_deleted'] += n_deleted
-
-                            def update_problems_values(addition):
-                                problems = addition.get('problems', {})
-                                updated_addition = False
-                                for problem_field, field, contest_field in settings.PROBLEM_STATISTIC_FIELDS:
-                                    values = set()
-                                    for problem in problems.values():
-                                        value = problem.get(problem_field)
-                                        if value:
-                                            problems_values[contest_field].add(value)
-                                            values.add(value)
-                                    if field not in addition and values:
-                                        addition[field] = list(values)
-                                        updated_addition = True
-                                return updated_addition
-
-                            def link_account(statistic):
-                                account_keys = set()
-                                for member in statistic.addition.get('_members', []):
-                                    if not member:
-                                        continue
-                                    account_key = member.get('account')
-                                    if not account_key:
-                                        continue
-                                    account_keys.add(account_key)
-                                link_accounts = resource.account_set.filter(key__in=account_keys)
-                                link_accounts = link_accounts.prefetch_related('coders')
-                                for link_account in link_accounts:
-                                    coders = link_account.coders.all()
-                                    if len(coders) != 1:
-                                        continue
-                                    coder = coders[0]
-                                    if coder.account_set.filter(pk=statistic.account.pk).exists():
-                                        continue
-                                    statistic.account.coders.add(coder)
-                                    NotificationMessage.link_accounts(to=coder, accounts=[statistic.account])
-
-                            def set_matched_coders_to_members(statistic):
-                                with_countries = not statistic.addition.get('_countries')
-                                to_update = False
-                                for member in statistic.addition.get('_members', []):
-                                    if 'name' not in member or len(member) > 1:
-                                        continue
-                                    matched_coder_key = (member['name'], statistic.pk)
-                                    if matched_coder_key in matched_coders:
-                                        member['coder'], country = matched_coders[matched_coder_key]
-                                        if country and with_countries:
-                                            statistic.addition.setdefault('_countries', []).append(country)
-                                        to_update = True
-                                if to_update:
-                                    statistic.save(update_fields=['addition'])
-
-                            def process_subscriptions(statistic, updates):
-                                if skip_result or not with_subscription:
-                                    return
-                                if addition.get('_skip_subscription') or not updates['problems']:
-                                    return
-
-                                with_top_n = (subscription_top_n and statistic.place_as_int and
-                                              statistic.place_as_int <= subscription_top_n)
-                                with_first_ac = updates['has_first_ac'] and subscription_first_ac
-                                subscribed_coders = getattr(account, 'subscribed_coders', None)
-                                if (
-                                    not account.n_subscribers and
-                                    not subscribed_coders and
-                                    not with_top_n and
-                                    not with_first_ac
-                                ):
-                                    return
-
-                                kwargs = {
-                                    'problem_shorts': updates['problems'],
-                                    'statistic': statistic,
-                                    'previous_addition': stat,
-                                    'contest_or_problems': standings_problems,
-                                }
-                                subscription_message = compose_message_by_problems(**kwargs)
-
-                                subscriptions_filter = Q()
-                                if account.n_subscribers:
-                                    subscriptions_filter |= Q(accounts=account)
-                                if subscribed_coders:
-                                    subscriptions_filter |= Q(coders__in=subscribed_coders)
-                                if with_top_n:
-                                    subscriptions_filter |= Q(top_n__gte=statistic.place_as_int)
-                                if with_first_ac:
-                                    subscriptions_filter |= Q(with_first_accepted=True)
-                                subscriptions_filter = (
-                                    subscriptions_filter
-                                    & (Q(resource__isnull=True) | Q(resource=resource))
-                                    & (Q(contest__isnull=True) | Q(contest=contest))
-                                )
-                                subscriptions = Subscription.for_statistics.filter(subscriptions_filter)
-                                already_sent = set()
-                                for subscription in subscriptions:
-                                    if subscription.notification_key in already_sent:
-                                        continue
-                                    already_sent.add(subscription.notification_key)
-
-                                    message = compose_message_by_problems(
-                                        subscription=subscription,
-                                        general_message=subscription_message,
-                                        **kwargs,
-                                    )
-                                    subscription.send(message=message, contest=contest)
-                                    contest_log_counter['statistics_subscription'] += 1
-
-                            def process_upsolving_subscriptions(submissions):
-                                if not submissions or not with_upsolving_subscription:
-                                    return
-                                subscribed_coders = getattr(account, 'subscribed_coders', None)
-                                if not account.n_subscribers and not subscribed_coders:
-                                    return
-
-                                subscriptions_filter = Q()
-                                if account.n_subscribers:
-                                    subscriptions_filter |= Q(accounts=account)
-                                if subscribed_coders:
-                                    subscriptions_filter |= Q(coders__in=subscribed_coders)
-                                subscriptions_filter = (
-                                    subscriptions_filter
-                                    & (Q(resource__isnull=True) | Q(resource=resource))
-                                    & (Q(contest__isnull=True) | Q(contest=contest))
-                                )
-                                upsolving_subscriptions = Subscription.for_upsolving.filter(subscriptions_filter)
-
-                                processed = set()
-                                for subscription in upsolving_subscriptions:
-                                    message = compose_message_by_submissions(
-                                        resource, account, submissions,
-                                        cache=processed,
-                                        subscription=subscription,
-                                    )
-                                    if not message:
-                                        continue
-                                    subscription.send(message=message)
-                                    contest_log_counter['statistics_subscription'] += 1
-
                             update_addition_fields()
                             update_account_time()
                             update_account_info()
@@ -1732,33 +1862,35 @@ class Command(BaseCommand):
                             update_statistic_stats()
                             defaults, addition, try_calculate_time = get_addition()
 
-                            statistics_objects = Statistics.saved_objects
-                            statistics_objects = statistics_objects.select_related('account', 'contest', 'resource')
-                            statistic, statistic_created = statistics_objects.update_or_create(
+                            if incremental:
+                                row_hash = get_statistic_hash(defaults, addition, result_submissions,
+                                                              result_upsolving_submissions)
+                                addition['_row_hash'] = row_hash
+                                previous_pk, previous_hash = statistics_hashes.get(member, (None, None))
+                                if previous_hash == row_hash and not force_socket:
+                                    statistics_to_delete.discard(previous_pk)
+                                    n_statistics_total += 1
+                                    contest_log_counter['statistics_total'] += 1
+                                    contest_log_counter['statistics_unchanged'] += 1
+                                    continue
+
+                            pending_statistics.append(AttrDict(
+                                r=r,
+                                member=member,
                                 account=account,
-                                contest=contest,
+                                stat=stat,
+                                skip_result=skip_result,
                                 defaults=defaults,
-                            )
-
-                            n_statistics_total += 1
-                            n_statistics_created += statistic_created
-                            contest_log_counter['statistics_total'] += 1
-                            if statistic_created:
-                                contest_log_counter['statistics_created'] += 1
-
-                            updates = update_after_update_or_create(statistic, statistic_created, addition,
-                                                                    try_calculate_time)
-
-                            update_submissions(statistic, result_submissions)
-
-                            if with_link_accounts:
-                                link_account(statistic)
-
-                            if contest.set_matched_coders_to_members:
-                                set_matched_coders_to_members(statistic)
+                                addition=addition,
+                                try_calculate_time=try_calculate_time,
+                                result_submissions=result_submissions,
+                                result_upsolving_submissions=result_upsolving_submissions,
+                            ))
+                            if len(pending_statistics) >= (batch_size or 1):
+                                flush_pending_statistics()
 
-                            process_subscriptions(statistic, updates)
-                            process_upsolving_subscriptions(result_upsolving_submissions)
+                        if pending_statistics:
+                            flush_pending_statistics()
 
                         if not specific_users:
                             for field, values in problems_values.items():
@@ -2209,4 +2341,8 @@ class Command(BaseCommand):
             allow_delete_statistics=args.allow_delete_statistics,
             clear_submissions_info=args.clear_submissions_info,
             split_by_resource=args.split_by_resource,
+            split_by_contest=args.split_by_contest,
+            n_jobs_per_resource=args.n_jobs_per_resource,
+            batch_size=args.batch_size,
+            incremental=args.incremental,
         )
@@ -2,11 +2,8 @@ import html
 import json
 import re
 from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor as PoolExecutor
 from urllib.parse import urljoin
 
-from ratelimiter import RateLimiter
-
 from ranking.management.modules.common import REQ, BaseModule
 from ranking.management.modules.excepts import ExceptionParseStandings
 
@@ -62,13 +59,11 @@ class Statistic(BaseModule):
                                             'short': html.unescape(short),
                                             'name': html.unescape(name)}
 
-        @RateLimiter(max_calls=5, period=1)
-        def fetch_page(page):
+        scoreboard_headers = {'x-requested-with': 'XMLHttpRequest'}
+
+        def get_page_url(page):
             offset = (page - 1) * limit
-            url = f'https://algotester.com/en/Contest/ListScoreboard/{cid}?offset={offset}&limit={limit}'
-            page = REQ.get(url, headers={'x-requested-with': 'XMLHttpRequest'})
-            data = json.loads(page)
-            return data
+            return f'https://algotester.com/en/Contest/ListScoreboard/{cid}?offset={offset}&limit={limit}'
 
         result = {}
         hidden_fields = {'element_type', 'is_unofficial', 'group_ex'}
@@ -132,15 +127,15 @@ class Statistic(BaseModule):
                         solved += 1
                 r['solved'] = {'solving': solved}
 
-        data = fetch_page(1)
+        data = json.loads(REQ.get(get_page_url(1), headers=scoreboard_headers))
         if 'rows' not in data:
             raise ExceptionParseStandings(json.dumps(data))
         proccess_data(data)
 
-        with PoolExecutor(max_workers=4) as executor:
-            total_pages = (data['total'] + limit - 1) // limit
-            for data in executor.map(fetch_page, range(2, total_pages + 1)):
-                proccess_data(data)
+        total_pages = (data['total'] + limit - 1) // limit
+        urls = [get_page_url(page) for page in range(2, total_pages + 1)]
+        for page in REQ.get_many(urls, concurrency=4, per_host_rate=5, headers=scoreboard_headers):
+            proccess_data(json.loads(page))
 
         if problems_results.issubset({0, 1}):
             for r in result.values():
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.15 on 2026-10-18 07:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clist', '0186_problem_submissions_rate'),
+        ('ranking', '0156_alter_statistics_related'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+                ('date', models.DateTimeField()),
+                ('new_rating', models.IntegerField(blank=True, default=None, null=True)),
+                ('old_rating', models.IntegerField(blank=True, default=None, null=True)),
+                ('rating_change', models.IntegerField(blank=True, default=None, null=True)),
+                ('place', models.CharField(blank=True, default=None, max_length=17, null=True)),
+                ('score', models.FloatField(blank=True, default=None, null=True)),
+                ('solved', models.IntegerField(blank=True, default=None, null=True)),
+                ('division', models.TextField(blank=True, default=None, null=True)),
+                ('has_rating_data', models.BooleanField(default=False)),
+                ('values', models.JSONField(blank=True, default=dict)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to='ranking.account')),
+                ('contest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to='clist.contest')),
+                ('resource', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to='clist.resource')),
+                ('statistic', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='rating_history', to='ranking.statistics')),
+            ],
+            options={
+                'verbose_name_plural': 'Rating histories',
+                'indexes': [models.Index(fields=['account', 'date'], include=('resource', 'contest', 'statistic', 'new_rating', 'old_rating', 'rating_change', 'place', 'score'), name='rating_history_account_date')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.15 on 2026-10-18 07:29
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def backfill_rating_history(apps, schema_editor):
+    call_command('backfill_rating_history')
+
+
+class Migration(migrations.Migration):
+
+    # backfill is done in batches, each of them is committed separately
+    atomic = False
+
+    dependencies = [
+        ('ranking', '0157_ratinghistory'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_rating_history, migrations.RunPython.noop),
+    ]
@@ -12,9 +12,9 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
 from django.db import models
-from django.db.models import F, OuterRef, Prefetch, Q, Sum
+from django.db.models import F, Func, OuterRef, Prefetch, Q, Sum, Value
 from django.db.models.functions import Coalesce, Upper
-from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
 from django.dispatch import receiver
 from django.urls import reverse
 from django.utils import timezone
@@ -23,11 +23,13 @@ from django_countries.fields import CountryField
 from sql_util.utils import Exists, SubqueryCount, SubquerySum
 
 from clist.models import Contest, Resource
-from clist.templatetags.extras import get_item, get_statistic_stats, has_season
+from clist.templatetags.extras import asfloat, get_item, get_statistic_stats, has_season
 from clist.utils import update_account_by_coders
 from pyclist.indexes import DescNullsLastIndex, ExpressionIndex, GistIndexTrgrmOps
 from pyclist.models import BaseManager, BaseModel
+from ranking.counters import get_account_counters_accumulator
 from ranking.enums import AccountType
+from ranking.rating_history import deferred_rating_history, get_rating_history_accumulator
 from true_coders.models import Coder, Party
 from utils.mathutils import sum_with_none
 from utils.signals import update_n_field_on_change
@@ -159,7 +161,10 @@ class Account(BaseModel):
             (not self.last_activity or self.last_activity < statistic.last_activity)
         ):
             self.last_activity = statistic.last_activity
-            self.save(update_fields=['last_activity'])
+            if (accumulator := get_account_counters_accumulator()) is not None:
+                accumulator.set_max(self.pk, 'last_activity', self.last_activity)
+            else:
+                self.save(update_fields=['last_activity'])
 
     def update_last_rating_activity(self, statistic, contest=None, resource=None):
         contest = contest or statistic.contest
@@ -170,7 +175,10 @@ class Account(BaseModel):
             resource.is_major_kind(contest)
         ):
             self.last_rating_activity = statistic.last_activity
-            self.save(update_fields=['last_rating_activity'])
+            if (accumulator := get_account_counters_accumulator()) is not None:
+                accumulator.set_max(self.pk, 'last_rating_activity', self.last_rating_activity)
+            else:
+                self.save(update_fields=['last_rating_activity'])
 
     def display(self, with_resource=None):
         if not with_resource and self.name and has_season(self.key, self.name):
@@ -673,6 +681,28 @@ class Statistics(BaseModel):
     def first_ac_filter(cls):
         return Q(addition__problems__icontains='"first_ac": true')
 
+    STATS_SOURCE_FIELDS = ('addition', 'solving', 'place_as_int')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stats_source = {f: instance.__dict__[f] for f in cls.STATS_SOURCE_FIELDS if f in instance.__dict__}
+        return instance
+
+    @property
+    def _stats(self):
+        """Account counters of the stored row, computed on first access.
+
+        Loaded values are kept by reference, pre_save takes the stored values if addition can be changed in place.
+        """
+        if '_stats_snapshot' not in self.__dict__:
+            self._stats_snapshot = _get_statistic_stats(self, getattr(self, '_stats_source', None))
+        return self._stats_snapshot
+
+    def reset_stats_snapshot(self):
+        self._stats_source = {f: self.__dict__[f] for f in self.STATS_SOURCE_FIELDS if f in self.__dict__}
+        self.__dict__.pop('_stats_snapshot', None)
+
     def update_stats(self) -> list[str]:
         problem_stats = get_statistic_stats(self.addition, solving=self.solving)
         update_fields = []
@@ -687,19 +717,35 @@ class Statistics(BaseModel):
         return update_fields
 
 
-def _get_statistic_stats(instance):
-    return get_statistic_stats(instance.addition, solving=instance.solving,
-                               with_n_medal_field=True, with_n_place_field=instance.place_as_int)
+def _get_statistic_stats(instance, source=None):
+    values = {field: getattr(instance, field) for field in instance.STATS_SOURCE_FIELDS if field not in (source or {})}
+    values.update(source or {})
+    return get_statistic_stats(values['addition'], solving=values['solving'],
+                               with_n_medal_field=True, with_n_place_field=values['place_as_int'])
 
 
-@receiver(post_init, sender=Statistics)
-def statistics_post_init(sender, instance, **kwargs):
-    instance._stats = _get_statistic_stats(instance)
+@receiver(pre_save, sender=Statistics)
+def statistics_pre_save(sender, instance, **kwargs):
+    if instance._state.adding or '_stats_snapshot' in instance.__dict__:
+        return
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and not set(update_fields) & set(instance.STATS_SOURCE_FIELDS):
+        return
+    source = getattr(instance, '_stats_source', {})
+    if 'addition' in source and instance.__dict__.get('addition') is not source['addition']:
+        return
+    if not instance.resource.is_major_kind(instance.contest):
+        return
+    # loaded addition can be changed in place, so take the stored values
+    stored = Statistics.objects.filter(pk=instance.pk).values(*instance.STATS_SOURCE_FIELDS).first()
+    if stored is not None:
+        instance._stats_source = stored
 
 
 @receiver(post_save, sender=Statistics)
 @receiver(post_delete, sender=Statistics)
 def update_account_from_statistic(signal, instance, **kwargs):
+    accumulator = get_account_counters_accumulator()
     if instance.resource.is_major_kind(instance.contest):
         if signal is post_delete:
             diff = {field: -value for field, value in instance._stats.items() if value}
@@ -714,27 +760,165 @@ def update_account_from_statistic(signal, instance, **kwargs):
         for field, value in diff.items():
             if not value:
                 continue
+            if accumulator is not None:
+                accumulator.add(instance.account_id, field, value)
+                continue
             account = instance.account
             setattr(account, field, sum_with_none(getattr(account, field), value))
             updated_fields.append(field)
         if updated_fields:
             instance.account.save(update_fields=updated_fields)
+    if signal is post_save:
+        instance.reset_stats_snapshot()
 
     if instance.skip_in_stats or kwargs.get('update_fields'):
         return
 
+    n_contests_diff = 0
     if signal is post_delete:
-        instance.account.n_contests -= 1
+        n_contests_diff = -1
+    elif signal is post_save and kwargs['created']:
+        n_contests_diff = 1
+    if n_contests_diff and accumulator is not None:
+        accumulator.add(instance.account_id, 'n_contests', n_contests_diff)
+    elif n_contests_diff:
+        instance.account.n_contests += n_contests_diff
         instance.account.save(update_fields=['n_contests'])
-    elif signal is post_save:
-        if kwargs['created']:
-            instance.account.n_contests += 1
-            instance.account.save(update_fields=['n_contests'])
 
+    if signal is post_save:
         instance.account.update_last_activity(statistic=instance)
         instance.account.update_last_rating_activity(statistic=instance)
 
 
+class RatingHistory(BaseModel):
+    statistic = models.OneToOneField(Statistics, on_delete=models.CASCADE, related_name='rating_history')
+    account = models.ForeignKey(Account, on_delete=models.CASCADE, related_name='rating_history')
+    contest = models.ForeignKey(Contest, on_delete=models.CASCADE, related_name='rating_history')
+    resource = models.ForeignKey(Resource, on_delete=models.CASCADE, related_name='rating_history')
+    date = models.DateTimeField()
+    new_rating = models.IntegerField(default=None, null=True, blank=True)
+    old_rating = models.IntegerField(default=None, null=True, blank=True)
+    rating_change = models.IntegerField(default=None, null=True, blank=True)
+    place = models.CharField(max_length=17, default=None, null=True, blank=True)
+    score = models.FloatField(default=None, null=True, blank=True)
+    solved = models.IntegerField(default=None, null=True, blank=True)
+    division = models.TextField(default=None, null=True, blank=True)
+    has_rating_data = models.BooleanField(default=False)
+    values = models.JSONField(default=dict, blank=True)
+
+    STATISTIC_FIELDS = {'addition', 'place', 'solving', 'account', 'contest'}
+    UPDATE_FIELDS = ['account', 'contest', 'resource', 'date', 'new_rating', 'old_rating', 'rating_change',
+                     'place', 'score', 'solved', 'division', 'has_rating_data', 'values', 'modified']
+
+    class Meta:
+        verbose_name_plural = 'Rating histories'
+
+        indexes = [
+            models.Index(fields=['account', 'date'], name='rating_history_account_date',
+                         include=['resource', 'contest', 'statistic', 'new_rating', 'old_rating', 'rating_change',
+                                  'place', 'score']),
+        ]
+
+    def __str__(self):
+        return f'RatingHistory#{self.id} of {self.statistic_id}'
+
+    @staticmethod
+    def has_rating(addition):
+        return addition.get('new_rating') is not None or bool(addition.get('_rating_data'))
+
+    @staticmethod
+    def dict_to_float_values(data):
+        ret = {}
+        for k, v in data.items():
+            if k.startswith('_') or k in settings.ADDITION_HIDE_FIELDS_ or isinstance(v, (list, tuple)):
+                continue
+            if isinstance(v, dict):
+                d = RatingHistory.dict_to_float_values(v)
+                for subk, subv in d.items():
+                    ret[f'{k}__{subk}'] = subv
+                continue
+            if isinstance(v, str):
+                v = asfloat(v)
+            if v is None:
+                continue
+            ret[k] = v
+        return ret
+
+    @classmethod
+    def from_statistic(cls, statistic):
+        addition = statistic.addition
+        solved = asfloat(get_item(addition, 'solved.solving'))
+        solved = None if solved is None else int(solved)
+        values = dict(addition)
+        for field, value in (('n_solved', solved), ('place', statistic.place), ('score', statistic.solving)):
+            values[field] = value
+
+        def as_int(field):
+            value = asfloat(addition.get(field))
+            return None if value is None else int(value)
+
+        division = addition.get('division')
+        return cls(
+            statistic_id=statistic.pk,
+            account_id=statistic.account_id,
+            contest_id=statistic.contest_id,
+            resource_id=statistic.resource_id,
+            date=statistic.contest.end_time,
+            new_rating=as_int('new_rating'),
+            old_rating=as_int('old_rating'),
+            rating_change=as_int('rating_change'),
+            place=statistic.place,
+            score=statistic.solving,
+            solved=solved,
+            division=None if division is None else str(division),
+            has_rating_data=bool(addition.get('_rating_data')),
+            values=cls.dict_to_float_values(values),
+        )
+
+    @classmethod
+    def upsert(cls, statistics):
+        histories = [cls.from_statistic(statistic) for statistic in statistics]
+        return cls.objects.bulk_create(histories, update_conflicts=True, unique_fields=['statistic'],
+                                       update_fields=cls.UPDATE_FIELDS)
+
+    @classmethod
+    def reset_place(cls, statistic_ids):
+        """Sync place of rows whose statistics place was reset by queryset update."""
+        values = Func(F('values'), Value('place'), function='', arg_joiner=' - ', output_field=models.JSONField())
+        return cls.objects.filter(statistic_id__in=statistic_ids).update(place=None, values=values)
+
+
+@receiver(post_save, sender=Statistics)
+def update_rating_history(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not set(update_fields) & RatingHistory.STATISTIC_FIELDS:
+        return
+    if not instance.resource.has_rating_history:
+        return
+    with deferred_rating_history() as accumulator:
+        if RatingHistory.has_rating(instance.addition):
+            accumulator.upsert(instance)
+        elif not created:
+            accumulator.delete(instance.pk)
+
+
+@receiver(post_delete, sender=Statistics)
+def discard_rating_history(sender, instance, **kwargs):
+    if (accumulator := get_rating_history_accumulator()) is not None:
+        accumulator.discard(instance.pk)
+
+
+@receiver(post_save, sender=Contest)
+def update_rating_history_date(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and 'end_time' not in update_fields:
+        return
+    if instance.prev_end_time == instance.end_time:
+        return
+    instance.prev_end_time = instance.end_time
+    if created:
+        return
+    RatingHistory.objects.filter(contest=instance).exclude(date=instance.end_time).update(date=instance.end_time)
+
+
 class Module(BaseModel):
     resource = models.OneToOneField(Resource, on_delete=models.CASCADE)
     path = models.CharField(max_length=255)
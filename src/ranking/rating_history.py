@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import threading
+from contextlib import contextmanager
+
+from django.db import connection
+
+RATING_HISTORY_BATCH_SIZE = 1000
+
+_local = threading.local()
+
+
+class RatingHistoryAccumulator:
+    """Collects saved statistics to upsert or remove their rating history rows with grouped queries."""
+
+    def __init__(self):
+        self.upserts = {}
+        self.deletes = set()
+
+    def __bool__(self):
+        return bool(self.upserts or self.deletes)
+
+    def upsert(self, statistic):
+        self.deletes.discard(statistic.pk)
+        self.upserts[statistic.pk] = statistic
+
+    def delete(self, statistic_id):
+        self.upserts.pop(statistic_id, None)
+        self.deletes.add(statistic_id)
+
+    def discard(self, statistic_id):
+        self.upserts.pop(statistic_id, None)
+        self.deletes.discard(statistic_id)
+
+    def flush(self, batch_size=RATING_HISTORY_BATCH_SIZE):
+        from ranking.models import RatingHistory
+
+        n_upserted = 0
+        statistics = list(self.upserts.values())
+        for offset in range(0, len(statistics), batch_size):
+            n_upserted += len(RatingHistory.upsert(statistics[offset:offset + batch_size]))
+
+        n_deleted = 0
+        statistic_ids = sorted(self.deletes)
+        for offset in range(0, len(statistic_ids), batch_size):
+            histories = RatingHistory.objects.filter(statistic_id__in=statistic_ids[offset:offset + batch_size])
+            history_ids = list(histories.values_list('pk', flat=True))
+            if history_ids:
+                n_deleted += RatingHistory.objects.filter(pk__in=history_ids).delete()[0]
+
+        self.upserts.clear()
+        self.deletes.clear()
+        return n_upserted, n_deleted
+
+
+def get_rating_history_accumulator():
+    return getattr(_local, 'accumulator', None)
+
+
+@contextmanager
+def deferred_rating_history():
+    """Defer rating history updates from statistics signals and apply them grouped on exit.
+
+    Nested usage shares the outer accumulator. Rows are built from statistics as they are on exit.
+    """
+    accumulator = get_rating_history_accumulator()
+    if accumulator is not None:
+        yield accumulator
+        return
+
+    accumulator = RatingHistoryAccumulator()
+    _local.accumulator = accumulator
+    try:
+        yield accumulator
+    except Exception:
+        # inside transaction saved statistics are rolled back together with rating history
+        if not connection.in_atomic_block:
+            accumulator.flush()
+        raise
+    else:
+        accumulator.flush()
+    finally:
+        _local.accumulator = None
@@ -3,6 +3,7 @@
 import ast
 import collections
 import functools
+import hashlib
 import json
 import operator
 import re
@@ -14,9 +15,11 @@ from pydoc import locate
 import tqdm
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.management import call_command
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Count, JSONField, Max, Q, Sum
+from django.db.models.signals import post_save
 from django.urls import reverse
 from django.utils import timezone
 from django_print_sql import print_sql
@@ -27,6 +30,7 @@ from clist.templatetags.extras import add_prefix_to_problem_short, get_item, get
 from pyclist.middleware import RedirectException
 from ranking.management.modules.common import LOG
 from ranking.models import Account, Statistics
+from utils.attrdict import AttrDict
 from utils.logger import suppress_db_logging_context
 from utils.mathutils import max_with_none, sum_with_none
 
@@ -421,6 +425,56 @@ def create_upsolving_statistic(resource, contest, account):
     return stat, created
 
 
+def bulk_update_or_create_statistics(contest, rows):
+    """Batched analogue of Statistics.saved_objects.update_or_create for list of (account, defaults).
+
+    Returns list of (statistic, created) in the order of rows and sends post_save signals
+    the same way update_or_create does, so account counters stay consistent.
+    Rows of the same account are saved once with the last defaults and share the statistic.
+    """
+    unique_rows = {account.pk: (account, defaults) for account, defaults in rows}
+    existing_statistics = Statistics.saved_objects.filter(contest=contest, account_id__in=list(unique_rows))
+    existing_statistics = {s.account_id: s for s in existing_statistics}
+
+    now = timezone.now()
+    saved = {}
+    to_create = defaultdict(list)
+    to_update = defaultdict(list)
+    for account, defaults in unique_rows.values():
+        fields = tuple(sorted(defaults))
+        statistic = existing_statistics.get(account.pk)
+        created = statistic is None
+        if created:
+            statistic = Statistics(account=account, contest=contest, **defaults)
+            to_create[fields].append(statistic)
+        else:
+            for field, value in defaults.items():
+                setattr(statistic, field, value)
+            statistic.modified = now
+            to_update[fields].append(statistic)
+        saved[account.pk] = (statistic, created, fields)
+
+    with suppress_db_logging_context():
+        for fields, statistics in to_create.items():
+            update_fields = [f for f in fields if f != 'resource'] + ['modified']
+            Statistics.objects.bulk_create(statistics, update_conflicts=True, unique_fields=['account', 'contest'],
+                                           update_fields=update_fields)
+        for fields, statistics in to_update.items():
+            Statistics.objects.bulk_update(statistics, list(fields) + ['modified'])
+
+    for statistic, created, fields in saved.values():
+        update_fields = None if created else frozenset(fields) | {'modified'}
+        post_save.send(sender=Statistics, instance=statistic, created=created, update_fields=update_fields,
+                       raw=False, using=Statistics.objects.db)
+
+    ret = []
+    for account, _ in rows:
+        statistic, created, _ = saved[account.pk]
+        ret.append((statistic, created))
+        saved[account.pk] = (statistic, False, None)
+    return ret
+
+
 def _get_placing(placing, stat):
     return placing['division'][stat.addition['division']] if 'division' in placing else placing
 
@@ -429,10 +483,14 @@ def _get_placing_values(placing):
     return placing['division'].values() if 'division' in placing else [placing]
 
 
+STAGE_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+
+
 def update_stage(self):
     eps = 1e-9
     stage = self.contest
     timezone_now = timezone.now()
+    score_params_hash = hashlib.md5(json.dumps(self.score_params, sort_keys=True).encode()).hexdigest()
 
     filter_params = dict(self.filter_params)
     spec_filter_params = dict()
@@ -561,9 +619,7 @@ def update_stage(self):
                 d['contest'] = r['contest__title']
             exclude_advances[r['account__key']] = d
 
-    statistics = Statistics.objects \
-        .select_related('account', 'account__duplicate') \
-        .prefetch_related('account__coders')
+    statistics = Statistics.objects.select_related('account')
     filter_statistics = self.score_params.get('filter_statistics')
     if filter_statistics:
         statistics = statistics.filter(**filter_statistics)
@@ -572,124 +628,210 @@ def update_stage(self):
         statistics = statistics.exclude(**exclude_statistics)
     re_ranking = self.score_params.get('re_ranking')
     update_statistics_fields = self.score_params.get('update_statistics_fields', [])
+    # cache only statistics fields and addition keys used below to build stage results
+    stage_fields = {field['field'] for field in fields if 'field' in field}
+    stage_fields |= {field.lstrip('-') for field in order_by}
+    if 'status' in self.score_params:
+        stage_fields.add(self.score_params['status'])
+    addition_fields = stage_fields | {'url', 'solved'}
+    addition_fields |= {field for _, field, _ in settings.PROBLEM_STATISTIC_FIELDS}
+    if detail_problems:
+        addition_fields.add('problems')
+    statistics_fields = [
+        field.attname for field in Statistics._meta.concrete_fields
+        if not isinstance(field, JSONField) or field.attname in stage_fields
+    ]
+
+    # statistics can be changed without parsing (renamed accounts, deletes, admin edits), so their marker is used too
+    statistics_markers = statistics.filter(contest__in=contests).order_by().values('contest_id').annotate(
+        n_statistics=Count('pk'),
+        max_modified=Max('modified'),
+        sum_account_ids=Sum('account_id'),
+    )
+    statistics_markers = {
+        marker['contest_id']: (marker['n_statistics'], str(marker['max_modified']), marker['sum_account_ids'])
+        for marker in statistics_markers
+    }
+
+    def get_contest_statistics_fingerprint(contest):
+        return (
+            score_params_hash,
+            str(contest.parsed_time),
+            str(contest.updated),
+            statistics_markers.get(contest.pk),
+        )
+
+    def calculate_contest_statistics(contest):
+        stats = list(statistics.filter(contest_id=contest.pk))
+        stage_values = {}
+
+        max_solving = 0
+        n_effective = 0
+        for stat in stats:
+            max_solving = max(max_solving, stat.solving)
+            n_effective += stat.solving > eps
+
+        if re_ranking:
+            order = contest.get_statistics_order()
+            stats = list(statistics.filter(contest_id=contest.pk).order_by(*order))
+            stat_last = None
+            stat_attrs = [attr.strip('-') for attr in order]
+            for stat_idx, stat in enumerate(stats, start=1):
+                stat_value = tuple(get_item(stat, attr) for attr in stat_attrs)
+                if stat_value != stat_last:
+                    stat_rank = stat_idx
+                    stat_last = stat_value
+                stat.place_as_int = stat_rank
+
+        if stage_placing:
+            placing = deepcopy(stage_placing)
+            for placing_value in _get_placing_values(placing):
+                placing_value.setdefault('_scores', {})
+                placing_value.setdefault('_n_stats', 0)
+            for stat in stats:
+                stat_placing = _get_placing(placing, stat)
+                key = str(stat.place_as_int)
+                if key in stat_placing:
+                    stat_placing['_scores'][key] = stat_placing.pop(key)
+                stat_placing['_n_stats'] += 1
+            group_scores = []
+            for placing_value in _get_placing_values(placing):
+                n_stats = placing_value['_n_stats']
+                for place in reversed(range(1, n_stats + 1)):
+                    key = str(place)
+                    if key in placing_value:
+                        group_scores.append(placing_value.pop(key))
+                    else:
+                        if group_scores:
+                            placing_value['_scores'][key] += sum(group_scores)
+                            placing_value['_scores'][key] /= len(group_scores) + 1
+                        group_scores = []
+                placing_value.update(placing_value.pop('_scores'))
+
+        scored_stats = []
+        for stat in stats:
+            rank = stat.place_as_int
+            stage_values['rank'] = rank
+            score = None
+            if stage_placing:
+                placing_scores = _get_placing(placing, stat)
+                score_rank = 'zero' if stat.solving < eps else str(rank)
+                score = placing_scores.get(score_rank, placing_scores.get('default'))
+                if score is None:
+                    continue
+                stage_values['gp_score'] = score
+            if scoring:
+                if score is None:
+                    score = 0
+                if scoring['name'] == 'general':
+                    if rank is None:
+                        continue
+                    score_factor = stat.solving / max_solving
+                    rank_factor = (n_effective - rank + 1) / n_effective
+                    norm_score = scoring['factor'] * score_factor * rank_factor
+                    score += norm_score
+                    stage_values['score_factor'] = score_factor
+                    stage_values['rank_factor'] = rank_factor
+                    stage_values['norm_score'] = norm_score
+                elif scoring['name'] == 'field':
+                    score += stat.addition.get(scoring['field'], 0)
+                else:
+                    raise NotImplementedError(f'scoring {scoring["name"]} is not implemented')
+            if score is None:
+                score = stat.solving
+            if duration_weighting and contest.duration < timedelta(**duration_weighting['duration']):
+                score *= duration_weighting['factor']
+
+            stage_values['score'] = score
+
+            updated_addition = False
+            updated_contest_info = False
+            contest_fields = contest.info.setdefault('fields', [])
+            contest_hidden_fields = contest.info.setdefault('hidden_fields', [])
+            for field in update_statistics_fields:
+                stage_value = stage_values.get(field)
+                stat_field = f'stage_{field}'
+                if stage is None and stat_field in stat.addition:
+                    stat.addition.pop(stat_field)
+                    updated_addition = True
+                elif stage_value != stat.addition.get(stat_field):
+                    stat.addition[stat_field] = stage_value
+                    updated_addition = True
+                    if stat_field not in contest_fields:
+                        contest_fields.append(stat_field)
+                        contest_hidden_fields.append(stat_field)
+                        updated_contest_info = True
+            if updated_addition:
+                stat.save(update_fields=['addition'])
+            if updated_contest_info:
+                contest.save(update_fields=['info'])
+
+            scored_stat = {field: getattr(stat, field) for field in statistics_fields}
+            scored_stat['addition'] = {k: v for k, v in stat.addition.items() if k in addition_fields}
+            scored_stat['pk'] = stat.pk
+            scored_stat['stage_score'] = score
+            scored_stats.append(scored_stat)
+        return {'n_total': len(stats), 'statistics': scored_stats}
+
+    def get_contest_statistics_cache_key(contest):
+        return f'update_stage_{self.pk}_contest_{contest.pk}'
+
+    def cache_contest_statistics(contest):
+        contest_statistics = calculate_contest_statistics(contest)
+        contest_statistics['fingerprint'] = get_contest_statistics_fingerprint(contest)
+        cache.set(get_contest_statistics_cache_key(contest), contest_statistics, timeout=STAGE_CACHE_TIMEOUT)
+        contests_statistics[contest.pk] = contest_statistics
+
+    contests_statistics = {}
+    n_calculated = 0
+    for contest in tqdm.tqdm(contests, desc=f'calculating statistics for stage {stage}'):
+        fingerprint = get_contest_statistics_fingerprint(contest)
+        cached = cache.get(get_contest_statistics_cache_key(contest))
+        if cached and cached['fingerprint'] == fingerprint:
+            contests_statistics[contest.pk] = cached
+            continue
+        cache_contest_statistics(contest)
+        n_calculated += 1
+
+    def get_accounts(contests_statistics):
+        accounts_ids = {stat['account_id'] for cs in contests_statistics for stat in cs['statistics']}
+        accounts = Account.objects.select_related('duplicate').prefetch_related('coders', 'duplicate__coders')
+        return accounts.in_bulk(accounts_ids)
+
+    accounts = get_accounts(contests_statistics.values())
+
+    # cached statistics can refer to merged or deleted accounts, such contests are calculated again
+    missed_contests = [
+        contest for contest in contests
+        if any(stat['account_id'] not in accounts for stat in contests_statistics[contest.pk]['statistics'])
+    ]
+    for contest in missed_contests:
+        cache_contest_statistics(contest)
+        n_calculated += 1
+    if missed_contests:
+        accounts.update(get_accounts(contests_statistics[contest.pk] for contest in missed_contests))
+    LOG.info(f'Calculated statistics for {n_calculated} of {len(contests)} contests of stage {stage}')
 
     account_keys = dict()
     problem_values = defaultdict(set)
-    total = statistics.filter(contest__in=contests).count()
+    total = sum(len(cs['statistics']) for cs in contests_statistics.values())
     with tqdm.tqdm(total=total, desc=f'getting statistics for stage {stage}') as pbar, print_sql(count_only=True):
         for idx, contest in enumerate(contests, start=1):
             skip_problem_stat = '_skip_for_problem_stat' in contest.info.get('fields', [])
             contest_unrated = contest.info.get('unrated')
+            contest_statistics = contests_statistics[contest.pk]
 
             if not detail_problems:
                 problem_info_key = str(contest.pk)
                 problem_short = get_problem_short(problems_infos[problem_info_key])
+                if not skip_problem_stat:
+                    problems_infos[problem_info_key].setdefault('n_total', 0)
+                    problems_infos[problem_info_key]['n_total'] += contest_statistics['n_total']
             pbar.set_postfix(contest=contest)
-            stats = statistics.filter(contest_id=contest.pk)
-            stage_values = {}
-
-            max_solving = 0
-            n_effective = 0
-            for stat in stats:
-                max_solving = max(max_solving, stat.solving)
-                n_effective += stat.solving > eps
-
-            if re_ranking:
-                order = contest.get_statistics_order()
-                stats = stats.order_by(*order)
-                stat_last = None
-                stat_attrs = [attr.strip('-') for attr in order]
-                for stat_idx, stat in enumerate(stats, start=1):
-                    stat_value = tuple(get_item(stat, attr) for attr in stat_attrs)
-                    if stat_value != stat_last:
-                        stat_rank = stat_idx
-                        stat_last = stat_value
-                    stat.place_as_int = stat_rank
 
-            if stage_placing:
-                placing = deepcopy(stage_placing)
-                for placing_value in _get_placing_values(placing):
-                    placing_value.setdefault('_scores', {})
-                    placing_value.setdefault('_n_stats', 0)
-                for stat in stats:
-                    stat_placing = _get_placing(placing, stat)
-                    key = str(stat.place_as_int)
-                    if key in stat_placing:
-                        stat_placing['_scores'][key] = stat_placing.pop(key)
-                    stat_placing['_n_stats'] += 1
-                group_scores = []
-                for placing_value in _get_placing_values(placing):
-                    n_stats = placing_value['_n_stats']
-                    for place in reversed(range(1, n_stats + 1)):
-                        key = str(place)
-                        if key in placing_value:
-                            group_scores.append(placing_value.pop(key))
-                        else:
-                            if group_scores:
-                                placing_value['_scores'][key] += sum(group_scores)
-                                placing_value['_scores'][key] /= len(group_scores) + 1
-                            group_scores = []
-                    placing_value.update(placing_value.pop('_scores'))
-
-            for stat_idx, stat in enumerate(stats, start=1):
-                if not detail_problems and not skip_problem_stat:
-                    problems_infos[problem_info_key].setdefault('n_total', 0)
-                    problems_infos[problem_info_key]['n_total'] += 1
-                rank = stat.place_as_int
-                stage_values['rank'] = rank
-                score = None
-                if stage_placing:
-                    placing_scores = _get_placing(placing, stat)
-                    score_rank = 'zero' if stat.solving < eps else str(rank)
-                    score = placing_scores.get(score_rank, placing_scores.get('default'))
-                    if score is None:
-                        continue
-                    stage_values['gp_score'] = score
-                if scoring:
-                    if score is None:
-                        score = 0
-                    if scoring['name'] == 'general':
-                        if rank is None:
-                            continue
-                        score_factor = stat.solving / max_solving
-                        rank_factor = (n_effective - rank + 1) / n_effective
-                        norm_score = scoring['factor'] * score_factor * rank_factor
-                        score += norm_score
-                        stage_values['score_factor'] = score_factor
-                        stage_values['rank_factor'] = rank_factor
-                        stage_values['norm_score'] = norm_score
-                    elif scoring['name'] == 'field':
-                        score += stat.addition.get(scoring['field'], 0)
-                    else:
-                        raise NotImplementedError(f'scoring {scoring["name"]} is not implemented')
-                if score is None:
-                    score = stat.solving
-                if duration_weighting and contest.duration < timedelta(**duration_weighting['duration']):
-                    score *= duration_weighting['factor']
-
-                stage_values['score'] = score
-
-                updated_addition = False
-                updated_contest_info = False
-                contest_fields = contest.info.setdefault('fields', [])
-                contest_hidden_fields = contest.info.setdefault('hidden_fields', [])
-                for field in update_statistics_fields:
-                    stage_value = stage_values.get(field)
-                    stat_field = f'stage_{field}'
-                    if stage is None and stat_field in stat.addition:
-                        stat.addition.pop(stat_field)
-                        updated_addition = True
-                    elif stage_value != stat.addition.get(stat_field):
-                        stat.addition[stat_field] = stage_value
-                        updated_addition = True
-                        if stat_field not in contest_fields:
-                            contest_fields.append(stat_field)
-                            contest_hidden_fields.append(stat_field)
-                            updated_contest_info = True
-                if updated_addition:
-                    stat.save(update_fields=['addition'])
-                if updated_contest_info:
-                    contest.save(update_fields=['info'])
+            for stat in contest_statistics['statistics']:
+                stat = AttrDict(stat)
+                score = stat.stage_score
 
                 if not detail_problems and not skip_problem_stat:
                     problems_infos[problem_info_key].setdefault('n_teams', 0)
@@ -698,7 +840,9 @@ def update_stage(self):
                         problems_infos[problem_info_key].setdefault('n_accepted', 0)
                         problems_infos[problem_info_key]['n_accepted'] += 1
 
-                account = stat.account
+                account = accounts.get(stat.account_id)
+                if account is None:
+                    continue
                 if account.duplicate is not None:
                     account = account.duplicate
 
@@ -988,6 +1132,8 @@ def update_stage(self):
         fields = list()
 
         pks = set()
+        saved_statistics = []
+        rows_to_save = []
         placing_infos = {}
         score_advance = None
         place_advance = 0
@@ -1063,10 +1209,13 @@ def update_stage(self):
                 stat.skip_in_stats = defaults['skip_in_stats']
                 stat.advanced = defaults['advanced']
                 stat.save(update_fields=['addition', 'skip_in_stats', 'advanced'])
+                saved_statistics.append(stat)
             else:
-                stat, created = Statistics.objects.update_or_create(account=account, contest=stage, defaults=defaults)
-            pks.add(stat.pk)
+                rows_to_save.append((account, defaults))
+        saved_statistics.extend(stat for stat, _ in bulk_update_or_create_statistics(stage, rows_to_save))
 
+        for stat in saved_statistics:
+            pks.add(stat.pk)
             for k in stat.addition.keys():
                 if field_to_problem and re.search(field_to_problem['regex'], k):
                     continue
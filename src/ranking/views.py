@@ -2,6 +2,7 @@ import bisect
 import colorsys
 import copy
 import hashlib
+import json
 import re
 from collections import OrderedDict, defaultdict
 from datetime import timedelta
@@ -13,6 +14,8 @@ from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.db.models import Avg, Case, Count, Exists, F, OuterRef, Prefetch, Q, Subquery, Value, When
 from django.db.models.expressions import RawSQL
@@ -769,7 +772,77 @@ def standings_charts(request, context):
     context["charts"] = charts
 
 
-def render_standings_paging(contest, statistics, with_detail=True):
+STANDINGS_SOCKET_CACHE_TIMEOUT = 3600
+
+
+def get_standings_row_hash(statistic):
+    data = [
+        statistic.place,
+        statistic.solving,
+        statistic.upsolving,
+        statistic.penalty,
+        statistic.addition,
+        statistic.medal,
+        statistic.advanced,
+        statistic.skip_in_stats,
+        statistic.account_id,
+        statistic.account.modified,
+    ]
+    return hashlib.md5(json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+
+
+def get_standings_problems_signature(problems):
+    """Problems without statistics fields which are updated on almost every parse."""
+    return [
+        {k: v for k, v in problem.items() if not k.startswith("n_") and not k.startswith("first_ac")}
+        for problem in problems
+    ]
+
+
+def get_standings_socket_context(contest, division, problems, with_detail):
+    """Contest-wide part of live standings context, reused until contest standings settings change.
+
+    Penalty mode depends on the current leader, so it is computed on every call.
+    """
+    contest_fields = contest.info.get("fields", [])
+    statistics = contest.statistics_set.order_by(*contest.get_statistics_order())
+    mod_penalty = get_standings_mod_penalty(contest, division, problems, statistics)
+    signature = [
+        division,
+        with_detail,
+        contest_fields,
+        contest.info.get("fields_values"),
+        contest.info.get("standings"),
+        contest.info.get("divisions_addition"),
+        get_standings_problems_signature(problems),
+        contest.duration_in_secs,
+    ]
+    signature = hashlib.md5(json.dumps(signature, sort_keys=True, cls=DjangoJSONEncoder).encode()).hexdigest()
+    cache_key = f"standings_socket_context_{contest.pk}"
+    cached = cache.get(cache_key)
+    if cached and cached["signature"] == signature:
+        return dict(cached, mod_penalty=mod_penalty)
+
+    has_country = (
+        "country" in contest_fields
+        or "_countries" in contest_fields
+        or statistics.filter(account__country__isnull=False).exists()
+    )
+    ret = {
+        "signature": signature,
+        "fields": get_standings_fields(contest, division=division, with_detail=with_detail),
+        "has_country": has_country,
+    }
+    cache.set(cache_key, ret, STANDINGS_SOCKET_CACHE_TIMEOUT)
+    return dict(ret, mod_penalty=mod_penalty)
+
+
+def render_standings_paging(contest, statistics, with_detail=True, only_changed=False):
+    """Render standings rows for live update.
+
+    With `only_changed` rows whose content hash is the same as on the previous push are not rendered,
+    the whole page is rendered if hashes of the previous push are not available.
+    """
     contest_fields = contest.info.get("fields", [])
 
     n_total = None
@@ -795,18 +868,31 @@ def render_standings_paging(contest, statistics, with_detail=True):
 
     problems = get_standings_problems(contest, division)
 
-    fields = get_standings_fields(contest, division=division, with_detail=with_detail)
+    socket_context = get_standings_socket_context(contest, division, problems, with_detail)
 
     statistics = statistics.prefetch_related("account")
 
-    mod_penalty = get_standings_mod_penalty(contest, division, problems, statistics)
-    colored_by_group_score = contest.info.get("standings", {}).get("colored_by_group_score")
+    if only_changed:
+        # rendered rows depend on penalty mode, which is not a part of the cached context signature
+        mod_penalty_hash = hashlib.md5(json.dumps(socket_context["mod_penalty"], sort_keys=True).encode()).hexdigest()
+        rows_hashes_key = f"standings_rows_hashes_{contest.pk}_{socket_context['signature']}_{mod_penalty_hash}"
+        rows_hashes = cache.get(rows_hashes_key) or {}
+        rows = list(statistics)
+        changed = []
+        for statistic in rows:
+            row_hash = get_standings_row_hash(statistic)
+            if rows_hashes.get(statistic.pk) != row_hash:
+                rows_hashes[statistic.pk] = row_hash
+                changed.append(statistic.pk)
+        cache.set(rows_hashes_key, rows_hashes, STANDINGS_SOCKET_CACHE_TIMEOUT)
+        n_total = (n_total or len(rows)) - (len(rows) - len(changed))
+        if not changed:
+            return {"page": "", "total": 0}
+        if len(changed) < len(rows):
+            statistics = statistics.filter(pk__in=changed)
 
-    has_country = (
-        "country" in contest_fields
-        or "_countries" in contest_fields
-        or statistics.filter(account__country__isnull=False).exists()
-    )
+    colored_by_group_score = contest.info.get("standings", {}).get("colored_by_group_score")
+    mod_penalty = socket_context["mod_penalty"]
 
     context = {
         "request": HttpRequest(),
@@ -814,11 +900,11 @@ def render_standings_paging(contest, statistics, with_detail=True):
         "division": division,
         "statistics": statistics,
         "problems": problems,
-        "fields": fields,
+        "fields": socket_context["fields"],
         "without_pagination": True,
         "my_statistics": [],
         "contest_timeline": contest.get_timeline_info(),
-        "has_country": has_country,
+        "has_country": socket_context["has_country"],
         "with_detail": with_detail,
         "per_page": contest.standings_per_page,
         "per_page_more": 0,
@@ -843,7 +929,7 @@ def render_standings_paging(contest, statistics, with_detail=True):
 
 
 def update_standings_socket(contest, statistics):
-    rendered = render_standings_paging(contest, statistics)
+    rendered = render_standings_paging(contest, statistics, only_changed=True)
     channel_layer = get_channel_layer()
     context = {
         "type": "standings",
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+import time
+
+import numpy as np
+from prettytable import PrettyTable
+
+from ranking.management.commands.calculate_rating_prediction import (DEFAULT_MAX_ERROR, calculate_expected_ratings,
+                                                                     calculate_expected_ratings_histogram)
+from scripts.common import pass_args
+
+
+def generate_rankings(n, seed):
+    rng = np.random.default_rng(seed)
+    ratings = np.clip(rng.normal(1500, 350, n), 0, 4000).round()
+    scores = ratings + rng.normal(0, 300, n)
+    ranks = np.empty(n, dtype=np.float64)
+    ranks[np.argsort(-scores)] = np.arange(1, n + 1)
+    order = np.argsort(ratings)
+    return ranks[order], ratings[order]
+
+
+def benchmark(sizes='1000,5000,10000', max_error=DEFAULT_MAX_ERROR, seed=0, exact=True):
+    sizes = [int(size) for size in str(sizes).split(',')]
+
+    # warm up numba compilation
+    calculate_expected_ratings(*generate_rankings(10, seed))
+
+    table = PrettyTable(field_names=['n', 'exact, s', 'histogram, s', 'speedup', 'max diff', 'mean diff'])
+    for n in sizes:
+        ranks, ratings = generate_rankings(n, seed)
+
+        start = time.time()
+        histogram = calculate_expected_ratings_histogram(ranks, ratings, max_error)
+        histogram_time = time.time() - start
+
+        if not exact:
+            table.add_row([n, '', f'{histogram_time:.3f}', '', '', ''])
+            continue
+
+        start = time.time()
+        expected = calculate_expected_ratings(ranks, ratings)
+        exact_time = time.time() - start
+
+        diff = np.abs(expected - histogram)
+        table.add_row([n, f'{exact_time:.3f}', f'{histogram_time:.3f}', f'{exact_time / histogram_time:.1f}x',
+                       f'{diff.max():.3f}', f'{diff.mean():.3f}'])
+    print(table)
+
+
+def run(*args):
+    pass_args(benchmark, args)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import random
+import time
+
+from django.db.models.signals import post_init
+from prettytable import PrettyTable
+
+from ranking.models import Statistics, _get_statistic_stats
+from scripts.common import pass_args
+
+
+def generate_rows(n, n_problems, seed):
+    rng = random.Random(seed)
+    field_names = ['id', 'account_id', 'contest_id', 'resource_id', 'place', 'place_as_int', 'solving', 'addition']
+    rows = []
+    for place in range(1, n + 1):
+        problems = {}
+        for short in range(n_problems):
+            result = rng.choice(['+', '+2', '-1', '-3', 100, 0, None])
+            if result is None:
+                continue
+            problem = {'result': result, 'time': f'{rng.randint(0, 300)}:00'}
+            if rng.random() < 0.1:
+                problem['upsolving'] = {'result': '+'}
+            problems[chr(ord('A') + short)] = problem
+        addition = {'problems': problems, 'medal': rng.choice([None, 'gold', 'silver', 'bronze'])}
+        rows.append([place, place, 1, 1, str(place), place, len(problems), addition])
+    return field_names, rows
+
+
+def load(field_names, rows, access=False):
+    start = time.time()
+    for values in rows:
+        statistic = Statistics.from_db('default', field_names, values)
+        if access:
+            statistic._stats
+    return time.time() - start
+
+
+def eager_post_init(sender, instance, **kwargs):
+    # previous behaviour, snapshot was computed for every loaded row
+    instance._stats_snapshot = _get_statistic_stats(instance)
+
+
+def benchmark(sizes='200,50000', n_problems=12, seed=0, repeat=3):
+    sizes = [int(size) for size in str(sizes).split(',')]
+
+    table = PrettyTable(field_names=['n', 'post_init, s', 'lazy, s', 'lazy with access, s',
+                                     'post_init per row, us', 'lazy per row, us', 'speedup'])
+    for n in sizes:
+        field_names, rows = generate_rows(n, n_problems, seed)
+
+        post_init.connect(eager_post_init, sender=Statistics)
+        try:
+            eager = min(load(field_names, rows) for _ in range(repeat))
+        finally:
+            post_init.disconnect(eager_post_init, sender=Statistics)
+        lazy = min(load(field_names, rows) for _ in range(repeat))
+        lazy_access = min(load(field_names, rows, access=True) for _ in range(repeat))
+
+        table.add_row([n, f'{eager:.3f}', f'{lazy:.3f}', f'{lazy_access:.3f}',
+                       f'{eager / n * 1e6:.1f}', f'{lazy / n * 1e6:.1f}', f'{eager / lazy:.1f}x'])
+    print(table)
+
+
+def run(*args):
+    pass_args(benchmark, args)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import io
+from datetime import datetime, timedelta
+
+from django.db import connection, transaction
+
+from submissions.models import Submission, Testing
+
+SUBMISSION_STAGING_TABLE = 'submissions_submission_staging'
+TESTING_STAGING_TABLE = 'submissions_testing_staging'
+
+SUBMISSION_FIELDS = (
+    'account', 'contest', 'statistic', 'secondary_key', 'problem_short', 'problem', 'problem_key', 'contest_time',
+    'language', 'verdict', 'time', 'current_result', 'current_attempt', 'run_time', 'failed_test',
+)
+SUBMISSION_OPTIONAL_FIELDS = ('run_time', 'failed_test')
+SUBMISSION_UPDATE_FIELDS = (
+    'problem', 'problem_key', 'contest_time', 'language', 'verdict', 'time', 'current_result', 'current_attempt',
+)
+TESTING_FIELDS = ('submission', 'secondary_key', 'verdict', 'test_number', 'run_time', 'contest_time', 'time')
+
+
+def format_copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, timedelta):
+        return f'{value.total_seconds()} seconds'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    value = str(value)
+    for old, new in (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')):
+        value = value.replace(old, new)
+    return value
+
+
+def copy_rows(cursor, model, table, fields, rows, extra_columns=()):
+    """Stage rows into temporary table with COPY, values are prepared by model fields."""
+    model_fields = [model._meta.get_field(field) for field in fields]
+    columns = [field.column for field in model_fields] + [column for column, _ in extra_columns]
+    buffer = io.StringIO()
+    for row in rows:
+        values = [field.get_db_prep_save(row.get(field.name), connection) for field in model_fields]
+        values.extend(row.get(column) for column, _ in extra_columns)
+        buffer.write('\t'.join(format_copy_value(value) for value in values))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    definitions = [f'{field.column} {field.db_type(connection)}' for field in model_fields]
+    definitions.extend(f'{column} {db_type}' for column, db_type in extra_columns)
+    cursor.execute(f'CREATE TEMPORARY TABLE IF NOT EXISTS {table} ({", ".join(definitions)})')
+    cursor.execute(f'TRUNCATE {table}')
+    cursor.copy_expert(f'COPY {table} ({", ".join(columns)}) FROM STDIN', buffer)
+    return columns
+
+
+def get_column(model, field):
+    return model._meta.get_field(field).column
+
+
+def ingest_submissions(rows):
+    """Merge submissions of one statistic with one COPY and set-based UPDATE and INSERT.
+
+    Row is a dict with submission fields, `run_time` and `failed_test` are updated only if they are in row,
+    `created_run_time` and `created_failed_test` are used for new submissions if row has not own values.
+
+    Returns dict by (secondary_key, problem_short) with `id`, `created`, `run_time` and `failed_test`.
+    """
+    if not rows:
+        return {}
+
+    staging_rows = []
+    for row in rows:
+        staging_row = dict(row)
+        for field in SUBMISSION_OPTIONAL_FIELDS:
+            staging_row[f'has_{field}'] = field in row
+            if field not in row:
+                staging_row[field] = row.get(f'created_{field}')
+        staging_rows.append(staging_row)
+
+    table = Submission._meta.db_table
+    key_columns = [get_column(Submission, field) for field in ('statistic', 'secondary_key', 'problem_short')]
+    update_columns = [get_column(Submission, field) for field in SUBMISSION_UPDATE_FIELDS]
+    optional_columns = [get_column(Submission, field) for field in SUBMISSION_OPTIONAL_FIELDS]
+    key_condition = ' AND '.join(f's.{column} = t.{column}' for column in key_columns)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        columns = copy_rows(
+            cursor, Submission, SUBMISSION_STAGING_TABLE, SUBMISSION_FIELDS, staging_rows,
+            extra_columns=[(f'has_{field}', 'boolean') for field in SUBMISSION_OPTIONAL_FIELDS],
+        )
+        columns = [column for column in columns if not column.startswith('has_')]
+
+        set_values = [f'{column} = s.{column}' for column in update_columns]
+        set_values.extend(
+            f'{column} = CASE WHEN s.has_{field} THEN s.{column} ELSE t.{column} END'
+            for field, column in zip(SUBMISSION_OPTIONAL_FIELDS, optional_columns)
+        )
+        changed = [f's.{column} IS DISTINCT FROM t.{column}' for column in update_columns]
+        changed.extend(
+            f'(s.has_{field} AND s.{column} IS DISTINCT FROM t.{column})'
+            for field, column in zip(SUBMISSION_OPTIONAL_FIELDS, optional_columns)
+        )
+        cursor.execute(f'''
+            UPDATE {table} AS t SET {", ".join(set_values)}, modified = NOW()
+            FROM {SUBMISSION_STAGING_TABLE} AS s
+            WHERE {key_condition} AND ({" OR ".join(changed)})
+        ''')
+
+        cursor.execute(f'''
+            INSERT INTO {table} ({", ".join(columns)}, created, modified)
+            SELECT {", ".join(f's.{column}' for column in columns)}, NOW(), NOW()
+            FROM {SUBMISSION_STAGING_TABLE} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {table} AS t WHERE {key_condition})
+            ON CONFLICT DO NOTHING
+            RETURNING id
+        ''')
+        created_ids = {pk for pk, in cursor.fetchall()}
+
+        secondary_key, problem_short = key_columns[1:]
+        cursor.execute(f'''
+            SELECT t.id, t.{secondary_key}, t.{problem_short}, {", ".join(f't.{c}' for c in optional_columns)}
+            FROM {table} AS t JOIN {SUBMISSION_STAGING_TABLE} AS s ON {key_condition}
+        ''')
+        ret = {}
+        for pk, key, short, *values in cursor.fetchall():
+            ret[(key, short)] = {'id': pk, 'created': pk in created_ids}
+            ret[(key, short)].update(zip(SUBMISSION_OPTIONAL_FIELDS, values))
+    return ret
+
+
+def ingest_testings(rows):
+    """Upsert testings with one COPY and INSERT ... ON CONFLICT, returns number of created testings."""
+    if not rows:
+        return 0
+
+    table = Testing._meta.db_table
+    key_columns = [get_column(Testing, field) for field in ('submission', 'secondary_key')]
+    with transaction.atomic(), connection.cursor() as cursor:
+        columns = copy_rows(cursor, Testing, TESTING_STAGING_TABLE, TESTING_FIELDS, rows)
+        update_columns = [column for column in columns if column not in key_columns]
+        cursor.execute(f'''
+            INSERT INTO {table} ({", ".join(columns)}, created, modified)
+            SELECT {", ".join(columns)}, NOW(), NOW() FROM {TESTING_STAGING_TABLE}
+            ON CONFLICT ({", ".join(key_columns)}) DO UPDATE
+            SET {", ".join(f'{column} = EXCLUDED.{column}' for column in update_columns)}, modified = NOW()
+            RETURNING xmax = 0
+        ''')
+        return sum(created for created, in cursor.fetchall())
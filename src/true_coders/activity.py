@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from logging import getLogger
+
+from django.core.cache import cache
+from django.db import connection
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from true_coders.models import Coder
+
+ACTIVITY_RECORD_INTERVAL = 60
+ACTIVITY_RECORDED_MAXSIZE = 10000
+ACTIVITY_FLUSH_BATCH_SIZE = 1000
+
+# Remove fields only if they were not updated after reading, so activity recorded during flush is kept.
+REMOVE_FLUSHED_SCRIPT = '''
+local n_removed = 0
+for i = 1, #ARGV, 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+        n_removed = n_removed + redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+return n_removed
+'''
+
+logger = getLogger('coders.activity')
+
+_recorded_activities = OrderedDict()
+
+
+def get_activity_key():
+    return cache.make_key('coders_last_activity')
+
+
+def record_coder_activity(coder_id):
+    """Remember that coder was active now, at most once per interval for each process."""
+    now = time.time()
+    recorded = _recorded_activities.get(coder_id)
+    if recorded is not None and now - recorded < ACTIVITY_RECORD_INTERVAL:
+        return
+    _recorded_activities[coder_id] = now
+    _recorded_activities.move_to_end(coder_id)
+    while len(_recorded_activities) > ACTIVITY_RECORDED_MAXSIZE:
+        _recorded_activities.popitem(last=False)
+    try:
+        get_redis_connection('default').hset(get_activity_key(), coder_id, now)
+    except RedisError as e:
+        logger.warning(f'Failed to record activity of coder {coder_id}: {e}')
+
+
+def flush_coders_activity(batch_size=ACTIVITY_FLUSH_BATCH_SIZE):
+    """Apply recorded activities to coders, each batch is removed from redis only after its update."""
+    redis_connection = get_redis_connection('default')
+    activity_key = get_activity_key()
+    remove_flushed = redis_connection.register_script(REMOVE_FLUSHED_SCRIPT)
+    activities = sorted(redis_connection.hgetall(activity_key).items(), key=lambda item: int(item[0]))
+    table = Coder._meta.db_table
+    n_updated = 0
+    with connection.cursor() as cursor:
+        for offset in range(0, len(activities), batch_size):
+            batch = activities[offset:offset + batch_size]
+            values = ', '.join(['(%s, %s)'] * len(batch))
+            params = []
+            for coder_id, timestamp in batch:
+                params.extend([int(coder_id), datetime.fromtimestamp(float(timestamp), tz=timezone.utc)])
+            cursor.execute(f'''
+                UPDATE {table} AS coder SET last_activity = activity.last_activity
+                FROM (VALUES {values}) AS activity (id, last_activity)
+                WHERE coder.id = activity.id
+                AND (coder.last_activity IS NULL OR coder.last_activity < activity.last_activity)
+            ''', params)
+            n_updated += cursor.rowcount
+            remove_flushed(keys=[activity_key], args=[value for item in batch for value in item])
+    return len(activities), n_updated
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+from logging import getLogger
+
+from django.core.management.base import BaseCommand
+
+from true_coders.activity import ACTIVITY_FLUSH_BATCH_SIZE, flush_coders_activity
+from utils.attrdict import AttrDict
+from utils.logger import suppress_db_logging_context
+
+
+class Command(BaseCommand):
+    help = 'Flush coders last activity collected by middleware'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = getLogger('coders.flush_coders_activity')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=ACTIVITY_FLUSH_BATCH_SIZE, help='coders per update')
+
+    def handle(self, *args, **options):
+        args = AttrDict(options)
+        with suppress_db_logging_context():
+            n_activities, n_updated = flush_coders_activity(batch_size=args.batch_size)
+        if n_activities:
+            self.logger.info(f'Flushed {n_activities} activities, updated {n_updated} coders')
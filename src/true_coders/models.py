@@ -92,48 +92,7 @@ class Coder(BaseModel):
         hide = Q()
         show = Q()
         for filter_ in filters:
-            query = Q()
-            if filter_.resources:
-                query &= Q(resource__id__in=filter_.resources)
-            if filter_.duration_from:
-                seconds = timedelta(minutes=filter_.duration_from).total_seconds()
-                query &= Q(duration_in_secs__gte=seconds)
-            if filter_.duration_to:
-                seconds = timedelta(minutes=filter_.duration_to).total_seconds()
-                query &= Q(duration_in_secs__lte=seconds)
-            if filter_.start_time_from:
-                minutes = filter_.start_time_from * 60
-                hours = minutes // 60
-                minutes = minutes % 60
-                query &= Q(start_time__hour__gt=hours) | Q(start_time__hour=hours, start_time__minute__gte=minutes)
-            if filter_.start_time_to:
-                minutes = filter_.start_time_to * 60
-                hours = minutes // 60
-                minutes = minutes % 60
-                query &= Q(start_time__hour__lt=hours) | Q(start_time__hour=hours, start_time__minute__lte=minutes)
-            if filter_.regex:
-                field = 'title'
-                regex = filter_.regex
-
-                match = re.search(r'^(?P<field>[a-z]+):(?P<sep>.)(?P<regex>.+)(?P=sep)$', filter_.regex)
-                if match:
-                    f = match.group('field')
-                    if f in ('url',):
-                        field = f
-                        regex = match.group('regex')
-                query_regex = Q(**{f'{field}__regex': regex})
-                if filter_.inverse_regex:
-                    query_regex = ~query_regex
-                query &= query_regex
-            if filter_.host:
-                query &= Q(host=filter_.host)
-            if filter_.week_days:
-                query &= Q(start_time__week_day__in=filter_.week_days)
-            if filter_.contest_id:
-                query &= Q(pk=filter_.contest_id)
-            if filter_.party_id:
-                query &= Q(ratings__party_id=filter_.party_id)
-
+            query = filter_.get_contest_query()
             if filter_.to_show:
                 show |= query
             else:
@@ -326,8 +285,10 @@ class CoderProblem(BaseModel):
 def init_coder_username(instance, **kwargs):
     if not instance.username:
         instance.username = instance.user.username
-    if 'api_throttle_at' in instance.settings:
-        limit_key = str(instance.username) + '[limit]'
+    limit_key = str(instance.username) + '[limit]'
+    cached_throttle_at = cache.get(limit_key)
+    throttle_at = instance.settings.get('api_throttle_at', django_settings.DEFAULT_API_THROTTLE_AT_)
+    if cached_throttle_at is not None and cached_throttle_at != throttle_at:
         cache.delete(limit_key)
 
 
@@ -453,6 +414,97 @@ class Filter(BaseModel):
             ret['party__name'] = self.party.name
         return ret
 
+    def get_contest_query(self):
+        """Condition on contests of this filter, empty for filter without conditions."""
+        query = Q()
+        if self.resources:
+            query &= Q(resource__id__in=self.resources)
+        if self.duration_from:
+            seconds = timedelta(minutes=self.duration_from).total_seconds()
+            query &= Q(duration_in_secs__gte=seconds)
+        if self.duration_to:
+            seconds = timedelta(minutes=self.duration_to).total_seconds()
+            query &= Q(duration_in_secs__lte=seconds)
+        if self.start_time_from:
+            minutes = self.start_time_from * 60
+            hours = minutes // 60
+            minutes = minutes % 60
+            query &= Q(start_time__hour__gt=hours) | Q(start_time__hour=hours, start_time__minute__gte=minutes)
+        if self.start_time_to:
+            minutes = self.start_time_to * 60
+            hours = minutes // 60
+            minutes = minutes % 60
+            query &= Q(start_time__hour__lt=hours) | Q(start_time__hour=hours, start_time__minute__lte=minutes)
+        if self.regex:
+            field = 'title'
+            regex = self.regex
+
+            match = re.search(r'^(?P<field>[a-z]+):(?P<sep>.)(?P<regex>.+)(?P=sep)$', self.regex)
+            if match:
+                f = match.group('field')
+                if f in ('url',):
+                    field = f
+                    regex = match.group('regex')
+            query_regex = Q(**{f'{field}__regex': regex})
+            if self.inverse_regex:
+                query_regex = ~query_regex
+            query &= query_regex
+        if self.host:
+            query &= Q(host=self.host)
+        if self.week_days:
+            query &= Q(start_time__week_day__in=self.week_days)
+        if self.contest_id:
+            query &= Q(pk=self.contest_id)
+        if self.party_id:
+            query &= Q(ratings__party_id=self.party_id)
+        return query
+
+    def get_contest_predicate(self):
+        """Same condition as Coder.get_contest_filter builds for this filter, but checked in memory.
+
+        Contest is expected to have `party_ids` attribute if filter has party.
+        Returns None for filter without conditions, its empty query is skipped by Coder.get_contest_filter.
+        Regex is evaluated by database with its own syntax, so filter with regex has to use get_contest_query.
+        """
+        if self.regex:
+            raise ValueError('Filter with regex can not be checked in memory')
+        checks = []
+        if self.resources:
+            resources = set(self.resources)
+            checks.append(lambda c: c.resource_id in resources)
+        if self.duration_from:
+            duration_from = timedelta(minutes=self.duration_from).total_seconds()
+            checks.append(lambda c: c.duration_in_secs is not None and c.duration_in_secs >= duration_from)
+        if self.duration_to:
+            duration_to = timedelta(minutes=self.duration_to).total_seconds()
+            checks.append(lambda c: c.duration_in_secs is not None and c.duration_in_secs <= duration_to)
+        if self.start_time_from:
+            start_time_from = divmod(self.start_time_from * 60, 60)
+            checks.append(lambda c: self.get_start_hour_minute(c) >= start_time_from)
+        if self.start_time_to:
+            start_time_to = divmod(self.start_time_to * 60, 60)
+            checks.append(lambda c: self.get_start_hour_minute(c) <= start_time_to)
+        if self.host:
+            checks.append(lambda c: c.host == self.host)
+        if self.week_days:
+            week_days = set(self.week_days)
+            checks.append(lambda c: timezone.localtime(c.start_time).isoweekday() % 7 + 1 in week_days)
+        if self.contest_id:
+            checks.append(lambda c: c.pk == self.contest_id)
+        if self.party_id:
+            checks.append(lambda c: self.party_id in c.party_ids)
+        if not checks:
+            return None
+
+        def predicate(contest):
+            return all(check(contest) for check in checks)
+        return predicate
+
+    @staticmethod
+    def get_start_hour_minute(contest):
+        start_time = timezone.localtime(contest.start_time)
+        return start_time.hour, start_time.minute
+
     class Meta:
         indexes = [
             models.Index(fields=['coder']),
@@ -35,7 +35,7 @@ from sql_util.utils import Exists, SubqueryCount, SubqueryMax, SubquerySum
 from tastypie.models import ApiKey
 
 from clist.models import Contest, ContestSeries, ProblemTag, Promotion, Resource
-from clist.templatetags.extras import (accounts_split, allowed_redirect, as_number, asfloat, format_time,
+from clist.templatetags.extras import (accounts_split, allowed_redirect, as_number, format_time,
                                        get_division_problems, get_item, get_problem_short, get_timezones,
                                        has_update_statistics_permission, is_rating_prediction_field, is_yes,
                                        query_transform, quote_url, relative_url)
@@ -52,8 +52,8 @@ from notification.models import Calendar, NotificationMessage, Subscription
 from notification.utils import compose_message_by_problems, compose_message_by_submissions, send_messages
 from pyclist.decorators import context_pagination, pagination_login_required
 from pyclist.middleware import RedirectException
-from ranking.models import (Account, AccountRenaming, AccountVerification, Module, Rating, Statistics, VerifiedAccount,
-                            VirtualStart)
+from ranking.models import (Account, AccountRenaming, AccountVerification, Module, Rating, RatingHistory, Statistics,
+                            VerifiedAccount, VirtualStart)
 from tg.bot import Bot
 from tg.models import Chat
 from true_coders.models import AccessLevel, Coder, CoderList, Filter, ListGroup, ListValue, Organization, Party
@@ -692,40 +692,35 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
         if username is not None:
             coder = get_object_or_404(Coder, username=username)
             statistics = Statistics.objects.filter(account__coders=coder)
+            histories = RatingHistory.objects.filter(account__coders=coder)
             with_global = django_settings.ENABLE_GLOBAL_RATING_
         else:
             resource = get_object_or_404(Resource, host=host)
             account = get_object_or_404(Account, key=key, resource=resource)
             statistics = Statistics.objects.filter(account=account)
+            histories = RatingHistory.objects.filter(account=account)
         resource = request.GET.get('resource')
         if resource:
             statistics = statistics.filter(contest__resource__host=resource)
+            histories = histories.filter(resource__host=resource)
+    else:
+        histories = RatingHistory.objects.filter(statistic__in=statistics.values('pk'))
 
     resources = {r.pk: r for r in Resource.objects.filter(has_rating_history=True)}
+    minimal = is_yes(request.GET.get('minimal'))
 
-    base_qs = (
-        statistics
-        .annotate(date=F('contest__end_time'))
+    qs = (
+        histories
         .annotate(name=F('contest__title'))
         .annotate(key=F('contest__key'))
         .annotate(kind=F('contest__kind'))
-        .annotate(score=F('solving'))
-        .annotate(solved=IntegerJSONF('addition__solved__solving'))
-        .annotate(division=KeyTextTransform('division', 'addition'))
         .annotate(n_problems=F('contest__n_problems'))
         .annotate(division_n_problems=JsonJSONF('contest__info__problems__n_problems'))
         .annotate(cid=F('contest_id'))
-        .annotate(sid=F('pk'))
-        .filter(contest__is_rated=True)
-        .order_by('date')
-    )
-
-    qs = (
-        base_qs
-        .annotate(rating_change=Cast(KeyTextTransform('rating_change', 'addition'), IntegerField()))
-        .annotate(new_rating=Cast(KeyTextTransform('new_rating', 'addition'), IntegerField()))
-        .annotate(old_rating=Cast(KeyTextTransform('old_rating', 'addition'), IntegerField()))
+        .annotate(sid=F('statistic_id'))
         .annotate(is_unrated=Cast(KeyTextTransform('is_unrated', 'contest__info'), IntegerField()))
+        .filter(contest__is_rated=True, resource__in=list(resources))
+        .order_by('date')
     )
 
     qs_values = (
@@ -733,11 +728,11 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
         'new_rating', 'old_rating', 'rating_change', 'is_unrated',
         'place', 'score',
     )
-    if not is_yes(request.GET.get('minimal')):
+    if not minimal:
         qs_values += (
             'division', 'solved',
             'n_problems', 'division_n_problems',
-            'addition___rating_data', 'addition',
+            'has_rating_data', 'values',
         )
 
     qs = qs.values(*qs_values)
@@ -749,35 +744,42 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
 
     ratings['data']['resources'] = {}
 
-    def dict_to_float_values(data):
-        ret = {}
-        for k, v in data.items():
-            if k.startswith('_') or k in django_settings.ADDITION_HIDE_FIELDS_ or isinstance(v, (list, tuple)):
-                continue
-            if isinstance(v, dict):
-                d = dict_to_float_values(v)
-                for subk, subv in d.items():
-                    ret[f'{k}__{subk}'] = subv
-                continue
-            if isinstance(v, str):
-                v = asfloat(v)
-            if v is None:
-                continue
-            ret[k] = v
-        return ret
-
     qs = [
         stat for stat in qs if (
-            stat['resource'] in resources and
-            (stat['new_rating'] or stat.get('addition___rating_data')) and
+            (stat['new_rating'] or stat.get('has_rating_data')) and
             not stat['is_unrated']
         )
     ]
     n_resources = len({stat['resource'] for stat in qs})
+    if n_resources > 1:
+        qs = [stat for stat in qs if not stat.get('has_rating_data')]
+
+    rating_data_ids = [stat['sid'] for stat in qs if stat.get('has_rating_data')]
+    rating_datas = dict(
+        Statistics.objects.filter(pk__in=rating_data_ids).values_list('pk', 'addition___rating_data')
+    ) if rating_data_ids else {}
+    for stat in qs:
+        if stat.pop('has_rating_data', False):
+            stat['addition___rating_data'] = rating_datas.get(stat['sid'])
+        if minimal:
+            stat['values'] = RatingHistory.dict_to_float_values({'place': stat['place'], 'score': stat['score']})
 
     if with_global:
         global_qs = (
-            base_qs
+            statistics
+            .annotate(date=F('contest__end_time'))
+            .annotate(name=F('contest__title'))
+            .annotate(key=F('contest__key'))
+            .annotate(kind=F('contest__kind'))
+            .annotate(score=F('solving'))
+            .annotate(solved=IntegerJSONF('addition__solved__solving'))
+            .annotate(division=KeyTextTransform('division', 'addition'))
+            .annotate(n_problems=F('contest__n_problems'))
+            .annotate(division_n_problems=JsonJSONF('contest__info__problems__n_problems'))
+            .annotate(cid=F('contest_id'))
+            .annotate(sid=F('pk'))
+            .filter(contest__is_rated=True)
+            .order_by('date')
             .annotate(rating_change=F('global_rating_change'))
             .annotate(new_rating=F('new_global_rating'))
             .annotate(old_rating=Value(None, IntegerField(null=True)))
@@ -785,18 +787,18 @@ def get_ratings_data(request, username=None, key=None, host=None, statistics=Non
             .annotate(is_unrated=Value(0, IntegerField()))
             .filter(new_rating__isnull=False)
         )
-        qs.extend(global_qs.values(*qs_values))
+        global_values = tuple(v for v in qs_values if v not in ('has_rating_data', 'values'))
+        if not minimal:
+            global_values += ('addition',)
+        for stat in global_qs.values(*global_values):
+            addition = stat.pop('addition', {})
+            for field, out in (('solved', 'n_solved'), ('place', 'place'), ('score', 'score')):
+                if field in stat:
+                    addition[out] = stat[field]
+            stat['values'] = RatingHistory.dict_to_float_values(addition)
+            qs.append(stat)
 
     for stat in qs:
-        if stat.get('addition___rating_data') and n_resources > 1:
-            continue
-
-        addition = stat.pop('addition', {})
-        for field, out in (('solved', 'n_solved'), ('place', 'place'), ('score', 'score')):
-            if field in stat:
-                addition[out] = stat[field]
-        stat['values'] = dict_to_float_values(addition)
-
         if stat['resource'] == 0:  # global rating
             resource = None
             default_info = dict(django_settings.CLIST_RESOURCE_DICT_)
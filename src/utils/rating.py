@@ -3,8 +3,13 @@
 
 from datetime import datetime, timedelta
 
+import numpy as np
 from pytz import utc
 
+RATING_LEFT = 0
+RATING_RIGHT = 5000
+RATING_N_STEPS = 14
+
 
 def get_n_contests_weight(n_contests):
     return 1 - 0.9 ** n_contests
@@ -19,10 +24,10 @@ def get_last_activity_weight(last_activity, base=None):
 
 
 def get_weighted_rating(wratings, target, threshold=0.95, cache=None) -> float:
-    left = 0
-    right = 5000
+    left = RATING_LEFT
+    right = RATING_RIGHT
 
-    for _ in range(14):
+    for _ in range(RATING_N_STEPS):
         middle = (left + right) / 2
 
         if cache is not None and middle in cache:
@@ -59,6 +64,50 @@ def get_weighted_rating(wratings, target, threshold=0.95, cache=None) -> float:
     return rating
 
 
+class WeightedRatingGrid:
+    """
+    Vectorized get_weighted_rating for many targets over the same wratings.
+
+    All bisection midpoints of get_weighted_rating lie on the fixed grid with step
+    (RATING_RIGHT - RATING_LEFT) / 2 ** RATING_N_STEPS, so e_total, positive_prob and negative_prob
+    are computed for the whole grid once and every lookup is a binary search over these arrays.
+    """
+
+    def __init__(self, wratings, threshold=0.95, chunk_size=2 ** 22):
+        weights, ratings = np.array(wratings, dtype=np.float64).reshape(-1, 2).T
+        n_grid = 2 ** RATING_N_STEPS + 1
+        self.grid = np.linspace(RATING_LEFT, RATING_RIGHT, n_grid)
+        middles = self.grid[1:-1]
+
+        middles_powers = 10 ** (middles / 400)
+        ratings_powers = 10 ** (-ratings / 400)
+
+        e_total = np.empty(len(middles))
+        positive_prob = np.empty(len(middles))
+        negative_prob = np.empty(len(middles))
+        step = max(chunk_size // max(len(ratings), 1), 1)
+        for offset in range(0, len(middles), step):
+            chunk = slice(offset, offset + step)
+            e = 1 / (1 + np.outer(middles_powers[chunk], ratings_powers))
+            e_total[chunk] = e @ weights
+            positive_prob[chunk] = np.prod(e, axis=1)
+            negative_prob[chunk] = np.prod(1 - e, axis=1)
+
+        self.neg_e_total = -e_total
+        n_middles = len(middles)
+        if threshold:
+            self.first_unblocked = np.count_nonzero(positive_prob > threshold)
+            self.first_forced = n_middles - np.count_nonzero(negative_prob > threshold)
+        else:
+            self.first_unblocked = 0
+            self.first_forced = n_middles
+
+    def get(self, target) -> float:
+        first_target = np.searchsorted(self.neg_e_total, -target, side='right')
+        index = max(self.first_unblocked, min(self.first_forced, first_target))
+        return float(self.grid[index] + self.grid[index + 1]) / 2
+
+
 def get_rating(ratings) -> float:
     wratings = [(1, r) for r in ratings]
     return get_weighted_rating(wratings, 0.5)
@@ -2,8 +2,10 @@
 # -*- coding: utf-8 -*-
 
 
+import asyncio
 import atexit
 import copy
+import functools
 import html
 import json
 import logging
@@ -21,7 +23,8 @@ import urllib.error
 import urllib.parse
 import urllib.request
 import zlib
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
 from datetime import datetime, timedelta
 from distutils.util import strtobool
 from gzip import GzipFile
@@ -29,8 +32,8 @@ from hashlib import md5
 from http.cookiejar import Cookie, MozillaCookieJar
 from io import BytesIO
 from json import dumps, load, loads
-from os import environ, listdir, makedirs, path, remove, stat
-from os.path import getctime, isdir
+from os import environ, listdir, makedirs, path, remove
+from os.path import isdir
 from random import choice, gauss
 from string import ascii_letters, digits
 from sys import stderr
@@ -42,6 +45,7 @@ from filelock import FileLock
 from requests.models import Response
 
 from utils.proxy_list import ProxyList
+from utils.requester.cache import ResponseCache
 
 logging.getLogger('chardet.charsetprober').setLevel(logging.INFO)
 logger = logging.getLogger('utils.requester')
@@ -115,6 +119,9 @@ class NoVerifyWord(Exception):
 class Proxer():
     DIVIDER = 3
     LIMIT_TIME = float(environ.get('PROXY_LIMIT_TIME', 3))
+    EWMA_ALPHA = 0.3
+    EWMA_DEFAULT_SUCCESS = 0.5
+    JOURNAL_COMPACT_SIZE = 1000
 
     def load_data(self):
         try:
@@ -125,18 +132,41 @@ class Proxer():
         self._data.setdefault('proxies', {})
         self._data.setdefault('sources', {})
         self._data.setdefault('deferred', {})
+        self.load_journal()
 
         env_proxy = environ.get('REQUESTER_PROXY')
         if env_proxy and re.match(r'^[0-9]+\.+[0-9]+\.+[0-9]+\.+[0-9]+:[0-9]+$', env_proxy):
             self._data['proxies'] = {}
             self.add(env_proxy)
+            self.need_compact = True
 
         if environ.get('REQUESTER_PROXY_CLEAR'):
             self._data['proxies'] = {}
+            self.need_compact = True
 
         for proxy in self.proxies.values():
             self.init_proxy(proxy)
 
+    def load_journal(self):
+        self.n_journal = 0
+        if not path.exists(self.journal_file_name):
+            return
+        with open(self.journal_file_name, 'r') as fo:
+            for line in fo:
+                try:
+                    record = loads(line)
+                except ValueError:
+                    continue
+                section = self._data.setdefault(record['section'], {})
+                if record['value'] is None:
+                    section.pop(record['key'], None)
+                else:
+                    section[record['key']] = record['value']
+                self.n_journal += 1
+
+    def mark_dirty(self, section, key):
+        self.dirty.add((section, key))
+
     def clear_data(self):
         created_threshold = self.get_timestamp() - 60 * 60
         removed = []
@@ -145,6 +175,7 @@ class Proxer():
                 removed.append(k)
         for k in removed:
             del self.proxies[k]
+            self.mark_dirty('proxies', k)
         self.print(f'remove {len(removed)} proxies')
 
     @property
@@ -155,24 +186,35 @@ class Proxer():
     def sources(self):
         return self._data['sources']
 
-    def defer_proxy(self):
-        success = self.proxy.pop('_success')
+    def defer_proxy(self, key):
+        proxy = self.proxies[key]
+        success = proxy.pop('_success')
         if success:
-            self.proxy['_n_deferred'] = self.n_deferred
+            proxy['_n_deferred'] = self.n_deferred
         else:
-            self.proxy['_n_deferred'] -= 1
-        self._data['deferred'][self.proxy_key] = self.proxy
+            proxy['_n_deferred'] -= 1
+        self._data['deferred'][key] = proxy
+        self.mark_dirty('deferred', key)
 
-    def check_proxy(self):
+    def check_proxy(self, key=None):
         with self.lock:
-            if (self.proxy and self.proxy['_fail'] > 0 and self.proxy['_state'] == 0 or self.is_slow_proxy()):
-                if (self.proxy['_success'] or self.proxy['_total_success']) and self.proxy['_n_deferred']:
+            if key is None:
+                key = self.proxy_key
+            proxy = self.proxies.get(key) if key else None
+            if not proxy:
+                return
+            if proxy['_fail'] > 0 and proxy['_state'] == 0 or self.is_slow_proxy(proxy):
+                if (proxy['_success'] or proxy['_total_success']) and proxy['_n_deferred']:
                     message = 'defer'
-                    self.defer_proxy()
+                    self.defer_proxy(key)
                 else:
                     message = 'remove'
-                self.print(f'{message} {self.proxy_key}, info = {self.proxy}')
-                del self.proxies[self.proxy_key]
+                self.print(f'{message} {key}, info = {proxy}')
+                del self.proxies[key]
+                self.mark_dirty('proxies', key)
+                self.in_use.pop(key, None)
+                if key != self.proxy_key:
+                    return
                 self.proxy = None
                 self.proxy_key = None
                 self.save_data()
@@ -188,30 +230,44 @@ class Proxer():
     def save_data(self):
         with self.lock:
             self.check_proxy()
-            j = dumps(
-                self._data,
-                indent=2,
-                sort_keys=True,
-                ensure_ascii=False,
-            )
             os.makedirs(path.dirname(self.file_name), exist_ok=True)
-            with open(self.file_name, 'w') as fo:
-                fo.write(j)
+            if self.need_compact or self.n_journal + len(self.dirty) > self.JOURNAL_COMPACT_SIZE:
+                j = dumps(
+                    self._data,
+                    indent=2,
+                    sort_keys=True,
+                    ensure_ascii=False,
+                )
+                with open(self.file_name, 'w') as fo:
+                    fo.write(j)
+                open(self.journal_file_name, 'w').close()
+                self.n_journal = 0
+                self.need_compact = False
+            elif self.dirty:
+                with open(self.journal_file_name, 'a') as fo:
+                    for section, key in self.dirty:
+                        value = self._data[section].get(key)
+                        fo.write(dumps({'section': section, 'key': key, 'value': value}, ensure_ascii=False) + '\n')
+                self.n_journal += len(self.dirty)
+            self.dirty.clear()
 
             self.dump_proxy()
 
-    def is_slow_proxy(self):
-        if self.proxy and self.proxy.get('_total_count', 0) > 9:
-            time = self.time_response()
+    def is_slow_proxy(self, proxy=None):
+        proxy = proxy or self.proxy
+        if proxy and proxy.get('_total_count', 0) > 9:
+            time = self.time_response(proxy)
             return time > self.time_limit
 
     @staticmethod
     def get_timestamp():
         return int(datetime.utcnow().strftime('%s'))
 
-    @staticmethod
-    def get_score(proxy):
-        return (proxy['_state'], -proxy['_timestamp'])
+    def get_score(self, proxy, host=None):
+        stats = proxy.get('_hosts', {}).get(host) or proxy
+        success = stats.get('_ewma_success', self.EWMA_DEFAULT_SUCCESS)
+        time = stats.get('_ewma_time') or self.time_limit / 2
+        return (round(success / time, 1), -proxy['_timestamp'])
 
     def init_proxy(self, proxy):
         proxy.setdefault('_state', 0)
@@ -231,6 +287,7 @@ class Proxer():
         value = self.proxies.setdefault(key, {})
         value.update(proxy)
         self.init_proxy(value)
+        self.mark_dirty('proxies', key)
 
     def add_free_proxies(self):
         for proxy in ProxyList().get():
@@ -240,8 +297,10 @@ class Proxer():
         deferred_proxies = self._data.pop('deferred', {})
         self._data['deferred'] = {}
 
-        for proxy in deferred_proxies.values():
+        for key, proxy in deferred_proxies.items():
             self.init_proxy(proxy)
+            self.mark_dirty('proxies', key)
+            self.mark_dirty('deferred', key)
 
         self.proxies.update(deferred_proxies)
 
@@ -259,7 +318,7 @@ class Proxer():
         except Exception:
             return None
 
-    def get(self):
+    def take_proxy(self, host=None, exclude_in_use=False):
         if self.n_limit is not None:
             if self.n_limit <= 0:
                 raise ProxyLimitReached()
@@ -268,61 +327,102 @@ class Proxer():
         if not self.proxies:
             self.add_proxies()
 
-        self.proxy = None
+        best_key, best_score = None, None
         for k, v in self.proxies.items():
-            if self.proxy is None or self.get_score(v) > self.get_score(self.proxy):
-                self.proxy = v
-                self.proxy_key = k
-        if not self.proxy:
+            score = self.get_score(v, host)
+            if exclude_in_use:
+                score = (-self.in_use.get(k, 0), score)
+            if best_key is None or score > best_score:
+                best_key, best_score = k, score
+        if best_key is None:
             raise NotFoundProxy()
-        self.proxy['_timestamp'] = self.get_timestamp()
+        self.proxies[best_key]['_timestamp'] = self.get_timestamp()
+        return best_key
+
+    def get(self):
+        with self.lock:
+            self.proxy_key = self.take_proxy()
+            self.proxy = self.proxies[self.proxy_key]
         ret = self.proxy_address
         self.print(f'get = {ret} of {len(self)} (limit = {self.n_limit}), time = {self.time_response()}')
         return ret
 
-    def update_value(self, key, value):
-        self.proxy.setdefault(key, 0)
-        self.proxy[key] += value
-        if 'source' in self.proxy:
-            source = self.sources.setdefault(self.proxy['source'], {})
+    def acquire(self, host=None):
+        """Take the best proxy for host which is used by the least number of workers."""
+        with self.lock:
+            key = self.take_proxy(host=host, exclude_in_use=True)
+            self.in_use[key] = self.in_use.get(key, 0) + 1
+        self.print(f'acquire = {key} of {len(self)} for {host}, in use = {self.in_use[key]}')
+        return key
+
+    def release(self, proxy):
+        with self.lock:
+            if self.in_use.get(proxy):
+                self.in_use[proxy] -= 1
+
+    def update_value(self, key, value, proxy=None):
+        proxy = proxy or self.proxy
+        proxy.setdefault(key, 0)
+        proxy[key] += value
+        if 'source' in proxy:
+            source = self.sources.setdefault(proxy['source'], {})
             source.setdefault(key, 0)
             source[key] += value
             if source.get('_total_count') and source.get('_total_time'):
                 source['_avg_time'] = round(source['_total_time'] / source['_total_count'], 3)
-
-    def ok(self, proxy, time_response=None):
+            self.mark_dirty('sources', proxy['source'])
+
+    def update_ewma(self, proxy, success, delta_time=None, host=None):
+        stats = [proxy]
+        if host:
+            stats.append(proxy.setdefault('_hosts', {}).setdefault(host, {}))
+        for stat in stats:
+            prev = stat.get('_ewma_success', self.EWMA_DEFAULT_SUCCESS)
+            stat['_ewma_success'] = round(prev + self.EWMA_ALPHA * (success - prev), 4)
+            if delta_time is not None:
+                prev = stat.get('_ewma_time', delta_time)
+                stat['_ewma_time'] = round(prev + self.EWMA_ALPHA * (delta_time - prev), 4)
+
+    def ok(self, proxy, time_response=None, host=None):
         with self.lock:
-            if not self.proxy or proxy != self.proxy_address:
+            value = self.proxies.get(proxy)
+            if not value:
                 return
-            self.proxy['_state'] += 1
-            self.proxy['_total_success'] += 1
-            self.update_value('_success', 1)
-            if self.proxy['_success'] == 1:
+            value['_state'] += 1
+            value['_total_success'] += 1
+            self.update_value('_success', 1, value)
+            if value is self.proxy and value['_success'] == 1:
                 self.dump_proxy()
             if time_response:
                 delta_time = time_response.total_seconds() + time_response.microseconds / 1000000.
-                self.update_value('_total_count', 1)
-                self.update_value('_total_time', delta_time)
-                self.proxy['_avg_time'] = self.time_response()
-            self.print(f'ok, {time_response} with average {self.time_response()}')
-            self.check_proxy()
-
-    def fail(self, proxy, force=False) -> bool:
+                self.update_value('_total_count', 1, value)
+                self.update_value('_total_time', delta_time, value)
+                value['_avg_time'] = self.time_response(value)
+            self.update_ewma(value, 1, time_response.total_seconds() if time_response else None, host)
+            self.mark_dirty('proxies', proxy)
+            self.print(f'ok {proxy}, {time_response} with average {self.time_response(value)}')
+            self.check_proxy(proxy)
+
+    def fail(self, proxy, force=False, host=None) -> bool:
         with self.lock:
-            if not self.proxy or proxy != self.proxy_address:
+            value = self.proxies.get(proxy)
+            if not value:
                 return False
             if force:
-                self.proxy['_state'] = 0
+                value['_state'] = 0
             else:
-                self.proxy['_state'] //= self.DIVIDER
-            self.proxy['_total_fail'] += 1
-            self.update_value('_fail', 1)
-            self.check_proxy()
+                value['_state'] //= self.DIVIDER
+            value['_total_fail'] += 1
+            self.update_value('_fail', 1, value)
+            self.update_ewma(value, 0, host=host)
+            self.mark_dirty('proxies', proxy)
+            self.check_proxy(proxy)
             return True
 
-    def time_response(self):
-        if self.proxy and self.proxy.get('_total_count', 0):
-            return round(self.proxy['_total_time'] / self.proxy['_total_count'], 3)
+    def time_response(self, proxy=None):
+        proxy = proxy or self.proxy
+        if proxy and proxy.get('_total_count', 0):
+            return round(proxy['_total_time'] / proxy['_total_count'], 3)
 
     def print(self, *args):
         if self.logger:
@@ -362,6 +462,12 @@ class Proxer():
     ):
         self.logger = logger
         self.file_name = file_name + '.json'
+        self.journal_file_name = file_name + '.jsonl'
+        self.dirty = set()
+        self.need_compact = False
+        self.in_use = {}
+        self.proxy_key = None
+        self.lock = threading.RLock()
         self.time_limit = time_limit
         self.n_limit = n_limit
         self.n_deferred = n_deferred
@@ -381,7 +487,6 @@ class Proxer():
                     self.add(line)
             open(file_name, 'w').close()
         self.proxy = None
-        self.lock = threading.RLock()
 
     def __len__(self):
         return len(self.proxies)
@@ -522,6 +627,29 @@ def curl_response(url, headers=None, cookie_file=None, curl_args=None, post=None
     return response
 
 
+class HostRateLimiter:
+    """Spreads requests to the same host evenly by the rate in requests per second."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_time = {}
+
+    def get_interval(self, host):
+        rate = self.rate.get(host) if isinstance(self.rate, dict) else self.rate
+        return 1 / rate if rate else 0
+
+    async def wait(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        interval = self.get_interval(host)
+        if not interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start_time = max(now, self.next_time.get(host, now))
+        self.next_time[host] = start_time + interval
+        if start_time > now:
+            await asyncio.sleep(start_time - now)
+
+
 class requester():
     cache_timeout = 10940
     caching = True
@@ -537,6 +665,8 @@ class requester():
     time_sleep = 1e-1
     limit_file_cache = 200
     counter_file_cache = 0
+    cache_max_size = int(environ.get('REQUESTER_CACHE_MAX_SIZE', 2 ** 30))
+    pooled_proxy = None
     verify_word = None
     n_attempts = int(environ.get('REQUESTER_N_ATTEMPTS', 1))
     attempt_delay = int(environ.get('REQUESTER_ATTEMPT_DELAY', 2))
@@ -586,7 +716,11 @@ class requester():
                 self.cookiejar.load(ignore_discard=True, ignore_expires=True)
         else:
             self.cookiejar = MozillaCookieJar()
+        self.opener = self.build_opener()
+        self.proxer = None
+        self.proxy = None
 
+    def build_opener(self, proxy=None):
         http_cookie_processor = urllib.request.HTTPCookieProcessor(self.cookiejar)
         context = ssl.create_default_context()
         context.set_ciphers('DEFAULT')
@@ -594,9 +728,10 @@ class requester():
             context.check_hostname = False
             context.verify_mode = ssl.CERT_NONE
         https_handler = urllib.request.HTTPSHandler(context=context)
-        self.opener = urllib.request.build_opener(http_cookie_processor, https_handler)
-        self.proxer = None
-        self.proxy = None
+        opener = urllib.request.build_opener(http_cookie_processor, https_handler)
+        if proxy:
+            opener.add_handler(urllib.request.ProxyHandler({'http': proxy, 'https': proxy}))
+        return opener
 
     def set_proxy(self, proxy, filepath_proxies=default_filepath_proxies, **kwargs):
         if proxy is True or proxy == 'true':
@@ -616,11 +751,26 @@ class requester():
             if self.proxer:
                 self.proxer.connect(req=self, set_proxy=set_proxy)
 
-    def proxy_fail(self, proxy=None, force=False) -> bool:
+    def proxy_fail(self, proxy=None, force=False, host=None) -> bool:
         if self.proxer:
-            return self.proxer.fail(proxy=proxy or self.proxy, force=force) and not self.proxer.without_new_proxy
+            failed = self.proxer.fail(proxy=proxy or self.proxy, force=force, host=host)
+            if failed and self.pooled_proxy and self.proxy not in self.proxer.proxies:
+                self.acquire_proxy(host=host)
+            return failed and not self.proxer.without_new_proxy
         return False
 
+    def acquire_proxy(self, host=None):
+        if self.pooled_proxy:
+            self.proxer.release(self.pooled_proxy)
+        self.pooled_proxy = self.proxer.acquire(host=host)
+        self.proxy = self.pooled_proxy
+        self.opener = self.build_opener(proxy=self.proxy)
+
+    def release_proxy(self):
+        if self.pooled_proxy:
+            self.proxer.release(self.pooled_proxy)
+            self.pooled_proxy = None
+
     def get(
         self,
         url,
@@ -680,28 +830,23 @@ class requester():
 
         try:
             file_cache = ''.join((
-                self.dir_cache,
                 md5((md5_file_cache or url + (post_urlencoded or "")).encode()).hexdigest(),
                 ("/" + url[url.find("//") + 2:].split("?", 2)[0]).replace("/", "_"),
-                ".html",
             ))
         except Exception:
             file_cache = None
 
         caching = file_cache and caching and self.cache_timeout > 0
 
-        from_cache = caching
+        cache_entry, from_cache = None, False
         if caching:
-            if not path.isfile(file_cache):
-                from_cache = False
-            else:
-                diff_time = datetime.now() - datetime.fromtimestamp(path.getctime(file_cache))
-                from_cache = diff_time.seconds < self.cache_timeout
+            cache_entry, from_cache = self.response_cache.get(file_cache, self.cache_timeout)
         self.print(("[cache] " if from_cache else "") + url, force=from_cache)
         page, self.error, response, last_url, proxy = None, None, None, None, None
+        response_content_type = None
         if from_cache:
-            with open(file_cache, "r") as f:
-                page = f.read()
+            page = cache_entry.body.decode('utf8', 'replace')
+            response_content_type = cache_entry.content_type
         else:
             if self.proxer and not self.proxer.is_alive():
                 raise ProxyLimitReached()
@@ -730,6 +875,12 @@ class requester():
             elif content_type:
                 headers.update({"Content-Type": content_type})
 
+            revalidated = False
+            if cache_entry and cache_entry.etag:
+                headers.update({"If-None-Match": cache_entry.etag})
+            if cache_entry and cache_entry.last_modified:
+                headers.update({"If-Modified-Since": cache_entry.last_modified})
+
             n_attempts = n_attempts or self.n_attempts
             attempt = 0
             while attempt < n_attempts:
@@ -768,18 +919,23 @@ class requester():
                 except Exception as err:
                     with_error_code = isinstance(err, (urllib.error.HTTPError, CurlFailedResponse))
                     error_code = err.code if with_error_code else None
-                    if ignore_codes and error_code in ignore_codes:
+                    if error_code == 304 and cache_entry:
+                        response = err
+                        page = cache_entry.body
+                        revalidated = True
+                    elif ignore_codes and error_code in ignore_codes:
                         force_json = False
                         response = err
                         page = read_response(response)
                     elif raise_codes and error_code in raise_codes:
                         if self.proxer:
-                            self.proxer.ok(proxy=str(proxy), time_response=datetime.utcnow() - time_start)
+                            self.proxer.ok(proxy=str(proxy), time_response=datetime.utcnow() - time_start,
+                                           host=urllib.parse.urlparse(url).netloc)
                         raise_fail(err, FailOnGetResponse(err))
                     else:
                         self.print(f'[error] code = {error_code}, response = {str(err)[:200]}')
                         self.error = err
-                        proxy_failed = self.proxy_fail(proxy)
+                        proxy_failed = self.proxy_fail(proxy, host=urllib.parse.urlparse(url).netloc)
 
                         error_exception = FailOnGetResponse(err)
 
@@ -814,26 +970,30 @@ class requester():
             if page and self.verify_word and self.verify_word not in page:
                 raise NoVerifyWord("No verify word '%s', size page = %d" % (self.verify_word, len(page)))
 
-            response_content_type = response.info().get('Content-Type')
+            if revalidated:
+                response_content_type = cache_entry.content_type
+            else:
+                response_content_type = response.info().get('Content-Type')
 
             try:
-                if file_cache and caching:
-                    cookie_write = True
-                    if response_content_type.startswith('application/json'):
-                        page = dumps(loads(page), indent=4)
-                        cookie_write = False
-                    if response_content_type.startswith('image/'):
-                        cookie_write = False
-                    with open(file_cache, "w") as f:
-                        f.write(page.decode('utf8'))
-                        if cookie_write:
-                            f.write("\n\n" + dumps(self.get_cookies(), indent=4))
+                if revalidated:
+                    self.response_cache.revalidate(file_cache)
+                elif caching and page is not None:
+                    self.response_cache.set(
+                        file_cache,
+                        url,
+                        page,
+                        content_type=response_content_type,
+                        etag=response.info().get('ETag'),
+                        last_modified=response.info().get('Last-Modified'),
+                    )
             except Exception:
                 traceback.print_exc()
                 self.print("[cache] ERROR: write to", file_cache)
 
             if self.proxer and not self.error:
-                self.proxer.ok(proxy=str(proxy), time_response=self.time_response)
+                self.proxer.ok(proxy=str(proxy), time_response=self.time_response,
+                               host=urllib.parse.urlparse(url).netloc)
 
             if page and (not response_content_type or not response_content_type.startswith('image/')):
                 matches = re.findall(r'charset=["\']?(?P<charset>[^"\'\s\.>;,]{3,}\b)', str(page), re.IGNORECASE)
@@ -873,7 +1033,7 @@ class requester():
             self.last_url = last_url
 
         if page and return_json:
-            if response_content_type.startswith('application/json') or force_json:
+            if (response_content_type or '').startswith('application/json') or force_json:
                 page = json.loads(page)
             else:
                 page = {'page': page, '__no_json': True}
@@ -887,6 +1047,71 @@ class requester():
             ret += [response.code]
         return ret
 
+    def spawn_worker(self, host=None):
+        """Copy of requester with own opener, sharing cookiejar, proxer and settings.
+
+        With proxer the worker takes its own proxy from the pool, so workers go through different proxies.
+        """
+        ret = copy.copy(self)
+        ret.pooled_proxy = None
+        if self.proxer:
+            ret.acquire_proxy(host=host)
+        else:
+            ret.opener = ret.build_opener(proxy=self.proxy)
+        return ret
+
+    def get_many(self, urls, **kwargs):
+        """Concurrent version of `get`, returns pages in the order of urls.
+
+        Each url is either a string or a dict with `url` key and additional `get` arguments.
+        See `async_get_many` for arguments.
+        """
+        return asyncio.run(self.async_get_many(urls, **kwargs))
+
+    async def async_get_many(self, urls, concurrency=8, per_host_rate=None, return_exceptions=False, **kwargs):
+        """Fetch urls with at most `concurrency` requests in flight.
+
+        `per_host_rate` limits requests per second for each host, either a number or a dict by host.
+        File cache, cookies, proxies and retries work the same way as in `get`.
+        """
+        loop = asyncio.get_running_loop()
+        limiter = HostRateLimiter(per_host_rate)
+        semaphore = asyncio.Semaphore(concurrency)
+        workers = []
+
+        def get_worker(url):
+            host = urllib.parse.urlparse(url).netloc
+            if not workers:
+                return self.spawn_worker(host=host)
+            worker = workers.pop()
+            if self.proxer and worker.proxy not in self.proxer.proxies:
+                worker.acquire_proxy(host=host)
+            elif not self.proxer and worker.proxy != self.proxy:
+                worker.opener = worker.build_opener(proxy=self.proxy)
+                worker.proxy = self.proxy
+            return worker
+
+        async def fetch(executor, url):
+            get_kwargs = dict(kwargs)
+            if isinstance(url, dict):
+                get_kwargs.update(url)
+                url = get_kwargs.pop('url')
+            async with semaphore:
+                await limiter.wait(url)
+                worker = get_worker(url)
+                try:
+                    return await loop.run_in_executor(executor, functools.partial(worker.get, url, **get_kwargs))
+                finally:
+                    workers.append(worker)
+
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                tasks = [fetch(executor, url) for url in urls]
+                return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+        finally:
+            for worker in workers:
+                worker.release_proxy()
+
     @property
     def current_url(self):
         return self.last_url
@@ -999,15 +1224,20 @@ class requester():
         }[form['method'].lower()]()
         return ret
 
+    @property
+    def response_cache(self):
+        return ResponseCache.get_instance(path.join(self.dir_cache, 'responses.sqlite3'), self.cache_max_size)
+
+    def remove_legacy_file_cache(self):
+        """Remove one-file-per-request cache files, they are not read since response cache is sqlite store."""
+        for file_cache in listdir(self.dir_cache):
+            if file_cache.endswith('.html'):
+                with suppress(FileNotFoundError):
+                    remove(path.join(self.dir_cache, file_cache))
+
     def file_cache_clear(self):
         if self.limit_file_cache and self.counter_file_cache % self.limit_file_cache == 0:
-            file_list = []
-            for file_cache in listdir(self.dir_cache):
-                stat_file = stat(self.dir_cache + file_cache)
-                file_list.append((stat_file.st_atime, file_cache))
-            file_list.sort(reverse=True)
-            for atime, file_cache in file_list[self.limit_file_cache:]:
-                remove(self.dir_cache + file_cache)
+            self.response_cache.evict()
         self.counter_file_cache += 1
 
     def get_raw_cookies(self):
@@ -1126,7 +1356,10 @@ class requester():
         if not isdir(self.dir_cache):
             return
 
-        for file_cache in listdir(self.dir_cache):
-            diff_time = (datetime.now() - datetime.fromtimestamp(getctime(self.dir_cache + file_cache)))
-            if diff_time.seconds >= self.cache_timeout:
-                remove(self.dir_cache + file_cache)
+        self.remove_legacy_file_cache()
+
+        response_cache = self.response_cache
+        response_cache.remove_expired(self.cache_timeout)
+        response_cache.evict()
+        if any(response_cache.stats.values()):
+            self.print('[cache] stats', response_cache.stats)
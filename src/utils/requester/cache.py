@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import threading
+import time
+import zlib
+from collections import namedtuple
+from os import makedirs, path
+
+import zstandard
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'content_type', 'etag', 'last_modified', 'created'])
+
+
+class ResponseCache:
+    """Size-bounded LRU store of compressed response bodies in a single sqlite file."""
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, filepath, max_size):
+        self.filepath = filepath
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evicted': 0}
+        self._connection = None
+        self._codecs = threading.local()
+
+    @classmethod
+    def get_instance(cls, filepath, max_size):
+        with cls._instances_lock:
+            if filepath not in cls._instances:
+                cls._instances[filepath] = cls(filepath, max_size)
+            instance = cls._instances[filepath]
+            instance.max_size = max_size
+            return instance
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            makedirs(path.dirname(self.filepath), mode=0o777, exist_ok=True)
+            connection = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    url TEXT,
+                    body BLOB,
+                    codec TEXT,
+                    size INTEGER,
+                    content_type TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    created REAL,
+                    accessed REAL
+                )
+            ''')
+            connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._connection = connection
+        return self._connection
+
+    def execute(self, *args):
+        with self.lock:
+            return self.connection.execute(*args).fetchall()
+
+    @property
+    def codecs(self):
+        """Zstd contexts are not thread-safe, so each thread gets its own pair."""
+        if not hasattr(self._codecs, 'compressor'):
+            self._codecs.compressor = zstandard.ZstdCompressor()
+            self._codecs.decompressor = zstandard.ZstdDecompressor()
+        return self._codecs
+
+    def compress(self, body):
+        return 'zstd', self.codecs.compressor.compress(body)
+
+    def decompress(self, codec, data):
+        if codec == 'zstd':
+            return self.codecs.decompressor.decompress(data)
+        if codec == 'gzip':
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    def get(self, key, timeout):
+        """Return entry by key even if it is expired, `is_fresh` tells if it can be used without a request."""
+        rows = self.execute(
+            'SELECT codec, body, content_type, etag, last_modified, created FROM responses WHERE key = ?',
+            (key,),
+        )
+        if not rows:
+            self.stats['misses'] += 1
+            return None, False
+        codec, data, content_type, etag, last_modified, created = rows[0]
+        is_fresh = time.time() - created < timeout
+        self.stats['hits' if is_fresh else 'misses'] += 1
+        self.execute('UPDATE responses SET accessed = ? WHERE key = ?', (time.time(), key))
+        entry = CacheEntry(self.decompress(codec, data), content_type, etag, last_modified, created)
+        return entry, is_fresh
+
+    def set(self, key, url, body, content_type=None, etag=None, last_modified=None):
+        codec, data = self.compress(body)
+        now = time.time()
+        self.execute(
+            'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, url, data, codec, len(data), content_type, etag, last_modified, now, now),
+        )
+
+    def revalidate(self, key):
+        self.stats['revalidated'] += 1
+        now = time.time()
+        self.execute('UPDATE responses SET created = ?, accessed = ? WHERE key = ?', (now, now, key))
+
+    def evict(self):
+        """Remove least recently accessed entries above the byte budget."""
+        if not self.max_size or not path.exists(self.filepath):
+            return
+        with self.lock:
+            deleted = self.connection.execute('''
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total_size FROM responses
+                    ) WHERE total_size > ?
+                )
+            ''', (self.max_size,)).rowcount
+        self.stats['evicted'] += max(deleted, 0)
+
+    def remove_expired(self, timeout):
+        """Remove expired entries which can not be revalidated."""
+        if not path.exists(self.filepath):
+            return
+        self.execute(
+            'DELETE FROM responses WHERE created < ? AND etag IS NULL AND last_modified IS NULL',
+            (time.time() - timeout,),
+        )
+
+    def clear(self):
+        self.execute('DELETE FROM responses')
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
+import hashlib
 import re
+import threading
+import time
+from collections import Counter, OrderedDict
 from datetime import datetime, timedelta, timezone
 from functools import wraps
 from urllib.parse import parse_qs, urlparse
@@ -117,20 +121,122 @@ def get_timezone(request):
     return request.session.get("timezone", settings.DEFAULT_TIME_ZONE_)
 
 
-def timed_cache(timeout_cache):
+TIMED_CACHE_NONE = '__timed_cache_none__'
+
+
+def get_timed_cache_key_part(value):
+    if isinstance(value, models.Model):
+        return f'{value._meta.label_lower}:{value.pk}'
+    return repr(value)
+
+
+def timed_cache(timeout_cache, local_timeout='1m', local_maxsize=1024, lock_timeout='30s', none_timeout=None):
+    """Cache function result in process memory (bounded LRU) and in django cache.
+
+    None results are cached for none_timeout (timeout_cache by default, not cached if zero).
+    Only one worker computes an expired value, others wait for it up to lock_timeout.
+    """
     timeout_cache = parse_duration(timeout_cache).total_seconds()
+    local_timeout = min(parse_duration(local_timeout).total_seconds(), timeout_cache)
+    lock_timeout = parse_duration(lock_timeout).total_seconds()
+    if none_timeout is None:
+        none_timeout = timeout_cache
+    elif none_timeout:
+        none_timeout = parse_duration(none_timeout).total_seconds()
+    n_key_locks = 64
 
     def decorator(func):
-        @wraps(func)
-        def decorated(*args, **kwargs):
-            key = f'{func.__module__}.{func.__qualname__}.{args}.{kwargs}'
+        local_cache = OrderedDict()
+        local_lock = threading.Lock()
+        key_locks = [threading.Lock() for _ in range(n_key_locks)]
+        stats = Counter()
+
+        def get_key(args, kwargs):
+            parts = [get_timed_cache_key_part(arg) for arg in args]
+            parts.extend(f'{k}={get_timed_cache_key_part(v)}' for k, v in sorted(kwargs.items()))
+            key = f'{func.__module__}.{func.__qualname__}({",".join(parts)})'
             key = key.replace(' ', '')
-            ret = cache.get(key)
-            if ret is None:
-                ret = func(*args, **kwargs)
-                cache.set(key, ret, timeout_cache)
-            return ret
+            if len(key) > 200:
+                key = f'{func.__module__}.{func.__qualname__}#{hashlib.md5(key.encode()).hexdigest()}'
+            return key
+
+        def get_local(key):
+            with local_lock:
+                if key not in local_cache:
+                    return None
+                expires, value = local_cache[key]
+                if expires < time.monotonic():
+                    local_cache.pop(key)
+                    return None
+                local_cache.move_to_end(key)
+                return value
+
+        def set_local(key, value):
+            timeout = min(local_timeout, none_timeout) if value == TIMED_CACHE_NONE else local_timeout
+            if not timeout:
+                return
+            with local_lock:
+                local_cache[key] = (time.monotonic() + timeout, value)
+                local_cache.move_to_end(key)
+                while len(local_cache) > local_maxsize:
+                    local_cache.popitem(last=False)
+
+        def compute(key, args, kwargs):
+            lock_key = f'{key}[lock]'
+            deadline = time.monotonic() + lock_timeout
+            # add returns None instead of False if cache is unavailable and exceptions are ignored
+            while cache.add(lock_key, 1, lock_timeout) is False and time.monotonic() < deadline:
+                time.sleep(0.05)
+                value = cache.get(key)
+                if value is not None:
+                    stats['waited'] += 1
+                    return value
+            try:
+                stats['misses'] += 1
+                value = func(*args, **kwargs)
+                if value is None:
+                    value = TIMED_CACHE_NONE
+                    if none_timeout:
+                        cache.set(key, value, none_timeout)
+                else:
+                    cache.set(key, value, timeout_cache)
+                return value
+            finally:
+                cache.delete(lock_key)
 
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            key = get_key(args, kwargs)
+            value = get_local(key)
+            if value is not None:
+                stats['local_hits'] += 1
+            else:
+                with key_locks[hash(key) % n_key_locks]:
+                    value = get_local(key)
+                    if value is None:
+                        value = cache.get(key)
+                        if value is None:
+                            value = compute(key, args, kwargs)
+                        else:
+                            stats['hits'] += 1
+                        set_local(key, value)
+                    else:
+                        stats['local_hits'] += 1
+            return None if value == TIMED_CACHE_NONE else value
+
+        def cache_clear():
+            with local_lock:
+                local_cache.clear()
+            stats.clear()
+
+        def cache_info():
+            total = sum(stats.values())
+            n_hits = stats['local_hits'] + stats['hits'] + stats['waited']
+            return {**stats, 'hit_rate': n_hits / total if total else None}
+
+        decorated.cache_clear = cache_clear
+        decorated.cache_info = cache_info
+        decorated.stats = stats
         return decorated
 
     return decorator